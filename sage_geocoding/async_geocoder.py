@@ -0,0 +1,232 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from metrics import exception_outcome, metrics
+from point_store import point_results
+from providers import get_provider
+from retry import is_final, retry_async
+
+import aiohttp
+import asyncio
+import time
+
+
+# define AsyncGeocoder class
+class AsyncGeocoder:
+
+    # constructor
+    def __init__(self, gc_service, concurrency=None, base_url=None, token=None, timeout=10, min_interval=None):
+        """
+        Asyncio geocoder for a single service with a pooled keep-alive session. Requests are described by the service's
+        provider (see providers.py); providers without an http api (local) are called directly.
+        :param gc_service: geocoding service name
+        :param concurrency: maximum number of requests in flight (default: the provider's concurrency)
+        :param base_url: service base url (default: the provider's base_url)
+        :param token: api token (default: the provider's token)
+        :param timeout: request timeout in seconds
+        :param min_interval: minimum seconds between starting requests (default: the provider's min_interval)
+        """
+        self.gc_service = gc_service
+        self.provider = get_provider(gc_service)
+        self.concurrency = self.provider.concurrency if concurrency is None else concurrency
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.token = token if token is not None else self.provider.token()
+        self.timeout = timeout
+        self.min_interval = self.provider.min_interval if min_interval is None else min_interval
+
+        # created in open() so they belong to the running event loop
+        self.session = None
+        self.semaphore = None
+        self.interval_lock = None
+        self.next_time = 0.0
+
+    ###########
+    # METHODS #
+    ###########
+
+    # open pooled session
+    async def open(self):
+        """
+        Open the keep-alive session (connections are reused for every request to the service).
+        :return: None
+        """
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.interval_lock = asyncio.Lock()
+        if not self.provider.http:
+            return None
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=30)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                             headers={'User-Agent': 'sdsu_geog582_final'})
+
+        return None
+
+    # close pooled session
+    async def close(self):
+        """
+        Close the session and its pooled connections.
+        :return: None
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+        return None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    # url and query parameters for an address
+    def build_request(self, address):
+        """
+        Build the request url and query parameters for the service.
+        :param address: address string
+        :return: url, dictionary of query parameters
+        """
+        return self.provider.build_request(address, self.base_url, self.token)
+
+    # coordinates and match confidence from a response
+    def parse_response(self, results):
+        """
+        Get the coordinates and match confidence of the first result from the service's json response.
+        :param results: decoded json response
+        :return: latitude, longitude, match confidence
+        """
+        return self.provider.parse_response(results)
+
+    # wait for the service's minimum interval
+    async def wait(self):
+        """
+        Space out request starts by min_interval seconds.
+        :return: None
+        """
+        if self.min_interval <= 0:
+            return None
+
+        async with self.interval_lock:
+            now = time.monotonic()
+            if self.next_time > now:
+                await asyncio.sleep(self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.min_interval
+
+        return None
+
+    # geocode a Point object
+    async def geocode(self, point):
+        """
+        Geocode the Point object's address and set latitude, longitude and confidence (None if the geocode fails).
+        :param point: Point object
+        :return: request outcome (see metrics.exception_outcome)
+        """
+        async with self.semaphore:
+            await self.wait()
+            start = time.perf_counter()
+            outcome = 'success'
+            try:
+                # offline providers answer directly
+                if not self.provider.http:
+                    point.latitude, point.longitude, point.confidence = self.provider.geocode(point.address)
+                else:
+                    url, params = self.build_request(point.address)
+                    async with self.session.get(url, params=params) as response:
+                        response.raise_for_status()
+                        results = await response.json(content_type=None)
+                    point.latitude, point.longitude, point.confidence = self.parse_response(results)
+            # print exception if geocode not successful
+            except Exception as e:
+                outcome = exception_outcome(e)
+                print('Exception for {}, {}, {}: {}'.format(point.id_num, point.name, point.address, repr(e)))
+
+            # request latency and outcome
+            metrics.record_request(self.gc_service, time.perf_counter() - start, outcome)
+
+        return outcome
+
+
+# geocode every row of the point store with one service
+async def geocode_points_async(store, gc_service, cache=None, concurrency=None, journal=None, retry_policy=None, **kwargs):
+    """
+    Geocode the addresses in the point store with many requests in flight (the store is not modified).
+    :param store: PointStore with ids, names and addresses
+    :param gc_service: which geocoding service to use to get coordinates
+    :param cache: optional GeocodeCache, checked before sending a request to the geocoding service (not used for
+    providers that are not cacheable)
+    :param concurrency: maximum number of requests in flight (default: the provider's concurrency)
+    :param journal: optional GeocodeJournal, each outcome is recorded as soon as it arrives
+    :param retry_policy: RetryPolicy for transient errors (default: RetryPolicy())
+    :param kwargs: other AsyncGeocoder parameters (base_url, token, timeout, min_interval)
+    :return: numpy array of latitudes, numpy array of longitudes (NaN for failed geocodes), numpy array of match
+    confidences (NaN if not reported)
+    """
+    # results of offline providers are not cached
+    if not get_provider(gc_service).cacheable:
+        cache = None
+
+    # create a Point object for each row
+    points = store.new_points(gc_service)
+
+    # use cached results if available
+    pending = []
+    for point in points:
+        cached = cache.get(gc_service, point.address) if cache is not None else None
+        if cached is not None:
+            point.latitude, point.longitude, point.confidence = cached
+        else:
+            pending.append(point)
+
+    # geocode with retries, record an answer ('success' or 'failure') as soon as it arrives (errors are not cached or
+    # journaled, so the address is geocoded again by the next run)
+    async def geocode(geocoder, point):
+        outcome = await retry_async(lambda: geocoder.geocode(point), gc_service, retry_policy)
+        if is_final(outcome):
+            if cache is not None:
+                cache.put(gc_service, point.address, point.latitude, point.longitude, point.confidence)
+            if journal is not None:
+                journal.record(gc_service, point.id_num, point.latitude, point.longitude, point.confidence)
+
+    # geocode the rest with one pooled session
+    if pending:
+        async with AsyncGeocoder(gc_service, concurrency=concurrency, **kwargs) as geocoder:
+            await asyncio.gather(*[geocode(geocoder, point) for point in pending])
+
+    return point_results(points)
+
+
+# batch api: geocode the point store with one or more services in one event loop
+def geocode_address_table_async(store, gc_services, cache=None, concurrency=None, journal=None, **kwargs):
+    """
+    Geocode the addresses in the point store with the asyncio engine. All services run in the same event loop, each
+    with its own pooled session and concurrency cap. Only rows without a result are geocoded, once per unique address.
+    :param store: PointStore with ids, names and addresses
+    :param gc_services: list of geocoding services
+    :param cache: optional GeocodeCache shared by all services
+    :param concurrency: maximum number of requests in flight per service (default: each provider's concurrency)
+    :param journal: optional GeocodeJournal, each outcome is recorded as soon as it arrives
+    :param kwargs: retry_policy and other AsyncGeocoder parameters (base_url, token, timeout, min_interval)
+    :return: updated PointStore
+    """
+    # rows still pending for each service, one row per unique address
+    rows = []
+    unique = []
+    for service in gc_services:
+        store.fill_duplicates(service)
+        rows.append(store.pending_rows(service))
+        unique.append(store.unique_rows(rows[-1]))
+
+    async def run_all():
+        return await asyncio.gather(*[geocode_points_async(store.subset(unique_rows), service, cache, concurrency, journal, **kwargs)
+                                      for service, (unique_rows, inverse) in zip(gc_services, unique)])
+
+    results = asyncio.run(run_all())
+
+    # merge results into the store, fanned out to every row with the address
+    for service, service_rows, (unique_rows, inverse), (latitude, longitude, confidence) in zip(gc_services, rows, unique, results):
+        store.set_coordinates(service, latitude[inverse], longitude[inverse], rows=service_rows, confidence=confidence[inverse])
+
+    return store
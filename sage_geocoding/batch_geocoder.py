@@ -0,0 +1,248 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from metrics import exception_outcome, metrics
+from point_store import point_results
+from providers import BING_CONFIDENCE, get_provider
+from retry import run_with_retries
+
+import json
+import time
+
+# histogram bucket upper bounds in seconds for batch requests (Bing jobs are polled for minutes)
+BATCH_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+# services with batch geocoding endpoints
+BATCH_SERVICES = ('arcgis', 'bing')
+
+# default number of addresses submitted per batch (ArcGIS geocodeAddresses accepts up to 1000 records per request,
+# Bing Spatial Data Services geocode jobs accept up to 200,000 entities)
+BATCH_SIZES = {'arcgis': 1000, 'bing': 50000}
+
+# default timeout in seconds of each batch request (a full ArcGIS batch takes minutes to geocode, a Bing job request
+# uploads or downloads up to 50,000 records); single address requests use the provider's timeout
+BATCH_TIMEOUTS = {'arcgis': 300, 'bing': 120}
+
+# Bing data schema fields read from a job's succeeded results
+BING_FIELDS = ('Id', 'GeocodeResponse/Point/Latitude', 'GeocodeResponse/Point/Longitude', 'GeocodeResponse/Confidence')
+
+# default service endpoints
+BATCH_URLS = {'arcgis': 'https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/geocodeAddresses',
+              'bing': 'https://spatial.virtualearth.net/REST/v1/Dataflows/Geocode'}
+
+
+# define BatchJobUnfinished class
+class BatchJobUnfinished(RuntimeError):
+    """
+    A batch job was still running when its wait ran out. The job keeps running on the service, so the batch is not
+    retried (a retry would submit the same addresses as a second job); the outcome is 'error' and the addresses stay
+    pending for the next run.
+    """
+
+
+# geocode a batch of addresses with ArcGIS geocodeAddresses
+def arcgis_batch_geocode(records, token=None, url=None, timeout=None):
+    """
+    Geocode a batch of addresses with one ArcGIS geocodeAddresses request.
+    :param records: list of (record id, address) tuples, record ids are small integers
+    :param token: ArcGIS token (default: the arcgis provider's token)
+    :param url: geocodeAddresses url (default: BATCH_URLS['arcgis'])
+    :param timeout: request timeout in seconds (default: BATCH_TIMEOUTS['arcgis'])
+    :return: dictionary of record id: (latitude, longitude, confidence) for matched addresses (score between 0 and 1)
+    """
+    provider = get_provider('arcgis')
+    session = provider.session
+    if token is None:
+        token = provider.token()
+    if url is None:
+        url = BATCH_URLS['arcgis']
+    if timeout is None:
+        timeout = BATCH_TIMEOUTS['arcgis']
+
+    # record id is sent as OBJECTID and returned as ResultID
+    addresses = {'records': [{'attributes': {'OBJECTID': int(record_id), 'SingleLine': str(address)}} for record_id, address in records]}
+    data = {'addresses': json.dumps(addresses), 'forStorage': 'true', 'token': token, 'f': 'json'}
+
+    r = session.post(url, data=data, timeout=timeout)
+    r.raise_for_status()
+    results = r.json()
+
+    # keep matched and tied locations
+    coords = {}
+    for location in results['locations']:
+        attributes = location['attributes']
+        if attributes.get('Status') in ('M', 'T') and location.get('location'):
+            score = attributes.get('Score')
+            coords[attributes['ResultID']] = (location['location']['y'], location['location']['x'],
+                                              None if score is None else score / 100)
+
+    return coords
+
+
+# parse the succeeded results of a Bing geocode job
+def parse_bing_results(text):
+    """
+    Parse a pipe delimited Bing Spatial Data Services results file (a version line, a header line with the data schema
+    field names, then one line per record). Fields are found by name in the header, so the order and number of output
+    columns do not matter.
+    :param text: file content
+    :return: dictionary of record id: (latitude, longitude, confidence) for records with coordinates
+    """
+    lines = text.splitlines()
+    if len(lines) < 2:
+        return {}
+
+    # column index of each field, the confidence column is optional
+    header = [field.strip() for field in lines[1].split('|')]
+    missing = [field for field in BING_FIELDS[:3] if field not in header]
+    if missing:
+        raise ValueError('Bing geocode results have no {} field'.format(', '.join(missing)))
+    id_col, lat_col, lon_col = (header.index(field) for field in BING_FIELDS[:3])
+    confidence_col = header.index(BING_FIELDS[3]) if BING_FIELDS[3] in header else None
+
+    coords = {}
+    for line in lines[2:]:
+        fields = line.split('|')
+        if len(fields) <= max(id_col, lat_col, lon_col) or not fields[lat_col] or not fields[lon_col]:
+            continue
+        confidence = None
+        if confidence_col is not None and confidence_col < len(fields):
+            confidence = BING_CONFIDENCE.get(fields[confidence_col])
+        coords[int(fields[id_col])] = (float(fields[lat_col]), float(fields[lon_col]), confidence)
+
+    return coords
+
+
+# geocode a batch of addresses with a Bing Spatial Data Services geocode job
+def bing_batch_geocode(records, token=None, url=None, poll_interval=15, max_wait=3600, timeout=None):
+    """
+    Submit a batch of addresses as a Bing Spatial Data Services geocode job, poll until it finishes and download results.
+    :param records: list of (record id, address) tuples, record ids are small integers
+    :param token: Bing maps key (default: the bing provider's token)
+    :param url: geocode dataflow url (default: BATCH_URLS['bing'])
+    :param poll_interval: seconds between job status requests
+    :param max_wait: seconds to wait for the job before giving up with BatchJobUnfinished
+    :param timeout: timeout in seconds of each request (default: BATCH_TIMEOUTS['bing'])
+    :return: dictionary of record id: (latitude, longitude, confidence) for matched addresses (see
+    providers.BING_CONFIDENCE)
+    """
+    provider = get_provider('bing')
+    session = provider.session
+    if token is None:
+        token = provider.token()
+    if url is None:
+        url = BATCH_URLS['bing']
+    if timeout is None:
+        timeout = BATCH_TIMEOUTS['bing']
+
+    # pipe delimited input data (pipes inside addresses would break the format)
+    lines = ['Bing Spatial Data Services, 2.0',
+             'Id|GeocodeRequest/Query|GeocodeResponse/Point/Latitude|GeocodeResponse/Point/Longitude|GeocodeResponse/Confidence']
+    for record_id, address in records:
+        lines.append('{}|{}|||'.format(record_id, str(address).replace('|', ' ')))
+
+    # create job
+    r = session.post(url, params={'input': 'pipe', 'output': 'json', 'key': token}, data='\n'.join(lines).encode('utf-8'),
+                     headers={'Content-Type': 'text/plain'}, timeout=timeout)
+    r.raise_for_status()
+    job = r.json()['resourceSets'][0]['resources'][0]
+
+    # poll job status until the deadline (each status request is bounded by the timeout)
+    deadline = time.monotonic() + max_wait
+    while job['status'] not in ('Completed', 'Aborted'):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise BatchJobUnfinished('Bing geocode job {} did not finish in {} seconds'.format(job['id'], max_wait))
+        time.sleep(min(poll_interval, remaining))
+        r = session.get('{}/{}'.format(url, job['id']), params={'output': 'json', 'key': token}, timeout=timeout)
+        r.raise_for_status()
+        job = r.json()['resourceSets'][0]['resources'][0]
+
+    if job['status'] == 'Aborted':
+        raise RuntimeError('Bing geocode job {} aborted: {}'.format(job['id'], job.get('errorMessage')))
+
+    # download succeeded results (pipe delimited, with the full data schema header)
+    coords = {}
+    for link in job.get('links', []):
+        if link.get('role') == 'output' and link.get('name') == 'succeeded':
+            r = session.get(link['url'], params={'key': token}, timeout=timeout)
+            r.raise_for_status()
+            coords.update(parse_bing_results(r.content.decode('utf-8-sig')))
+
+    return coords
+
+
+# geocode the point store with a batch endpoint
+def geocode_points_batch(store, gc_service, batch_size=None, cache=None, journal=None, retry_policy=None, **kwargs):
+    """
+    Geocode the addresses in the point store in chunks submitted to the service's batch endpoint (the store is not
+    modified). Results are mapped back to rows by their position in the chunk.
+    :param store: PointStore with ids, names and addresses
+    :param gc_service: geocoding service with a batch endpoint (arcgis, bing)
+    :param batch_size: number of addresses per batch (default: BATCH_SIZES[gc_service])
+    :param cache: optional GeocodeCache, checked before submitting addresses
+    :param journal: optional GeocodeJournal, outcomes are recorded as each batch finishes
+    :param retry_policy: RetryPolicy for batches that fail with a transient error (default: RetryPolicy())
+    :param kwargs: other parameters for the service's batch function (token, url, timeout, poll_interval, max_wait)
+    :return: numpy array of latitudes, numpy array of longitudes (NaN for failed geocodes), numpy array of match
+    confidences (NaN if not reported)
+    """
+    if gc_service not in BATCH_SERVICES:
+        raise ValueError('No batch endpoint for geocoding service: {}'.format(gc_service))
+    if batch_size is None:
+        batch_size = BATCH_SIZES[gc_service]
+    batch_geocode = arcgis_batch_geocode if gc_service == 'arcgis' else bing_batch_geocode
+
+    # create a Point object for each row
+    points = store.new_points(gc_service)
+
+    # use cached results if available
+    pending = []
+    for point in points:
+        cached = cache.get(gc_service, point.address) if cache is not None else None
+        if cached is not None:
+            point.latitude, point.longitude, point.confidence = cached
+        else:
+            pending.append(point)
+
+    # submit a chunk of the remaining addresses
+    results = {}
+
+    def attempt(start):
+        chunk = pending[start:start + batch_size]
+        batch_start = time.perf_counter()
+        try:
+            results[start] = batch_geocode([(k, point.address) for k, point in enumerate(chunk)], **kwargs)
+        # print exception if the batch was not successful
+        except Exception as e:
+            outcome = exception_outcome(e)
+            metrics.observe('geocode_batch_seconds', time.perf_counter() - batch_start, BATCH_BUCKETS, service=gc_service)
+            metrics.inc('geocode_batch_records_total', len(chunk), service=gc_service, outcome=outcome)
+            print('Exception for {} batch of {} addresses: {}'.format(gc_service, len(chunk), e))
+            return outcome
+
+        # batch latency, matched and unmatched records
+        metrics.observe('geocode_batch_seconds', time.perf_counter() - batch_start, BATCH_BUCKETS, service=gc_service)
+        metrics.inc('geocode_batch_records_total', len(results[start]), service=gc_service, outcome='success')
+        metrics.inc('geocode_batch_records_total', len(chunk) - len(results[start]), service=gc_service, outcome='failure')
+        return 'success'
+
+    # map results back to Point objects by position in the chunk (record ids fit the services' 32-bit id fields);
+    # addresses in a failed batch are left as failed and are not cached or journaled
+    def done(start, outcome):
+        if outcome != 'success':
+            return
+        coords = results.pop(start)
+        for k, point in enumerate(pending[start:start + batch_size]):
+            if k in coords:
+                point.latitude, point.longitude, point.confidence = coords[k]
+            if cache is not None:
+                cache.put(gc_service, point.address, point.latitude, point.longitude, point.confidence)
+            if journal is not None:
+                journal.record(gc_service, point.id_num, point.latitude, point.longitude, point.confidence)
+
+    # submit chunks, retrying transient errors
+    run_with_retries(range(0, len(pending), batch_size), attempt, gc_service, retry_policy, done=done)
+
+    return point_results(points)
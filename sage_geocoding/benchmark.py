@@ -0,0 +1,325 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from async_geocoder import geocode_address_table_async
+from normalize import canonical_series
+from providers import available_providers, configure_provider, get_provider
+from spatial_index import KnownSiteIndex
+import stub_geocoder
+from stub_geocoder import key_location
+from utility import create_address_table, \
+    create_points_known_coords, \
+    output_geocode_results_csv, \
+    output_geocode_results_vector, \
+    create_distance_table, \
+    calc_distance_statistics, \
+    plot_result_distances, \
+    map_geocoding_results, \
+    create_bubble_map, \
+    distance_column, \
+    service_style
+
+import argparse
+import cProfile
+import datetime
+import json
+import matplotlib.pyplot as plt
+import numpy as np
+import os
+import pandas as pd
+import platform
+import pstats
+import requests
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# synthetic address parts
+STREETS = ['Main', 'Broadway', 'El Cajon', 'University', 'Mission Gorge', 'Fairmount', 'Euclid', 'Imperial', 'Market',
+           'Adams', 'Park', 'Garnet', 'Clairemont', 'Genesee', 'Balboa', 'Convoy', 'Rosecrans', 'Midway', 'Sports Arena']
+SUFFIXES = [('Street', 'St.'), ('Avenue', 'Ave'), ('Boulevard', 'Blvd.'), ('Road', 'Rd'), ('Drive', 'Dr.')]
+CITIES = ['San Diego', 'La Mesa', 'El Cajon', 'Chula Vista', 'Santee']
+
+
+# create a synthetic address table
+def synthetic_address_table(rows, unique_fraction=0.8, seed=0):
+    """
+    Create an address table shaped like the source csv. Sites are repeated with variations in case and street suffix
+    (like several RP records for one site), and known coordinates lie within a few hundred feet of the address location
+    on the stub server.
+    :param rows: number of rows
+    :param unique_fraction: number of distinct sites as a fraction of rows
+    :param seed: random seed
+    :return: pandas df with 'Name ', 'Address', 'Latitude' and 'Longitude' columns
+    """
+    rng = np.random.default_rng(seed)
+    sites = max(1, int(rows * unique_fraction))
+
+    # site of each row: every site once, then repeats
+    site = np.concatenate([np.arange(sites), rng.integers(0, sites, rows - sites)])
+    rng.shuffle(site)
+
+    # site addresses with the suffix spelled out or abbreviated
+    number = pd.Series(rng.integers(100, 20000, sites)).astype(str)
+    street = pd.Series(np.array(STREETS)[rng.integers(0, len(STREETS), sites)])
+    suffix = rng.integers(0, len(SUFFIXES), sites)
+    city = pd.Series(np.array(CITIES)[rng.integers(0, len(CITIES), sites)])
+    long_address = number + ' ' + street + ' ' + pd.Series([SUFFIXES[s][0] for s in suffix]) + ', ' + city + ', CA'
+    short_address = number + ' ' + street + ' ' + pd.Series([SUFFIXES[s][1] for s in suffix]) + ' ' + city + ' CA'
+
+    # row addresses: long form, short form or upper case short form
+    variant = rng.integers(0, 3, rows)
+    address = np.where(variant == 0, long_address.to_numpy()[site], short_address.to_numpy()[site])
+    address = np.where(variant == 2, pd.Series(address).str.upper().to_numpy(), address)
+
+    # known coordinates near the stub location of each site (about 1% of rows have none)
+    location = np.array([key_location(key) for key in canonical_series(long_address)])
+    latitude = location[site, 0] + rng.normal(0, 0.001, rows)
+    longitude = location[site, 1] + rng.normal(0, 0.001, rows)
+    missing = rng.random(rows) < 0.01
+    latitude[missing] = np.nan
+    longitude[missing] = np.nan
+
+    return pd.DataFrame({'Name ': pd.Series(site).map('Cleaners {}'.format), 'Address': address,
+                         'Latitude': latitude, 'Longitude': longitude})
+
+
+# reference address points for the local provider
+def synthetic_reference_points(table):
+    """
+    Create reference address points for a synthetic address table: one point per site at its location on the stub
+    server, so the local provider returns the same coordinates as the stub services' rooftop results.
+    :param table: synthetic address table
+    :return: pandas df with 'Address', 'Latitude' and 'Longitude' columns
+    """
+    address = pd.Series(canonical_series(table['Address']).unique())
+    location = np.array([key_location(key) for key in address]).reshape(-1, 2)
+
+    return pd.DataFrame({'Address': address, 'Latitude': location[:, 0], 'Longitude': location[:, 1]})
+
+
+# profiler entries with the most cumulative time
+def profile_summary(profiler, top=20):
+    """
+    Summarize a profile as the functions with the most cumulative time.
+    :param profiler: cProfile.Profile
+    :param top: number of functions
+    :return: list of dictionaries (function, calls, total_seconds, cumulative_seconds)
+    """
+    entries = []
+    for (filename, line, func), (_, calls, total, cumulative, _) in pstats.Stats(profiler).stats.items():
+        entries.append({'function': '{}:{}({})'.format(os.path.basename(filename), line, func), 'calls': calls,
+                        'total_seconds': total, 'cumulative_seconds': cumulative})
+    entries.sort(key=lambda entry: entry['cumulative_seconds'], reverse=True)
+
+    return entries[:top]
+
+
+# time one pipeline stage
+def run_stage(stages, name, func, *args, profile=False, **kwargs):
+    """
+    Run a pipeline stage and record its wall time, peak memory so far and (optionally) a profile summary.
+    :param stages: dictionary of stage name: results, updated in place
+    :param name: stage name
+    :param func: function to run
+    :param args: positional arguments for func
+    :param profile: profile the stage with cProfile
+    :param kwargs: keyword arguments for func
+    :return: return value of func
+    """
+    profiler = cProfile.Profile() if profile else None
+
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    result = func(*args, **kwargs)
+    if profiler is not None:
+        profiler.disable()
+    seconds = time.perf_counter() - start
+
+    stages[name] = {'seconds': seconds}
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+        stages[name]['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    if profiler is not None:
+        stages[name]['profile'] = profile_summary(profiler)
+    print('{:>10} rows  {:<32} {:10.3f} s'.format(stages['rows'], name, seconds))
+
+    return result
+
+
+# start the stub geocoder in a separate process
+def start_stub_server(latency=0.0, error_rate=0.0, timeout=30):
+    """
+    Run stub_geocoder.py in a child process on a free port (so serving requests does not compete with the pipeline
+    for the interpreter) and wait until it answers.
+    :param latency: seconds each response is delayed
+    :param error_rate: fraction of requests answered with an error
+    :param timeout: seconds to wait for the server to start
+    :return: subprocess.Popen, base url
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    process = subprocess.Popen([sys.executable, stub_geocoder.__file__, '--port', str(port), '--latency', str(latency),
+                                '--error-rate', str(error_rate), '--seed', '0'])
+    base_url = 'http://127.0.0.1:{}'.format(port)
+
+    start = time.time()
+    while True:
+        try:
+            requests.get(base_url + '/stats', timeout=1)
+            return process, base_url
+        except requests.ConnectionError:
+            if time.time() - start > timeout or process.poll() is not None:
+                process.kill()
+                raise RuntimeError('Stub geocoder did not start on port {}'.format(port))
+            time.sleep(0.1)
+
+
+# number of requests answered by the stub geocoder
+def stub_requests(base_url):
+    """
+    Get the number of geocoding requests the stub server has answered.
+    :param base_url: stub server url
+    :return: request count
+    """
+    return requests.get(base_url + '/stats').json()['requests']
+
+
+# benchmark the pipeline for one table size
+def benchmark_pipeline(rows, workdir, base_url, gc_services, unique_fraction=0.8, concurrency=64, profile=False):
+    """
+    Run every stage of main.py on a synthetic table, geocoding against the stub server (and, for the local provider,
+    against reference address points at the stub locations).
+    :param rows: number of rows in the synthetic table
+    :param workdir: directory for input and output files
+    :param base_url: stub server url
+    :param gc_services: list of geocoding services
+    :param unique_fraction: number of distinct sites as a fraction of rows
+    :param concurrency: maximum number of requests in flight per service
+    :param profile: profile each stage with cProfile
+    :return: dictionary of stage name: results
+    """
+    stages = {'rows': rows}
+    csv_in = os.path.join(workdir, 'addresses_{}.csv'.format(rows))
+    out = os.path.join(workdir, '{}_{}'.format(rows, '{}'))
+    columns = [distance_column(service) for service in gc_services]
+    colors = [service_style(service)[1] for service in gc_services]
+
+    # input file (not timed as a pipeline stage)
+    table = synthetic_address_table(rows, unique_fraction)
+    table.to_csv(csv_in, index=False)
+
+    # reference address points for the local provider, indexed before geocoding
+    if 'local' in gc_services:
+        reference = os.path.join(workdir, 'address_points_{}.csv'.format(rows))
+        synthetic_reference_points(table).to_csv(reference, index=False)
+        configure_provider('local', reference_path=reference)
+        run_stage(stages, 'local_address_index', get_provider, 'local', profile=profile)
+
+    # pipeline stages in the order of main.py
+    addr = run_stage(stages, 'create_address_table', create_address_table, csv_in, profile=profile)
+    store = run_stage(stages, 'create_points_known_coords', create_points_known_coords, addr, 'Name ', 'Address',
+                      'Latitude', 'Longitude', profile=profile)
+    store = run_stage(stages, 'geocode_address_table', geocode_address_table_async, store, gc_services,
+                      concurrency=concurrency, base_url=base_url, token='stub', min_interval=0, profile=profile)
+    run_stage(stages, 'output_geocode_results_csv', lambda: [output_geocode_results_csv(store, service, out.format(service + '.csv'))
+                                                            for service in gc_services], profile=profile)
+    run_stage(stages, 'output_geocode_results_shp', lambda: [output_geocode_results_vector(store, service, out.format(service + '.shp'))
+                                                            for service in gc_services], profile=profile)
+    site_index = run_stage(stages, 'known_site_index', KnownSiteIndex.from_store, store, profile=profile)
+    dist = run_stage(stages, 'create_distance_table', create_distance_table, addr, store, out.format('distance_table.csv'),
+                     site_index=site_index, radius_feet=500, profile=profile)
+    run_stage(stages, 'calc_distance_statistics', calc_distance_statistics, dist, out.format('distance_statistics.csv'),
+              profile=profile)
+    run_stage(stages, 'plot_result_distances', plot_result_distances, dist, out.format('boxplot.png'), profile=profile)
+    run_stage(stages, 'plot_result_distances_summary', plot_result_distances, dist, out.format('summary.png'),
+              mode='summary', profile=profile)
+    plt.close('all')
+    run_stage(stages, 'map_geocoding_results', map_geocoding_results, out.format('map.html'), [colors[0], 'darkpurple'],
+              ['cloud', 'star'], store, gc_services[0], 'known', profile=profile)
+    run_stage(stages, 'create_bubble_map', create_bubble_map, store, dist, columns, colors, out.format('bubble_map.html'),
+              profile=profile)
+
+    stages['total_seconds'] = sum(stage['seconds'] for stage in stages.values() if isinstance(stage, dict))
+
+    return stages
+
+
+# run the benchmark suite
+def run_benchmarks(sizes, output, gc_services=None, latency=0.0, error_rate=0.0, unique_fraction=0.8, concurrency=64,
+                   profile=False, workdir=None):
+    """
+    Benchmark the pipeline for each table size against a local stub geocoder and save the results as JSON.
+    :param sizes: list of table sizes (rows)
+    :param output: path to save results JSON
+    :param gc_services: list of geocoding services (default: every registered provider)
+    :param latency: seconds each stub response is delayed
+    :param error_rate: fraction of stub requests answered with an error
+    :param unique_fraction: number of distinct sites as a fraction of rows
+    :param concurrency: maximum number of requests in flight per service
+    :param profile: profile each stage with cProfile
+    :param workdir: directory for input and output files (default: a temporary directory that is removed afterwards)
+    :return: results dictionary
+    """
+    if gc_services is None:
+        gc_services = available_providers()
+
+    results = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'config': {'sizes': sizes, 'gc_services': gc_services, 'latency': latency, 'error_rate': error_rate,
+                          'unique_fraction': unique_fraction, 'concurrency': concurrency, 'profile': profile},
+               'runs': []}
+
+    tmpdir = workdir is None
+    if tmpdir:
+        workdir = tempfile.mkdtemp(prefix='sage_benchmark_')
+
+    process, base_url = start_stub_server(latency, error_rate)
+    try:
+        for rows in sizes:
+            start_requests = stub_requests(base_url)
+            stages = benchmark_pipeline(rows, workdir, base_url, gc_services, unique_fraction, concurrency, profile)
+            stages['stub_requests'] = stub_requests(base_url) - start_requests
+            results['runs'].append(stages)
+
+            # save after every size so finished runs are kept
+            with open(output, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        process.terminate()
+        process.wait()
+        if tmpdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the geocoding pipeline against a local stub geocoder.')
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='comma separated table sizes (rows)')
+    parser.add_argument('--output', default='benchmark_results.json', help='path to save results JSON')
+    parser.add_argument('--services', default=','.join(available_providers()), help='comma separated geocoding services')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds each stub response is delayed')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of stub requests answered with an error')
+    parser.add_argument('--unique-fraction', type=float, default=0.8, help='distinct sites as a fraction of rows')
+    parser.add_argument('--concurrency', type=int, default=64, help='requests in flight per service')
+    parser.add_argument('--profile', action='store_true', help='profile each stage with cProfile')
+    parser.add_argument('--workdir', default=None, help='keep input and output files in this directory')
+    args = parser.parse_args()
+
+    run_benchmarks([int(size) for size in args.sizes.split(',')], args.output, args.services.split(','), args.latency,
+                   args.error_rate, args.unique_fraction, args.concurrency, args.profile, args.workdir)
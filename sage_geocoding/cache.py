@@ -0,0 +1,202 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from metrics import metrics
+from normalize import canonical_address
+
+import sqlite3
+import threading
+import time
+
+# cache schema version, stored as the database's user_version: 1 keyed results by normalized address, 2 by canonical
+# address (see normalize.canonical_address)
+CACHE_VERSION = 2
+
+
+# define GeocodeCache class
+class GeocodeCache:
+
+    # constructor
+    def __init__(self, db_path, ttl=90*24*60*60, negative_ttl=7*24*60*60, max_entries=None):
+        """
+        Persistent SQLite cache of geocoding results keyed by (service, canonical address).
+        :param db_path: path to the SQLite database file
+        :param ttl: seconds a successful result stays valid
+        :param negative_ttl: seconds a failed result (no coordinates) stays valid
+        :param max_entries: maximum number of cached results, oldest results are evicted first (None = no limit)
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+        # hit/miss counters for this session
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+        # open database and create cache table (the connection is shared between geocoding threads)
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS geocode_cache ('
+                          'service TEXT NOT NULL, '
+                          'address TEXT NOT NULL, '
+                          'latitude REAL, '
+                          'longitude REAL, '
+                          'created REAL NOT NULL, '
+                          'confidence REAL, '
+                          'PRIMARY KEY (service, address))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS geocode_cache_created ON geocode_cache (created)')
+
+        # caches created before match confidences were stored get the column (existing results have no confidence)
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(geocode_cache)')]
+        if 'confidence' not in columns:
+            self.conn.execute('ALTER TABLE geocode_cache ADD COLUMN confidence REAL')
+
+        # caches written before addresses were canonicalized get their keys rewritten
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] < CACHE_VERSION:
+            self.migrate_keys()
+            self.conn.execute('PRAGMA user_version = {}'.format(CACHE_VERSION))
+        self.conn.commit()
+
+    ###########
+    # METHODS #
+    ###########
+
+    # look up a cached result
+    def get(self, service, address):
+        """
+        Look up a cached geocoding result.
+        :param service: geocoding service name
+        :param address: address string (canonicalized before lookup)
+        :return: None on a miss, (latitude, longitude, confidence) on a hit, (None, None, None) for a cached failure
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT latitude, longitude, created, confidence FROM geocode_cache WHERE service = ? AND address = ?',
+                                    (service, canonical_address(address))).fetchone()
+
+            # not cached
+            if row is None:
+                self.misses += 1
+                metrics.inc('geocode_cache_total', service=service, result='miss')
+                return None
+
+            latitude, longitude, created, confidence = row
+
+            # expired results count as a miss
+            ttl = self.negative_ttl if latitude is None or longitude is None else self.ttl
+            if ttl is not None and time.time() - created > ttl:
+                self.misses += 1
+                metrics.inc('geocode_cache_total', service=service, result='miss')
+                return None
+
+            if latitude is None or longitude is None:
+                self.negative_hits += 1
+                metrics.inc('geocode_cache_total', service=service, result='negative_hit')
+                return None, None, None
+
+            self.hits += 1
+            metrics.inc('geocode_cache_total', service=service, result='hit')
+            return latitude, longitude, confidence
+
+    # store a result
+    def put(self, service, address, latitude, longitude, confidence=None):
+        """
+        Store a geocoding result. Failed geocodes are stored with null coordinates.
+        :param service: geocoding service name
+        :param address: address string (canonicalized before storing)
+        :param latitude: latitude or None if the geocode failed
+        :param longitude: longitude or None if the geocode failed
+        :param confidence: match confidence between 0 and 1, None if not reported
+        :return: None
+        """
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO geocode_cache (service, address, latitude, longitude, created, confidence) '
+                              'VALUES (?, ?, ?, ?, ?, ?)',
+                              (service, canonical_address(address), latitude, longitude, time.time(), confidence))
+            self.conn.commit()
+
+            # evict oldest entries if the cache is too large
+            if self.max_entries is not None:
+                self.evict(self.max_entries)
+
+        return None
+
+    # rewrite keys of an older cache
+    def migrate_keys(self):
+        """
+        Rewrite normalized address keys as canonical addresses (canonicalizing a normalized address gives the same key
+        as canonicalizing the original). When several old keys share a canonical key the newest result is kept.
+        :return: number of rewritten entries
+        """
+        migrated = 0
+        with self.lock:
+            rows = self.conn.execute('SELECT rowid, service, address, created FROM geocode_cache').fetchall()
+            for rowid, service, address, created in rows:
+                key = canonical_address(address)
+                if key == address:
+                    continue
+
+                # replace an older entry with the key, give way to a newer one
+                self.conn.execute('DELETE FROM geocode_cache WHERE service = ? AND address = ? AND created <= ?',
+                                  (service, key, created))
+                self.conn.execute('UPDATE OR IGNORE geocode_cache SET address = ? WHERE rowid = ?', (key, rowid))
+                self.conn.execute('DELETE FROM geocode_cache WHERE rowid = ? AND address = ?', (rowid, address))
+                migrated += 1
+            self.conn.commit()
+
+        return migrated
+
+    # remove expired entries
+    def purge_expired(self):
+        """
+        Delete expired successful and failed results.
+        :return: number of deleted entries
+        """
+        now = time.time()
+        deleted = 0
+        with self.lock:
+            if self.ttl is not None:
+                deleted += self.conn.execute('DELETE FROM geocode_cache WHERE latitude IS NOT NULL AND created < ?',
+                                             (now - self.ttl,)).rowcount
+            if self.negative_ttl is not None:
+                deleted += self.conn.execute('DELETE FROM geocode_cache WHERE latitude IS NULL AND created < ?',
+                                             (now - self.negative_ttl,)).rowcount
+            self.conn.commit()
+
+        return deleted
+
+    # keep only the newest entries
+    def evict(self, max_entries):
+        """
+        Delete the oldest entries so that at most max_entries remain.
+        :param max_entries: number of entries to keep
+        :return: number of deleted entries
+        """
+        with self.lock:
+            deleted = self.conn.execute('DELETE FROM geocode_cache WHERE rowid NOT IN '
+                                        '(SELECT rowid FROM geocode_cache ORDER BY created DESC LIMIT ?)',
+                                        (max_entries,)).rowcount
+            self.conn.commit()
+
+        return deleted
+
+    # hit/miss counts
+    def stats(self):
+        """
+        Return cache hit/miss counts for this session.
+        :return: dictionary of counts
+        """
+        return {'hits': self.hits, 'negative_hits': self.negative_hits, 'misses': self.misses}
+
+    # close database connection
+    def close(self):
+        """
+        Close the database connection.
+        :return: None
+        """
+        with self.lock:
+            self.conn.close()
+
+        return None
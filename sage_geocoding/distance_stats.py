@@ -0,0 +1,189 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+import numpy as np
+import pandas as pd
+
+# percentiles reported in the statistics table
+PERCENTILES = (50, 90, 95, 99)
+
+
+# column flagging the rows a service was asked to geocode
+def queried_column(col):
+    """
+    Get the name of the distance table column flagging the rows that were sent to a distance column's service (a
+    cascade does not send every address to every service).
+    :param col: distance column
+    :return: column name
+    """
+    return '{} Queried'.format(col)
+
+
+# define QuantileSketch class
+class QuantileSketch:
+
+    # constructor
+    def __init__(self, relative_accuracy=0.005, min_value=1e-3, max_value=1e9):
+        """
+        Mergeable quantile sketch with log-spaced buckets (DDSketch-style). Quantiles of values between min_value and
+        max_value are within about relative_accuracy of the exact value; memory is a fixed array of bucket counts.
+        :param relative_accuracy: maximum relative error of a quantile
+        :param min_value: smallest value with a bucket of its own (smaller values, including zero, share the first bucket)
+        :param max_value: largest value with a bucket of its own (larger values share the last bucket)
+        """
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.min_index = int(np.floor(np.log(min_value) / self.log_gamma))
+        self.max_index = int(np.ceil(np.log(max_value) / self.log_gamma))
+        self.counts = np.zeros(self.max_index - self.min_index + 1, dtype='int64')
+        self.zero_count = 0
+
+    ###########
+    # METHODS #
+    ###########
+
+    # add values
+    def update(self, values):
+        """
+        Add an array of non-negative values to the sketch.
+        :param values: numpy array of values (no NaN)
+        :return: None
+        """
+        positive = values[values > 0]
+        self.zero_count += len(values) - len(positive)
+
+        index = np.ceil(np.log(positive) / self.log_gamma).astype('int64')
+        index = np.clip(index, self.min_index, self.max_index) - self.min_index
+        self.counts += np.bincount(index, minlength=len(self.counts))
+
+        return None
+
+    # estimate a quantile
+    def quantile(self, q):
+        """
+        Estimate the q-th quantile of the values added so far.
+        :param q: quantile between 0 and 1
+        :return: estimated value, NaN if the sketch is empty
+        """
+        total = self.zero_count + self.counts.sum()
+        if total == 0:
+            return np.nan
+
+        rank = q * (total - 1)
+        if rank < self.zero_count:
+            return 0.0
+
+        # bucket containing the rank, value at the middle of the bucket (in relative terms)
+        bucket = int(np.searchsorted(np.cumsum(self.counts), rank - self.zero_count, side='right'))
+        return 2 * self.gamma ** (bucket + self.min_index) / (self.gamma + 1)
+
+    # non-empty buckets
+    def buckets(self):
+        """
+        Return the representative value and count of each non-empty bucket (zeros are returned as a bucket at 0), in
+        increasing order of value. Used to draw histograms and ECDFs without the raw values.
+        :return: numpy array of values, numpy array of counts
+        """
+        nonzero = np.flatnonzero(self.counts)
+        values = 2 * self.gamma ** (nonzero + self.min_index) / (self.gamma + 1)
+        counts = self.counts[nonzero]
+
+        if self.zero_count:
+            values = np.concatenate([[0.0], values])
+            counts = np.concatenate([[self.zero_count], counts])
+
+        return values, counts
+
+
+# define DistanceStatistics class
+class DistanceStatistics:
+
+    # constructor
+    def __init__(self, columns):
+        """
+        Running distance statistics (rows queried, count, percent matched, mean, std dev, max, percentiles) that can be
+        updated one chunk of the distance table at a time, so statistics are available without holding the whole table
+        in memory. Rows a service was not asked to geocode (see queried_column) are left out of its match rate.
+        :param columns: distance table columns to summarize
+        """
+        self.columns = list(columns)
+
+        # total number of rows seen
+        self.rows = 0
+
+        # column: rows sent to the service
+        self.queried = dict.fromkeys(self.columns, 0)
+
+        # column: running count, mean, sum of squared differences from the mean, max, quantile sketch
+        self.count = dict.fromkeys(self.columns, 0)
+        self.mean = dict.fromkeys(self.columns, 0.0)
+        self.m2 = dict.fromkeys(self.columns, 0.0)
+        self.max = dict.fromkeys(self.columns, np.nan)
+        self.sketch = {col: QuantileSketch() for col in self.columns}
+
+    ###########
+    # METHODS #
+    ###########
+
+    # add a chunk of the distance table
+    def update(self, distance_table):
+        """
+        Add the distances in a chunk of the distance table to the running statistics.
+        :param distance_table: pandas df with distance columns (and optional queried columns; without one, every row
+        counts as queried)
+        :return: None
+        """
+        self.rows += len(distance_table)
+
+        for col in self.columns:
+            if queried_column(col) in distance_table.columns:
+                self.queried[col] += int(distance_table[queried_column(col)].to_numpy(dtype=bool).sum())
+            else:
+                self.queried[col] += len(distance_table)
+
+            values = pd.to_numeric(distance_table[col], errors='coerce').to_numpy(dtype='float64')
+            values = values[~np.isnan(values)]
+            if len(values) == 0:
+                continue
+
+            # combine chunk mean/variance with the running values (Welford's algorithm, parallel form for chunks)
+            n_a, n_b = self.count[col], len(values)
+            mean_b = values.mean()
+            m2_b = ((values - mean_b) ** 2).sum()
+            delta = mean_b - self.mean[col]
+            n = n_a + n_b
+
+            self.mean[col] += delta * n_b / n
+            self.m2[col] += m2_b + delta ** 2 * n_a * n_b / n
+            self.count[col] = n
+            self.max[col] = np.fmax(self.max[col], values.max())
+            self.sketch[col].update(values)
+
+        return None
+
+    # statistics table
+    def table(self):
+        """
+        Return the statistics table, one row per distance column.
+        :return: pandas df (comparison, queried, count, percent_match, mean_distance, std_dev, max_distance, p50, p90, p95, p99)
+        """
+        rows = []
+        for col in self.columns:
+            n = self.count[col]
+            queried = self.queried[col]
+            row = {'comparison': col,
+                   'queried': queried,
+                   'count': n,
+                   'percent_match': n / queried * 100 if queried else np.nan,
+                   'mean_distance': self.mean[col] if n else np.nan,
+                   'std_dev': np.sqrt(self.m2[col] / (n - 1)) if n > 1 else np.nan,
+                   'max_distance': self.max[col]}
+            for p in PERCENTILES:
+                row['p{}'.format(p)] = self.sketch[col].quantile(p / 100)
+            rows.append(row)
+
+        columns = ['comparison', 'queried', 'count', 'percent_match', 'mean_distance', 'std_dev', 'max_distance'] + \
+                  ['p{}'.format(p) for p in PERCENTILES]
+
+        return pd.DataFrame(rows, columns=columns)
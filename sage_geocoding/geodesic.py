@@ -0,0 +1,86 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+import numpy as np
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+
+# feet per meter
+FEET_PER_METER = 1 / 0.3048
+
+
+# vectorized geodesic distance
+def geodesic_distance_feet(lat1, lon1, lat2, lon2, tolerance=1e-12, max_iter=200):
+    """
+    Calculate geodesic distances in feet between arrays of WGS84 coordinates (Vincenty's inverse formula, evaluated for
+    all pairs at once). Matches geopy.distance.distance to within 0.01 feet; pairs that do not converge (nearly
+    antipodal points) fall back to geopy. Pairs with a missing coordinate return NaN.
+    :param lat1: array of latitudes of the first points (degrees)
+    :param lon1: array of longitudes of the first points (degrees)
+    :param lat2: array of latitudes of the second points (degrees)
+    :param lon2: array of longitudes of the second points (degrees)
+    :param tolerance: convergence tolerance for lambda (radians)
+    :param max_iter: maximum number of iterations
+    :return: numpy array of distances in feet
+    """
+    lat1 = np.asarray(lat1, dtype='float64')
+    lon1 = np.asarray(lon1, dtype='float64')
+    lat2 = np.asarray(lat2, dtype='float64')
+    lon2 = np.asarray(lon2, dtype='float64')
+
+    # reduced latitudes and longitude difference
+    u1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat1)))
+    u2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat2)))
+    big_l = np.radians(lon2 - lon1)
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    # iterate lambda until it converges for every pair
+    lam = big_l.copy()
+    converged = np.isnan(lam)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cos_u2 * sin_lam) ** 2 + (cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam) ** 2)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+            c = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+            lam_new = big_l + (1 - c) * WGS84_F * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+
+            converged = converged | (np.abs(lam_new - lam) <= tolerance)
+            lam = lam_new
+            if converged.all():
+                break
+
+        # distance on the ellipsoid
+        u_sq = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+            big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        meters = WGS84_B * big_a * (sigma - delta_sigma)
+
+    # coincident points
+    meters = np.where(sin_sigma == 0, 0.0, meters)
+
+    # missing coordinates
+    missing = np.isnan(lat1) | np.isnan(lon1) | np.isnan(lat2) | np.isnan(lon2)
+    meters = np.where(missing, np.nan, meters)
+
+    # fall back to geopy for pairs that did not converge (geopy is imported only when needed)
+    failed = np.flatnonzero(~converged & ~missing)
+    if len(failed):
+        from geopy import distance
+    for i in failed:
+        meters[i] = distance.distance((lat1[i], lon1[i]), (lat2[i], lon2[i])).meters
+
+    return meters * FEET_PER_METER
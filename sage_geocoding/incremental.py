@@ -0,0 +1,171 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from normalize import normalize_series
+
+import csv
+import numpy as np
+import os
+import pandas as pd
+
+
+# read id numbers and coordinates from a results csv
+def read_results_csv(csv_path):
+    """
+    Read the id numbers, names, addresses and coordinates of a csv written by output_geocode_results_csv. The id number
+    is the first field and the coordinates the last two, so they are read correctly whether or not names and addresses
+    containing commas are quoted (files from older versions did not quote fields; the name and address of such rows are
+    None). Malformed lines are skipped.
+    :param csv_path: path to results csv
+    :return: pandas df with id_num, name, address, latitude and longitude columns (NaN coordinates for failed
+    geocodes), empty if the file does not exist
+    """
+    id_num = []
+    name = []
+    address = []
+    latitude = []
+    longitude = []
+    if os.path.exists(csv_path):
+        with open(csv_path, newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for fields in reader:
+                if len(fields) < 6:
+                    continue
+                try:
+                    id_num.append(int(fields[0]))
+                except ValueError:
+                    continue
+                name.append(fields[1] if len(fields) == 6 else None)
+                address.append(fields[2] if len(fields) == 6 else None)
+                latitude.append(float(fields[-2]) if fields[-2] not in ('', 'None') else np.nan)
+                longitude.append(float(fields[-1]) if fields[-1] not in ('', 'None') else np.nan)
+
+    return pd.DataFrame({'id_num': np.array(id_num, dtype='int64'), 'name': np.array(name, dtype=object),
+                         'address': np.array(address, dtype=object), 'latitude': np.array(latitude, dtype='float64'),
+                         'longitude': np.array(longitude, dtype='float64')})
+
+
+# results of the previous run
+def previous_results(csv_out, csv_out2, gc_services):
+    """
+    Read the previous run's results and fails csv files for each service (read them before a new run overwrites them).
+    :param csv_out: results csv path with {} for the service name
+    :param csv_out2: fails csv path with {} for the service name
+    :param gc_services: list of geocoding services
+    :return: dictionary of service: pandas df with id_num, name, address, latitude and longitude (NaN for failed
+    geocodes)
+    """
+    previous = {}
+    for service in gc_services:
+        results = pd.concat([read_results_csv(csv_out.format(service)), read_results_csv(csv_out2.format(service))])
+        previous[service] = results.drop_duplicates('id_num', keep='first').reset_index(drop=True)
+
+    return previous
+
+
+# normalized names or addresses
+def match_keys(values):
+    """
+    Normalize names or addresses the way id numbers are computed (see utility.generate_id_nums); missing values stay None.
+    :param values: sequence of names or addresses
+    :return: numpy array of normalized strings (None where a value is missing)
+    """
+    values = pd.Series(values, dtype=object)
+
+    return normalize_series(values).where(values.notna(), None).to_numpy(dtype=object)
+
+
+# pair new rows with removed rows
+def match_changed_rows(new_name, new_address, old_name, old_address):
+    """
+    Pair rows with new id numbers with removed rows that have the same normalized name or, failing that, the same
+    normalized address. Each removed row is paired at most once.
+    :param new_name: normalized names of the rows with new ids
+    :param new_address: normalized addresses of the rows with new ids
+    :param old_name: normalized names of the removed rows (None if not known)
+    :param old_address: normalized addresses of the removed rows (None if not known)
+    :return: number of pairs (changed rows)
+    """
+    matched_new = np.zeros(len(new_name), dtype=bool)
+    matched_old = np.zeros(len(old_name), dtype=bool)
+    for new_keys, old_keys in ((new_name, old_name), (new_address, old_address)):
+        # removed rows not paired yet, by key
+        waiting = {}
+        for j in np.flatnonzero(~matched_old):
+            if old_keys[j] is not None:
+                waiting.setdefault(old_keys[j], []).append(j)
+
+        # pair each new row with a waiting removed row
+        for i in np.flatnonzero(~matched_new):
+            candidates = waiting.get(new_keys[i])
+            if candidates:
+                matched_old[candidates.pop()] = True
+                matched_new[i] = True
+
+    return int(matched_new.sum())
+
+
+# compare the rows of a new input with the previous run
+def compare_rows(store, previous):
+    """
+    Count rows that are new, changed, removed and unchanged since the previous run. Id numbers are hashes of name and
+    address, so a changed row has a new id; a row with a new id is counted as changed when its name or address matches
+    a row whose id is gone, and only the remaining ids are counted as added and removed.
+    :param store: PointStore created from the new input
+    :param previous: previous results (see previous_results)
+    :return: dictionary with 'added', 'changed', 'removed' and 'unchanged' counts
+    """
+    # previous ids with their names and addresses
+    tables = list(previous.values())
+    table = pd.concat(tables).drop_duplicates('id_num') if tables else pd.DataFrame({'id_num': np.empty(0, dtype='int64')})
+    previous_ids = table['id_num'].to_numpy()
+    unchanged = np.isin(store.id_num, previous_ids)
+    removed = ~np.isin(previous_ids, store.id_num)
+
+    # rows with new ids that replace a removed row
+    changed = 0
+    if removed.any() and not unchanged.all():
+        new_rows = np.flatnonzero(~unchanged)
+        old_name = match_keys(table['name'].to_numpy()[removed]) if 'name' in table else np.full(removed.sum(), None)
+        old_address = match_keys(table['address'].to_numpy()[removed]) if 'address' in table else np.full(removed.sum(), None)
+        changed = match_changed_rows(match_keys(store.name[new_rows]), match_keys(store.address[new_rows]), old_name, old_address)
+
+    return {'added': int((~unchanged).sum()) - changed,
+            'changed': changed,
+            'removed': int(removed.sum()) - changed,
+            'unchanged': int(unchanged.sum())}
+
+
+# restore the previous run's results into a point store
+def restore_previous_results(store, previous, restore_failed=False):
+    """
+    Set coordinates in the point store for every row with a result from the previous run, matched by id number. New and
+    changed rows stay pending, so only they are geocoded; rows removed from the input are not in the store and are
+    dropped from the outputs.
+    :param store: PointStore created from the new input
+    :param previous: previous results (see previous_results; a confidence column, e.g. from
+    ResultsStore.previous_results, is restored too)
+    :param restore_failed: also restore failed geocodes (by default they are geocoded again; permanent failures are
+    answered by the geocode cache without a request)
+    :return: number of restored outcomes
+    """
+    restored = 0
+    for service, results in previous.items():
+        store.add_service(service)
+        if not restore_failed:
+            results = results.dropna(subset=['latitude', 'longitude'])
+
+        # rows of the store with a previous result
+        position = pd.Index(results['id_num']).get_indexer(store.id_num)
+        rows = np.flatnonzero(position >= 0)
+        if len(rows) == 0:
+            continue
+        latitude = results['latitude'].to_numpy()[position[rows]]
+        longitude = results['longitude'].to_numpy()[position[rows]]
+        confidence = results['confidence'].to_numpy()[position[rows]] if 'confidence' in results else None
+        store.set_coordinates(service, latitude, longitude, rows=rows, confidence=confidence)
+        restored += len(rows)
+
+    return restored
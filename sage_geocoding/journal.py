@@ -0,0 +1,149 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+import numpy as np
+import os
+import threading
+
+
+# define GeocodeJournal class
+class GeocodeJournal:
+
+    # constructor
+    def __init__(self, journal_path, resume=False):
+        """
+        Append-only journal of geocoding outcomes, one line per (service, id_num) written as soon as the result arrives,
+        so an interrupted run can be resumed without geocoding finished rows again.
+        :param journal_path: path to the journal file
+        :param resume: keep existing journal entries (False starts a new, empty journal)
+        """
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+
+        # service: {id_num: (latitude, longitude, confidence)}, loaded on first restore
+        self.entries = None
+
+        # a line cut off by a crash is removed, so new records do not continue it
+        if resume:
+            self.truncate_partial_line()
+        self.file = open(journal_path, 'a' if resume else 'w')
+
+    ###########
+    # METHODS #
+    ###########
+
+    # remove an incomplete last line
+    def truncate_partial_line(self):
+        """
+        Cut the journal file after its last complete line (a line without a newline was being written when the run
+        stopped).
+        :return: number of removed bytes
+        """
+        if not os.path.exists(self.journal_path):
+            return 0
+
+        with open(self.journal_path, 'rb+') as f:
+            # search backwards for the last newline, one block at a time
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(0, end - 4096)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            f.truncate(end)
+
+        return size - end
+
+    # record a geocoding outcome
+    def record(self, service, id_num, latitude, longitude, confidence=None):
+        """
+        Append an outcome to the journal and flush it to disk.
+        :param service: geocoding service name
+        :param id_num: id number of the row
+        :param latitude: latitude or None if the geocode failed
+        :param longitude: longitude or None if the geocode failed
+        :param confidence: match confidence or None if not reported
+        :return: None
+        """
+        latitude = '' if latitude is None or np.isnan(latitude) else repr(float(latitude))
+        longitude = '' if longitude is None or np.isnan(longitude) else repr(float(longitude))
+        confidence = '' if confidence is None or np.isnan(confidence) else repr(float(confidence))
+
+        with self.lock:
+            self.file.write('{},{},{},{},{}\n'.format(service, int(id_num), latitude, longitude, confidence))
+            self.file.flush()
+
+        return None
+
+    # read journal file
+    def load(self):
+        """
+        Read every complete line of the journal (a line cut off by a crash is skipped; lines written before confidences
+        were journaled have no confidence).
+        :return: dictionary of service: {id_num: (latitude, longitude, confidence)}, NaN for failed geocodes and
+        missing confidences
+        """
+        entries = {}
+        if not os.path.exists(self.journal_path):
+            return entries
+
+        with open(self.journal_path) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    continue
+                fields = line.rstrip('\n').split(',')
+                if len(fields) == 4:
+                    fields.append('')
+                if len(fields) != 5:
+                    continue
+                service, id_num, latitude, longitude, confidence = fields
+                entries.setdefault(service, {})[int(id_num)] = (float(latitude) if latitude else np.nan,
+                                                                  float(longitude) if longitude else np.nan,
+                                                                  float(confidence) if confidence else np.nan)
+
+        return entries
+
+    # restore journaled outcomes into a point store
+    def restore(self, store, gc_services):
+        """
+        Set coordinates in the point store for every row with a journaled outcome; other rows stay pending.
+        :param store: PointStore
+        :param gc_services: list of geocoding services
+        :return: number of restored outcomes
+        """
+        if self.entries is None:
+            with self.lock:
+                self.file.flush()
+            self.entries = self.load()
+
+        restored = 0
+        for service in gc_services:
+            store.add_service(service)
+            outcomes = self.entries.get(service, {})
+            if not outcomes:
+                continue
+
+            # rows of the store with a journaled outcome
+            rows = [i for i, id_num in enumerate(store.id_num) if int(id_num) in outcomes]
+            if rows:
+                coords = np.array([outcomes[int(store.id_num[i])] for i in rows], dtype='float64')
+                store.set_coordinates(service, coords[:, 0], coords[:, 1], rows=rows, confidence=coords[:, 2])
+                restored += len(rows)
+
+        return restored
+
+    # close journal file
+    def close(self):
+        """
+        Close the journal file.
+        :return: None
+        """
+        with self.lock:
+            self.file.close()
+
+        return None
@@ -0,0 +1,176 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from normalize import canonical_address, canonical_series
+
+import numpy as np
+import pandas as pd
+
+# minimum match score (weighted share of tokens shared by the address and the reference address point)
+MIN_SCORE = 0.6
+
+# directional abbreviations skipped when looking for the street name after the house number
+DIRECTIONALS = ('N', 'S', 'E', 'W', 'NE', 'NW', 'SE', 'SW')
+
+
+# define AddressPointIndex class
+class AddressPointIndex:
+
+    # constructor
+    def __init__(self, address, latitude, longitude):
+        """
+        Inverted index over the canonical street tokens of a reference list of address points (e.g. county address
+        points or OpenAddresses). Each token maps to the sorted rows of the reference addresses that contain it, stored
+        as one postings array with an offset per token. Tokens are weighted by inverse document frequency, so house
+        numbers and street names count for more than suffixes such as ST or AVE.
+        :param address: sequence of reference address strings
+        :param latitude: sequence of reference latitudes
+        :param longitude: sequence of reference longitudes
+        """
+        self.address = np.asarray(address, dtype=str)
+        self.latitude = np.asarray(latitude, dtype='float64')
+        self.longitude = np.asarray(longitude, dtype='float64')
+
+        # one (row, token) pair per distinct token of each canonical address, in row order
+        tokens = canonical_series(pd.Series(self.address)).str.split(' ').explode()
+        pairs = pd.DataFrame({'row': tokens.index.to_numpy(), 'token': tokens.to_numpy()}).drop_duplicates()
+        pairs = pairs[pairs['token'] != '']
+        codes, vocabulary = pd.factorize(pairs['token'])
+        rows = pairs['row'].to_numpy()
+
+        # postings: rows grouped by token (a stable sort keeps each token's rows sorted)
+        order = np.argsort(codes, kind='stable')
+        self.postings = rows[order].astype('int64')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(vocabulary)))])
+        self.vocabulary = {token: code for code, token in enumerate(vocabulary)}
+
+        # token weights and the total weight of each reference address
+        self.weights = np.log((len(self.address) + 1) / (np.diff(self.offsets) + 0.5))
+        self.row_weights = np.bincount(rows, weights=self.weights[codes], minlength=len(self.address))
+
+    ###########
+    # METHODS #
+    ###########
+
+    # number of reference address points
+    def __len__(self):
+        return len(self.address)
+
+    # create the index from a reference csv file
+    @classmethod
+    def from_csv(cls, csv_path, address_col='Address', lat_col='Latitude', lon_col='Longitude'):
+        """
+        Create the index from a csv file of address points (rows without coordinates are skipped).
+        :param csv_path: path to reference csv
+        :param address_col: address field, or a list of fields joined with spaces (e.g. number, street, city, zip)
+        :param lat_col: latitude field
+        :param lon_col: longitude field
+        :return: AddressPointIndex
+        """
+        address_cols = [address_col] if isinstance(address_col, str) else list(address_col)
+        table = pd.read_csv(csv_path, usecols=address_cols + [lat_col, lon_col], dtype={col: str for col in address_cols})
+        table[lat_col] = pd.to_numeric(table[lat_col], errors='coerce')
+        table[lon_col] = pd.to_numeric(table[lon_col], errors='coerce')
+        table = table.dropna(subset=[lat_col, lon_col])
+        address = table[address_cols[0]].fillna('')
+        for col in address_cols[1:]:
+            address = address + ' ' + table[col].fillna('')
+
+        return cls(address.to_numpy(), table[lat_col].to_numpy(), table[lon_col].to_numpy())
+
+    # save the reference points
+    def save(self, path):
+        """
+        Save the reference address points as a compressed numpy file, which loads faster than the csv.
+        :param path: path to save .npz file
+        :return: None
+        """
+        np.savez_compressed(path, address=self.address, latitude=self.latitude, longitude=self.longitude)
+
+        return None
+
+    # load saved reference points
+    @classmethod
+    def load(cls, path):
+        """
+        Create the index from reference address points saved with save().
+        :param path: path to .npz file
+        :return: AddressPointIndex
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['address'], data['latitude'], data['longitude'])
+
+    # rows containing a token
+    def rows(self, code):
+        """
+        Return the sorted rows of the reference addresses containing a token.
+        :param code: token code
+        :return: numpy array of rows
+        """
+        return self.postings[self.offsets[code]:self.offsets[code + 1]]
+
+    # which rows contain a token
+    def contains(self, code, rows):
+        """
+        Check which of the given rows contain a token (binary search in the token's postings).
+        :param code: token code
+        :param rows: numpy array of rows
+        :return: boolean numpy array
+        """
+        postings = self.rows(code)
+        position = np.minimum(np.searchsorted(postings, rows), len(postings) - 1)
+
+        return postings[position] == rows
+
+    # best reference address point for an address
+    def match(self, address, min_score=MIN_SCORE):
+        """
+        Find the reference address point that best matches an address. Candidates must have the address's house number
+        and the first word of its street name; each is scored by the weight of the shared tokens relative to the weight
+        of both addresses (tokens missing from the reference list, such as a state, are ignored). Addresses without a
+        house number are not matched.
+        :param address: address string
+        :param min_score: minimum match score between 0 and 1
+        :return: row of the best match, match score; row is None if nothing scores at least min_score
+        """
+        tokens = canonical_address(address).split()
+        codes = list(dict.fromkeys(self.vocabulary[token] for token in tokens if token in self.vocabulary))
+
+        # house number and street name (first word after the number that is not a directional)
+        if not tokens or not tokens[0].isdigit():
+            return None, 0.0
+        street = next((token for token in tokens[1:] if token not in DIRECTIONALS), None)
+        if tokens[0] not in self.vocabulary or street not in self.vocabulary:
+            return None, 0.0
+        candidates = self.rows(self.vocabulary[tokens[0]])
+        candidates = candidates[self.contains(self.vocabulary[street], candidates)]
+        if len(candidates) == 0:
+            return None, 0.0
+
+        # weight of the tokens each candidate shares with the address
+        shared = np.zeros(len(candidates))
+        for code in codes:
+            shared += np.where(self.contains(code, candidates), self.weights[code], 0.0)
+
+        # dice score over token weights
+        scores = 2 * shared / (self.weights[codes].sum() + self.row_weights[candidates])
+        best = int(np.argmax(scores))
+        if scores[best] < min_score:
+            return None, float(scores[best])
+
+        return int(candidates[best]), float(scores[best])
+
+    # coordinates of an address
+    def geocode(self, address, min_score=MIN_SCORE):
+        """
+        Return the coordinates of the reference address point that best matches an address.
+        :param address: address string
+        :param min_score: minimum match score between 0 and 1
+        :return: latitude, longitude, match score
+        """
+        row, score = self.match(address, min_score)
+        if row is None:
+            raise LookupError('No reference address point matches {} (best score {:.2f})'.format(address, score))
+
+        return self.latitude[row], self.longitude[row], score
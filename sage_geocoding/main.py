@@ -2,105 +2,670 @@
 # Jessica Embury
 
 # import statements
+import argparse
 import os
-import pandas as pd
-
-from utility import create_address_table, \
-    create_points_known_coords, \
-    geocode_address_table, \
-    output_geocode_results_shp, \
-    output_geocode_results_csv, \
-    create_distance_table, \
-    calc_distance_statistics, \
-    plot_result_distances, \
-    map_geocoding_results, \
-    create_bubble_map
+import sys
 
-# create output directories
-output_path = './output/central'
-if not os.path.exists(output_path):
-    os.makedirs(output_path)
-
-shp_path = './output/central/shapefiles'
-if not os.path.exists(shp_path):
-    os.makedirs(shp_path)
+# each command imports the modules it needs when it runs (pandas, the geocoding engines, scipy, GDAL/OGR, matplotlib
+# and folium take seconds to load), so short jobs and stage worker processes start quickly
 
+# subcommands; running main.py without a subcommand runs the whole pipeline
+COMMANDS = ('run', 'geocode', 'distances', 'stats', 'plot', 'maps', 'export')
 
-########
-# MAIN #
-########
+# marker color and icon of the known points on result maps (geocoded points use their service's style, see
+# utility.service_style)
+KNOWN_SYMBOL = ('darkpurple', 'star')
 
-def main():
 
-    # csv file with addresses
-    csv_in = './data/central_database.csv'
+# output file paths
+def output_paths(args):
+    """
+    Get the output file paths in the output directory.
+    :param args: parsed command line arguments
+    :return: dictionary of output name: path ({} in a path is replaced with a service or map name)
+    """
+    out = args.output_dir
 
-    # base file paths for output
-    csv_out = './output/central/{}_results.csv'
-    csv_out2 = './output/central/{}_fails.csv'
-    shp_out = './output/central/shapefiles/{}_points.shp'
+    return {'results_dir': os.path.join(out, 'results'),
+            'csv_out': os.path.join(out, '{}_results.csv'),
+            'csv_out2': os.path.join(out, '{}_fails.csv'),
+            'shp_out': os.path.join(out, 'shapefiles', '{}_points' + args.vector_format),
+            'dist_out': os.path.join(out, 'distance_table.csv'),
+            'stats_out': os.path.join(out, 'distance_statistics.csv'),
+            'plot_out': os.path.join(out, args.plot_name),
+            'map_out': os.path.join(out, '{}_map.html'),
+            'cache_path': os.path.join(out, 'geocode_cache.sqlite'),
+            'journal_path': os.path.join(out, 'geocode_journal.csv'),
+            'stage_state': os.path.join(out, 'stage_state.json'),
+            'metrics_out': os.path.join(out, 'metrics.json'),
+            'metrics_prom': os.path.join(out, 'metrics.prom')}
 
-    # distance table out
-    dist_out = './output/central/distance_table.csv'
 
-    # stats table out
-    stats_out = './output/central/distance_statistics.csv'
+# create output directories
+def create_output_dirs(args):
+    """
+    Create the output directory and its shapefile directory.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    os.makedirs(os.path.join(args.output_dir, 'shapefiles'), exist_ok=True)
 
-    # box plot out
-    plot_out = './output/central/boxplot_7k.png'
-    plot_out2 = './output/central/boxplot_100k.png'
+    return None
 
-    # maps out
-    map_out = './output/central/{}_map.html'
 
-    # available geocoding services
-    gc_services = ['nominatim', 'google', 'arcgis', 'bing']
+# address table and point store with known coordinates
+def load_address_table(args):
+    """
+    Read the input csv, add id numbers and create the point store with the known coordinates.
+    :param args: parsed command line arguments
+    :return: address table, PointStore
+    """
+    from metrics import metrics
+    from utility import create_address_table, create_points_known_coords
 
     # create the address table with unique id numbers for each address (id will stay same for all geocoders)
-    addr = create_address_table(csv_in)
+    with metrics.stage('create_address_table'):
+        addr = create_address_table(args.input, args.name_col, args.address_col)
+
+    # create point store with known coordinates
+    with metrics.stage('create_points_known_coords'):
+        store = create_points_known_coords(addr, args.name_col, args.address_col, args.lat_col, args.lon_col)
+
+    return addr, store
 
-    # create known Point objects
-    addr, known_pts = create_points_known_coords(addr, 'Name ', 'Address', 'Latitude', 'Longitude')
 
-    # output known Point objects
-    output_geocode_results_csv(known_pts, csv_out.format('known'))
-    output_geocode_results_shp(known_pts, shp_out.format('known'))
+# export results as csv and vector files
+def export_results(store, services, paths):
+    """
+    Write the known points and each service's results and fails as csv files, and the known points and results as
+    vector files. These are exports; the pipeline steps read the results store.
+    :param store: PointStore with known and geocoded coordinates
+    :param services: list of services with results
+    :param paths: output paths (see output_paths)
+    :return: None
+    """
+    from point_store import STATUS_FAILED
+    from utility import output_geocode_results_csv, output_geocode_results_vector
 
-    # geocode list using each service and output results
-    for service in gc_services:
-        addr, point_list, fails_list = geocode_address_table(addr, 'Name ', 'Address', service)
+    # output known points
+    output_geocode_results_csv(store, 'known', paths['csv_out'].format('known'))
+    output_geocode_results_vector(store, 'known', paths['shp_out'].format('known'))
 
+    for service in services:
         # output geocoding results (and fails) as csv files
-        output_geocode_results_csv(point_list, csv_out.format(service))
-        output_geocode_results_csv(fails_list, csv_out2.format(service))
+        output_geocode_results_csv(store, service, paths['csv_out'].format(service))
+        output_geocode_results_csv(store, service, paths['csv_out2'].format(service), status=STATUS_FAILED)
+
+        # output geocoding results as vector files
+        output_geocode_results_vector(store, service, paths['shp_out'].format(service))
+
+    return None
+
+
+# start collecting metrics
+def start_metrics(args):
+    """
+    Enable metrics collection if requested.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    if args.metrics:
+        from metrics import enable_metrics
+        enable_metrics()
+
+    return None
+
+
+# save collected metrics
+def save_metrics(args):
+    """
+    Save stage timings and request metrics as JSON and Prometheus text if requested.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    if args.metrics:
+        from metrics import JsonExporter, PrometheusExporter, metrics
+        paths = output_paths(args)
+        metrics.export(JsonExporter(paths['metrics_out']), PrometheusExporter(paths['metrics_prom']))
+
+    return None
+
+
+# results of the previous run
+def load_previous_results(args, services):
+    """
+    Read the results of the previous run for an incremental run, from the results store (or, for output directories
+    written before there was a results store, from the results and fails csv files).
+    :param args: parsed command line arguments
+    :param services: list of services with results
+    :return: dictionary of service: pandas df (see incremental.previous_results)
+    """
+    from incremental import previous_results
+    from results_store import ResultsStore
+
+    paths = output_paths(args)
+    results = ResultsStore(paths['results_dir'])
+    if results.exists():
+        return results.previous_results(services)
+
+    return previous_results(paths['csv_out'], paths['csv_out2'], services)
+
+
+# geocode the input and write results for each service
+def geocode_table(args):
+    """
+    Geocode the input with each service, write the points to the results store and export them as csv files and vector
+    files.
+    :param args: parsed command line arguments
+    :return: address table, PointStore with known and geocoded coordinates
+    """
+    from cache import GeocodeCache
+    from incremental import compare_rows, restore_previous_results
+    from journal import GeocodeJournal
+    from metrics import metrics
+    from providers import configure_provider
+    from results_store import ResultsStore
+    from utility import geocode_services, result_services
+
+    paths = output_paths(args)
+    configure_provider('local', reference_path=args.local_reference)
+
+    # results of the previous run, read before they are overwritten
+    services = result_services(args.services, args.mode)
+    previous = load_previous_results(args, services) if args.incremental else None
+
+    addr, store = load_address_table(args)
+
+    # incremental run: restore results of unchanged rows, new and changed rows stay pending
+    if previous is not None:
+        changes = compare_rows(store, previous)
+        restore_previous_results(store, previous)
+        print('Incremental run: {added} new rows, {changed} changed rows, {removed} removed rows, {unchanged} unchanged '
+              'rows'.format(**changes))
+
+    # open geocode cache (results are reused between runs) and journal (outcomes are written as they arrive)
+    cache = GeocodeCache(paths['cache_path'])
+    journal = GeocodeJournal(paths['journal_path'], resume=args.resume)
+
+    # geocode list using each service
+    with metrics.stage('geocode_services'):
+        store = geocode_services(store, args.services, args.mode, cache, args.batch_size, journal, args.min_confidence,
+                                 args.agree_feet)
+    journal.close()
+
+    # write known and geocoded points to the results store, read by the later steps
+    with metrics.stage('write_results_store'):
+        ResultsStore(paths['results_dir']).write_points(store, ['known'] + services)
 
-        # output geocoding results as shapefiles
-        output_geocode_results_shp(point_list, shp_out.format(service))
+    # export results as csv files and vector files
+    if not args.no_export:
+        with metrics.stage('output_geocode_results'):
+            export_results(store, services, paths)
 
-    # create distance table
-    dist = create_distance_table(addr, dist_out)
+    # report cache hits/misses and close cache
+    print('Geocode cache: {}'.format(cache.stats()))
+    cache.close()
 
-    # dist = pd.read_csv('./output/central/distance_table.csv')
+    return addr, store
+
+
+##########
+# STAGES #
+##########
+
+# each stage reads the columns it needs from the results store (the memory mapped points and distances files), so
+# stages pass no data through csv files or pickles and run in worker processes without copying the point store
+
+# distance table stage
+def distance_table_stage(address_table, results_dir, dist_out, k=1, radius_feet=None):
+    """
+    Create the distance table from the points in the results store, export it as csv and write its distance columns to
+    the results store.
+    :param address_table: address table of the input (same rows as the results store)
+    :param results_dir: results store directory
+    :param dist_out: path to save distance table as CSV
+    :param k: number of nearest known sites added for each geocoded point (0 for none)
+    :param radius_feet: optional radius for counting known sites nearby
+    :return: None
+    """
+    import numpy as np
+    from results_store import ResultsStore
+    from spatial_index import KnownSiteIndex
+    from utility import create_distance_table
+
+    results = ResultsStore(results_dir)
+    store = results.read_points(text=False)
+    if not np.array_equal(store.id_num, address_table['id_num'].to_numpy()):
+        raise ValueError('Results store {} does not match the input; run the geocode command first'.format(results_dir))
+
+    # create distance table, with the nearest known sites of each geocoded point
+    site_index = KnownSiteIndex.from_store(store) if k else None
+    dist = create_distance_table(address_table, store, dist_out, site_index=site_index, k=k, radius_feet=radius_feet)
+    results.write_distances(dist[['id_num'] + [col for col in dist.columns if col not in address_table.columns]])
+
+    return None
+
+
+# statistics stage
+def statistics_stage(results_dir, stats_out):
+    """
+    Calculate distance statistics from the distance and queried columns of the results store.
+    :param results_dir: results store directory
+    :param stats_out: path to save statistics table as CSV
+    :return: statistics table
+    """
+    from distance_stats import queried_column
+    from results_store import DISTANCES_FILE, ResultsStore
+    from utility import calc_distance_statistics, stored_distance_columns
+
+    results = ResultsStore(results_dir)
+    stored = results.columns(DISTANCES_FILE)
+    columns = stored_distance_columns(stored)
+    queried = [queried_column(col) for col in columns if queried_column(col) in stored]
+
+    return calc_distance_statistics(results.read_distances(columns + queried), stats_out, columns)
+
+
+# plot stage
+def plot_stage(results_dir, plot_out, mode='box'):
+    """
+    Plot the distance columns of the results store.
+    :param results_dir: results store directory
+    :param plot_out: path to save plot
+    :param mode: 'box' or 'summary' (see plot_result_distances)
+    :return: None
+    """
+    from results_store import DISTANCES_FILE, ResultsStore
+    from utility import plot_result_distances, stored_distance_columns
+
+    results = ResultsStore(results_dir)
+    columns = stored_distance_columns(results.columns(DISTANCES_FILE))
+
+    return plot_result_distances(results.read_distances(['id_num'] + columns), plot_out, mode)
+
+
+# result map stage
+def map_stage(results_dir, map_out, colors, icons, service):
+    """
+    Draw a map of a service's results against the known coordinates from the results store.
+    :param results_dir: results store directory
+    :param map_out: path to save map html file
+    :param colors: marker colors for the service and known points
+    :param icons: marker icons for the service and known points
+    :param service: geocoding service name
+    :return: None
+    """
+    from results_store import ResultsStore
+    from utility import map_geocoding_results
+
+    store = ResultsStore(results_dir).read_points([service, 'known'])
+
+    return map_geocoding_results(map_out, colors, icons, store, service, 'known')
+
+
+# bubble map stage
+def bubble_map_stage(results_dir, parameter, color, map_out):
+    """
+    Draw a bubble map of the known points sized by the distance to the geocoded results, from the results store.
+    :param results_dir: results store directory
+    :param parameter: distance column, or a list of distance columns (see create_bubble_map)
+    :param color: point color, or a list of colors
+    :param map_out: path to save map html file
+    :return: None
+    """
+    import numpy as np
+    from results_store import ResultsStore
+    from utility import create_bubble_map
+
+    results = ResultsStore(results_dir)
+    store = results.read_points(['known'])
+    dist = results.read_distances(['id_num'] + ([parameter] if isinstance(parameter, str) else list(parameter)))
+    if not np.array_equal(store.id_num, dist['id_num'].to_numpy()):
+        raise ValueError('Distances in results store {} are out of date; run the distances command first'.format(results_dir))
+
+    return create_bubble_map(store, dist, parameter, color, map_out)
+
+
+# map stages
+def map_stages(results_dir, services, map_out):
+    """
+    Create the stages drawing a map of each service's results against the known coordinates and the bubble maps sized
+    by the distance from the known coordinates.
+    :param results_dir: results store directory
+    :param services: list of services with results
+    :param map_out: map path with {} for the map name
+    :return: list of Stage objects
+    """
+    from results_store import DISTANCES_FILE, POINTS_FILE
+    from scheduler import Stage
+    from utility import service_style
+
+    points_file = os.path.join(results_dir, POINTS_FILE)
+    distances_file = os.path.join(results_dir, DISTANCES_FILE)
+    stages = []
+
+    # create maps comparing known coordinates versus geocoded results
+    styles = {service: service_style(service) for service in services}
+    for service in services:
+        _, color, icon = styles[service]
+        colors, icons = [color, KNOWN_SYMBOL[0]], [icon, KNOWN_SYMBOL[1]]
+        stages.append(Stage('map_{}'.format(service), map_stage, (results_dir, map_out.format(service), colors, icons, service),
+                            inputs=[points_file], outputs=[map_out.format(service)]))
+
+    # graduated point size using distance from known coord to geocoded coord
+    bubble_maps = [(styles[service][0], styles[service][1], '{}_bubble'.format(service)) for service in services]
+    # all geocoders as bubble layers on one map
+    bubble_maps.append(([styles[service][0] for service in services], [styles[service][1] for service in services],
+                        'all_bubble'))
+    for parameter, color, name in bubble_maps:
+        stages.append(Stage(name, bubble_map_stage, (results_dir, parameter, color, map_out.format(name)),
+                            inputs=[points_file, distances_file], outputs=[map_out.format(name)]))
+
+    return stages
+
+
+############
+# COMMANDS #
+############
+
+# geocode command
+def geocode_command(args):
+    """
+    Geocode the input with each service, write the results store and export the results as csv files and vector files.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    create_output_dirs(args)
+    start_metrics(args)
+    geocode_table(args)
+    save_metrics(args)
+
+    return None
+
+
+# distances command
+def distances_command(args):
+    """
+    Create the distance table from the results store written by the geocode command.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    from metrics import metrics
+    from utility import create_address_table
+
+    create_output_dirs(args)
+    start_metrics(args)
+    paths = output_paths(args)
+    addr = create_address_table(args.input, args.name_col, args.address_col)
+    with metrics.stage('create_distance_table'):
+        distance_table_stage(addr, paths['results_dir'], paths['dist_out'], args.nearest_k, args.site_radius_feet)
+    save_metrics(args)
+
+    return None
+
+
+# stats command
+def stats_command(args):
+    """
+    Calculate distance statistics from the results store.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    from metrics import metrics
+
+    create_output_dirs(args)
+    start_metrics(args)
+    paths = output_paths(args)
+    with metrics.stage('calc_distance_statistics'):
+        print(statistics_stage(paths['results_dir'], paths['stats_out']))
+    save_metrics(args)
+
+    return None
+
+
+# plot command
+def plot_command(args):
+    """
+    Plot the distances in the results store.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    from metrics import metrics
+
+    create_output_dirs(args)
+    start_metrics(args)
+    paths = output_paths(args)
+    with metrics.stage('plot_result_distances'):
+        plot_stage(paths['results_dir'], paths['plot_out'], args.plot_mode)
+    save_metrics(args)
+
+    return None
+
+
+# maps command
+def maps_command(args):
+    """
+    Draw the result maps and bubble maps from the results store.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    from metrics import metrics
+    from scheduler import run_stages
+    from utility import result_services
+
+    create_output_dirs(args)
+    start_metrics(args)
+    paths = output_paths(args)
+    with metrics.stage('maps'):
+        run_stages(map_stages(paths['results_dir'], result_services(args.services, args.mode), paths['map_out']),
+                   workers=args.stage_workers)
+    save_metrics(args)
+
+    return None
+
+
+# export command
+def export_command(args):
+    """
+    Export the results store as csv files and vector files.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    from metrics import metrics
+    from results_store import ResultsStore
+    from utility import result_services
+
+    create_output_dirs(args)
+    start_metrics(args)
+    paths = output_paths(args)
+    services = result_services(args.services, args.mode)
+    store = ResultsStore(paths['results_dir']).read_points(['known'] + services)
+    with metrics.stage('output_geocode_results'):
+        export_results(store, services, paths)
+    save_metrics(args)
+
+    return None
+
+
+# run command: the whole pipeline
+def run_command(args):
+    """
+    Run the geocoding comparison pipeline: geocode, then create the distance table, statistics, box plot and maps.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    from metrics import metrics
+    from results_store import DISTANCES_FILE, POINTS_FILE
+    from scheduler import Stage, run_stages
+    from utility import result_services
+
+    create_output_dirs(args)
+    start_metrics(args)
+    paths = output_paths(args)
+
+    # streaming mode: process the input file in chunks so memory use stays bounded (writes the results store, csv
+    # files, vector files, distance table and statistics; maps and box plots are not created)
+    if args.streaming:
+        from cache import GeocodeCache
+        from journal import GeocodeJournal
+        from providers import configure_provider
+        from streaming import check_streaming_vector_format, run_streaming_pipeline
+
+        # reject outputs that cannot be written chunk by chunk before anything is geocoded
+        check_streaming_vector_format(paths['shp_out'])
+        configure_provider('local', reference_path=args.local_reference)
+        previous = None
+        if args.incremental:
+            previous = load_previous_results(args, result_services(args.services, args.mode))
+        cache = GeocodeCache(paths['cache_path'])
+        journal = GeocodeJournal(paths['journal_path'], resume=args.resume)
+        with metrics.stage('streaming_pipeline'):
+            run_streaming_pipeline(args.input, args.services, paths['csv_out'], paths['csv_out2'], paths['shp_out'],
+                                   paths['dist_out'], paths['stats_out'], args.name_col, args.address_col, args.lat_col,
+                                   args.lon_col, chunk_size=args.chunk_size, geocode_mode=args.mode, cache=cache,
+                                   batch_size=args.batch_size, journal=journal, nearest_k=args.nearest_k,
+                                   site_radius_feet=args.site_radius_feet, previous=previous,
+                                   min_confidence=args.min_confidence, agree_feet=args.agree_feet,
+                                   results_dir=paths['results_dir'])
+        print('Geocode cache: {}'.format(cache.stats()))
+        journal.close()
+        cache.close()
+        save_metrics(args)
+        return None
+
+    addr, store = geocode_table(args)
+
+    # post-geocoding stages: each stage reads the results store files it declares as inputs and writes its output
+    # files; independent stages run at the same time on a process pool and stages whose inputs have not changed since
+    # the last run are skipped
+    points_file = os.path.join(paths['results_dir'], POINTS_FILE)
+    distances_file = os.path.join(paths['results_dir'], DISTANCES_FILE)
+    stages = []
+
+    # create distance table, with the nearest known sites of each geocoded point
+    stages.append(Stage('create_distance_table', distance_table_stage,
+                        (addr, paths['results_dir'], paths['dist_out'], args.nearest_k, args.site_radius_feet),
+                        inputs=[points_file], outputs=[paths['dist_out'], distances_file]))
 
     # calculate distance statistics
-    calc_distance_statistics(dist, stats_out)
+    stages.append(Stage('calc_distance_statistics', statistics_stage, (paths['results_dir'], paths['stats_out']),
+                        inputs=[distances_file], outputs=[paths['stats_out']]))
 
     # create box plot
-    plot_result_distances(dist, plot_out)
+    stages.append(Stage('plot_result_distances', plot_stage, (paths['results_dir'], paths['plot_out'], args.plot_mode),
+                        inputs=[distances_file], outputs=[paths['plot_out']]))
 
-    # create maps comparing known coordinates versus geocoded results: nom, goog, arc, bing
-    map_geocoding_results(map_out.format(gc_services[0]), ['orange', 'darkpurple'], ['cloud', 'star'], shp_out.format(gc_services[0]), shp_out.format('known'))
-    map_geocoding_results(map_out.format(gc_services[1]), ['green', 'darkpurple'], ['flash', 'star'], shp_out.format(gc_services[0]), shp_out.format('known'))
-    map_geocoding_results(map_out.format(gc_services[2]), ['red', 'darkpurple'], ['globe', 'star'], shp_out.format(gc_services[1]), shp_out.format('known'))
-    map_geocoding_results(map_out.format(gc_services[3]), ['blue', 'darkpurple'], ['paperclip', 'star'], shp_out.format(gc_services[2]), shp_out.format('known'))
-    
+    # create maps comparing known coordinates versus geocoded results, and bubble maps
+    stages.extend(map_stages(paths['results_dir'], result_services(args.services, args.mode), paths['map_out']))
+
+    # run stages
+    with metrics.stage('output_stages'):
+        run_stages(stages, paths['stage_state'], args.stage_workers)
+
+    save_metrics(args)
+
+    return None
+
+
+########
+# MAIN #
+########
+
+# command line parser
+def create_parser():
+    """
+    Create the command line parser with a subcommand for each pipeline step.
+    :return: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description='Geocode dry cleaner sites and compare results with known coordinates. '
+                                                 'Without a subcommand the whole pipeline is run.')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+
+    # input and output options shared by every command
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--input', default='./data/central_database.csv', help='csv file with addresses')
+    common.add_argument('--output-dir', default='./output/central', help='directory for output files')
+    common.add_argument('--services', type=lambda value: value.split(','), default=['nominatim', 'google', 'arcgis', 'bing'],
+                        help='comma separated geocoding services, by registered provider name (in cost order for '
+                             'the cascade mode)')
+    common.add_argument('--mode', default='threads', choices=['sequential', 'threads', 'async', 'cascade'],
+                        help="geocoding mode; 'cascade' also outputs the chosen results as the cascade service")
+    common.add_argument('--name-col', default='Name ', help='name field of the input csv')
+    common.add_argument('--address-col', default='Address', help='address field of the input csv')
+    common.add_argument('--lat-col', default='Latitude', help='known latitude field of the input csv')
+    common.add_argument('--lon-col', default='Longitude', help='known longitude field of the input csv')
+    common.add_argument('--vector-format', default='.shp', choices=['.shp', '.gpkg', '.fgb'],
+                        help='vector output format (.fgb cannot be used with --streaming)')
+    common.add_argument('--plot-name', default='boxplot_7k.png', help='box plot file name in the output directory')
+    common.add_argument('--metrics', action='store_true', help='save stage timings and geocoding request metrics')
+
+    # geocoding options
+    geocoding = argparse.ArgumentParser(add_help=False)
+    geocoding.add_argument('--resume', action='store_true', help='resume an interrupted run from the geocode journal')
+    geocoding.add_argument('--incremental', action='store_true', help='only geocode rows that are new or changed since the last run')
+    geocoding.add_argument('--batch-size', type=int, default=None,
+                           help='addresses per batch for services with batch endpoints (arcgis, bing)')
+    geocoding.add_argument('--local-reference', default='./data/address_points.csv',
+                           help='reference address points for the local provider (csv or .npz)')
+    geocoding.add_argument('--min-confidence', type=float, default=0.9,
+                           help='cascade mode: match confidence at which a result is accepted')
+    geocoding.add_argument('--agree-feet', type=float, default=250,
+                           help="cascade mode: distance within which two services' results agree")
+    geocoding.add_argument('--no-export', action='store_true',
+                           help='only write the results store, not the csv and vector exports (see the export command)')
+
+    # distance table options
+    distances = argparse.ArgumentParser(add_help=False)
+    distances.add_argument('--nearest-k', type=int, default=1, help='nearest known sites added for each geocoded point')
+    distances.add_argument('--site-radius-feet', type=float, default=500, help='radius for counting known sites nearby')
+
+    # plot options
+    plot = argparse.ArgumentParser(add_help=False)
+    plot.add_argument('--plot-mode', default='box', choices=['box', 'summary'],
+                      help="'box' plots every distance, 'summary' plots quantile summaries (for very large tables)")
+
+    # stage runner options
+    stages = argparse.ArgumentParser(add_help=False)
+    stages.add_argument('--stage-workers', type=int, default=None,
+                        help='worker processes for output stages (default: every cpu, 1 runs stages in this process)')
+
+    run = subparsers.add_parser('run', parents=[common, geocoding, distances, plot, stages], help='run the whole pipeline')
+    run.add_argument('--streaming', action='store_true', help='process the input in chunks (no maps or box plot)')
+    run.add_argument('--chunk-size', type=int, default=10000, help='rows per chunk in streaming mode')
+    run.set_defaults(func=run_command)
+
+    subparsers.add_parser('geocode', parents=[common, geocoding],
+                          help='geocode the input and write results per service').set_defaults(func=geocode_command)
+    subparsers.add_parser('distances', parents=[common, distances],
+                          help='create the distance table from geocode results').set_defaults(func=distances_command)
+    subparsers.add_parser('stats', parents=[common],
+                          help='calculate distance statistics from the distance table').set_defaults(func=stats_command)
+    subparsers.add_parser('plot', parents=[common, plot],
+                          help='plot distances from the distance table').set_defaults(func=plot_command)
+    subparsers.add_parser('maps', parents=[common, stages],
+                          help='draw result and bubble maps').set_defaults(func=maps_command)
+    subparsers.add_parser('export', parents=[common],
+                          help='export the results store as csv and vector files').set_defaults(func=export_command)
+
+    return parser
+
+
+def main(argv=None):
+    """
+    Run a pipeline command from the command line.
+    :param argv: command line arguments (default: sys.argv[1:]); without a subcommand the whole pipeline is run
+    :return: None
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ('-h', '--help')):
+        argv = ['run'] + list(argv)
+
+    args = create_parser().parse_args(argv)
+    args.func(args)
+
+    return None
 
-    # graduated point size using distance from known coord to geocoded coord
-    create_bubble_map(shp_out.format('known'), dist, 'Nominatim', 'orange', map_out.format('nominatim_bubble'))
-    create_bubble_map(shp_out.format('known'), dist, 'Google', 'green', map_out.format('google_bubble'))
-    create_bubble_map(shp_out.format('known'), dist, 'ArcGIS', 'red', map_out.format('arcgis_bubble'))
-    create_bubble_map(shp_out.format('known'), dist, 'Bing', 'blue', map_out.format('bing_bubble'))
-    
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,412 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+import asyncio
+import bisect
+import json
+import threading
+import time
+
+# histogram bucket upper bounds in seconds: geocoding requests and pipeline stages
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STAGE_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0, 14400.0)
+
+# help text for exported metrics
+METRIC_HELP = {'geocode_requests_total': 'Geocoding requests by service and outcome.',
+               'geocode_request_seconds': 'Geocoding request latency in seconds.',
+               'geocode_cache_total': 'Geocode cache lookups by service and result.',
+               'geocode_batch_records_total': 'Records submitted to batch endpoints by service and outcome.',
+               'geocode_batch_seconds': 'Batch geocoding request latency in seconds.',
+               'geocode_retries_total': 'Geocoding requests retried after a transient error.',
+               'circuit_breaker_open_total': 'Times a service circuit breaker opened.',
+               'circuit_breaker_stopped_total': 'Services stopped after a configuration or authentication error.',
+               'cascade_addresses_total': 'Addresses sent to each service by cascade geocoding.',
+               'cascade_resolved_total': 'Addresses resolved by cascade geocoding by service and reason.',
+               'stage_seconds': 'Pipeline stage wall time in seconds.',
+               'stage_skipped_total': 'Pipeline stages skipped because their inputs had not changed.'}
+
+# exception class name fragments for timeouts, quota/rate limit errors and unavailable services (geopy, requests,
+# aiohttp)
+TIMEOUT_NAMES = ('Timeout', 'TimedOut')
+QUOTA_NAMES = ('Quota', 'RateLimit')
+UNAVAILABLE_NAMES = ('Unavailable', 'ServerDisconnected')
+
+# exception class name fragments for authentication errors (bad or expired api key, insufficient privileges)
+AUTH_NAMES = ('Authentication', 'InsufficientPrivileges', 'Unauthorized')
+
+
+# outcome label for a failed request
+def exception_outcome(e):
+    """
+    Classify an exception raised while geocoding an address.
+    :param e: exception
+    :return: 'timeout', 'quota' (quota exceeded, rate limited or HTTP 429), 'unavailable' (HTTP 5xx or connection
+    error), 'auth' (HTTP 401/403, rejected api key or a missing token module), 'failure' (no result in the response)
+    or 'error'
+    """
+    name = type(e).__name__
+    response = getattr(e, 'response', None)
+    status = getattr(e, 'status', None) or getattr(response, 'status_code', None)
+
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError)) or any(part in name for part in TIMEOUT_NAMES):
+        return 'timeout'
+    if status == 429 or any(part in name for part in QUOTA_NAMES):
+        return 'quota'
+    if (isinstance(status, int) and status >= 500) or isinstance(e, ConnectionError) or \
+            any(part in name for part in UNAVAILABLE_NAMES + ('ConnectionError', 'ConnectorError')):
+        return 'unavailable'
+    if status in (401, 403) or isinstance(e, ImportError) or any(part in name for part in AUTH_NAMES):
+        return 'auth'
+    if isinstance(e, (LookupError, AttributeError, TypeError)):
+        return 'failure'
+
+    return 'error'
+
+
+# no-op context manager used when metrics are disabled
+class NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+# define StageTimer class
+class StageTimer:
+
+    # constructor
+    def __init__(self, metrics, stage):
+        """
+        Context manager that observes the wall time of a pipeline stage.
+        :param metrics: Metrics
+        :param stage: stage name
+        """
+        self.metrics = metrics
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe('stage_seconds', time.perf_counter() - self.start, STAGE_BUCKETS, stage=self.stage)
+        return False
+
+
+# define Histogram class
+class Histogram:
+
+    # constructor
+    def __init__(self, buckets):
+        """
+        Fixed-bucket histogram (Prometheus style).
+        :param buckets: increasing bucket upper bounds
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    ###########
+    # METHODS #
+    ###########
+
+    # add an observation
+    def observe(self, value):
+        """
+        Add a value to the histogram.
+        :param value: observed value
+        :return: None
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+        return None
+
+    # cumulative bucket counts
+    def cumulative(self):
+        """
+        Return the number of observations less than or equal to each bucket bound.
+        :return: list of (bound, count) tuples ending with ('+Inf', count)
+        """
+        total = 0
+        cumulative = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            cumulative.append((bound, total))
+
+        return cumulative
+
+    # estimate a quantile
+    def quantile(self, q):
+        """
+        Estimate a quantile by linear interpolation within its bucket (values above the last bound report the max).
+        :param q: quantile between 0 and 1
+        :return: estimated value, None if the histogram is empty
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        lower, below = 0.0, 0
+        for bound, total in self.cumulative():
+            if total >= rank:
+                if bound == '+Inf':
+                    return self.max
+                in_bucket = total - below
+                return lower + (bound - lower) * (rank - below) / in_bucket if in_bucket else bound
+            lower, below = bound, total
+
+        return self.max
+
+
+# define Metrics class
+class Metrics:
+
+    # constructor
+    def __init__(self, enabled=False):
+        """
+        Counters and histograms for pipeline stages and geocoding requests. While disabled every method returns
+        immediately, so instrumented code costs one attribute check per call.
+        :param enabled: start collecting immediately
+        """
+        self.enabled = enabled
+        self.lock = threading.Lock()
+
+        # (name, labels): value or Histogram, labels are sorted (key, value) tuples
+        self.counters = {}
+        self.histograms = {}
+
+    ###########
+    # METHODS #
+    ###########
+
+    # increment a counter
+    def inc(self, name, value=1, **labels):
+        """
+        Increment a counter.
+        :param name: metric name
+        :param value: amount to add
+        :param labels: label values, e.g. service='google'
+        :return: None
+        """
+        if not self.enabled:
+            return None
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+        return None
+
+    # add a histogram observation
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """
+        Add an observation to a histogram.
+        :param name: metric name
+        :param value: observed value
+        :param buckets: bucket upper bounds, used when the histogram is created
+        :param labels: label values, e.g. service='google'
+        :return: None
+        """
+        if not self.enabled:
+            return None
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+        return None
+
+    # time a pipeline stage
+    def stage(self, name):
+        """
+        Return a context manager that records the wall time of a pipeline stage in 'stage_seconds'.
+        :param name: stage name
+        :return: context manager
+        """
+        if not self.enabled:
+            return NULL_TIMER
+
+        return StageTimer(self, name)
+
+    # record a geocoding request
+    def record_request(self, service, seconds, outcome):
+        """
+        Count a geocoding request by outcome and observe its latency.
+        :param service: geocoding service
+        :param seconds: request latency
+        :param outcome: 'success', 'failure', 'timeout', 'quota', 'unavailable' or 'error'
+        :return: None
+        """
+        if not self.enabled:
+            return None
+
+        self.inc('geocode_requests_total', service=service, outcome=outcome)
+        self.observe('geocode_request_seconds', seconds, service=service)
+
+        return None
+
+    # clear collected metrics
+    def reset(self):
+        """
+        Remove every counter and histogram.
+        :return: None
+        """
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+        return None
+
+    # summary of collected metrics
+    def snapshot(self):
+        """
+        Return the collected metrics as plain data.
+        :return: dictionary with lists of counters and histograms
+        """
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = []
+            for (name, labels), hist in sorted(self.histograms.items(), key=lambda item: item[0]):
+                histograms.append({'name': name, 'labels': dict(labels), 'count': hist.count, 'sum': hist.sum,
+                                   'mean': hist.sum / hist.count, 'max': hist.max,
+                                   'p50': hist.quantile(0.5), 'p90': hist.quantile(0.9), 'p99': hist.quantile(0.99),
+                                   'buckets': [[bound, count] for bound, count in hist.cumulative()]})
+
+        return {'counters': counters, 'histograms': histograms}
+
+    # export with each exporter
+    def export(self, *exporters):
+        """
+        Write the collected metrics with each exporter.
+        :param exporters: objects with an export(metrics) method (JsonExporter, PrometheusExporter)
+        :return: None
+        """
+        for exporter in exporters:
+            exporter.export(self)
+
+        return None
+
+
+# define JsonExporter class
+class JsonExporter:
+
+    # constructor
+    def __init__(self, path):
+        """
+        Write a JSON summary of the metrics (counters, and histograms with count/sum/mean/max/quantile estimates).
+        :param path: path to save JSON file
+        """
+        self.path = path
+
+    ###########
+    # METHODS #
+    ###########
+
+    # write metrics
+    def export(self, metrics):
+        """
+        Write the metrics summary.
+        :param metrics: Metrics
+        :return: None
+        """
+        with open(self.path, 'w') as f:
+            json.dump(metrics.snapshot(), f, indent=2)
+
+        return None
+
+
+# define PrometheusExporter class
+class PrometheusExporter:
+
+    # constructor
+    def __init__(self, path):
+        """
+        Write the metrics in the Prometheus text exposition format (e.g. for the node exporter textfile collector).
+        :param path: path to save .prom file
+        """
+        self.path = path
+
+    ###########
+    # METHODS #
+    ###########
+
+    # format labels
+    @staticmethod
+    def labels(labels, **extra):
+        """
+        Format labels as {key="value",...}.
+        :param labels: dictionary of labels
+        :param extra: additional labels
+        :return: label string ('' without labels)
+        """
+        labels = dict(labels, **extra)
+        if not labels:
+            return ''
+        values = ['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items()]
+
+        return '{' + ','.join(values) + '}'
+
+    # write metrics
+    def export(self, metrics):
+        """
+        Write the metrics.
+        :param metrics: Metrics
+        :return: None
+        """
+        snapshot = metrics.snapshot()
+        lines = []
+
+        # counters, grouped by name
+        written = set()
+        for counter in snapshot['counters']:
+            name = counter['name']
+            if name not in written:
+                lines.append('# HELP {} {}'.format(name, METRIC_HELP.get(name, name)))
+                lines.append('# TYPE {} counter'.format(name))
+                written.add(name)
+            lines.append('{}{} {}'.format(name, self.labels(counter['labels']), counter['value']))
+
+        # histograms, grouped by name
+        for hist in snapshot['histograms']:
+            name = hist['name']
+            if name not in written:
+                lines.append('# HELP {} {}'.format(name, METRIC_HELP.get(name, name)))
+                lines.append('# TYPE {} histogram'.format(name))
+                written.add(name)
+            for bound, count in hist['buckets']:
+                lines.append('{}_bucket{} {}'.format(name, self.labels(hist['labels'], le=bound), count))
+            lines.append('{}_sum{} {}'.format(name, self.labels(hist['labels']), hist['sum']))
+            lines.append('{}_count{} {}'.format(name, self.labels(hist['labels']), hist['count']))
+
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        return None
+
+
+# shared no-op timer and the metrics registry used by the pipeline (disabled until enable_metrics is called)
+NULL_TIMER = NullTimer()
+metrics = Metrics()
+
+
+# turn on metrics collection
+def enable_metrics():
+    """
+    Start collecting metrics in the shared registry.
+    :return: Metrics
+    """
+    metrics.enabled = True
+
+    return metrics
@@ -0,0 +1,70 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+import re
+
+# standard abbreviations (USPS Publication 28) for street suffixes, directionals and unit designators
+ADDRESS_ABBREVIATIONS = {
+    # street suffixes
+    'ALLEY': 'ALY', 'AVENUE': 'AVE', 'AV': 'AVE', 'AVEN': 'AVE', 'AVENU': 'AVE', 'BOULEVARD': 'BLVD', 'BOUL': 'BLVD',
+    'CIRCLE': 'CIR', 'CIRC': 'CIR', 'COURT': 'CT', 'CRT': 'CT', 'DRIVE': 'DR', 'DRV': 'DR', 'EXPRESSWAY': 'EXPY',
+    'FREEWAY': 'FWY', 'HIGHWAY': 'HWY', 'HIWAY': 'HWY', 'LANE': 'LN', 'PARKWAY': 'PKWY', 'PKY': 'PKWY', 'PLACE': 'PL',
+    'PLAZA': 'PLZ', 'ROAD': 'RD', 'SQUARE': 'SQ', 'STREET': 'ST', 'STR': 'ST', 'TERRACE': 'TER', 'TRAIL': 'TRL',
+    # directionals
+    'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W',
+    'NORTHEAST': 'NE', 'NORTHWEST': 'NW', 'SOUTHEAST': 'SE', 'SOUTHWEST': 'SW',
+    # unit designators
+    'APARTMENT': 'APT', 'BUILDING': 'BLDG', 'FLOOR': 'FL', 'SUITE': 'STE'}
+
+# whole words that have a standard abbreviation
+ABBREVIATION_PATTERN = re.compile(r'\b({})\b'.format('|'.join(sorted(ADDRESS_ABBREVIATIONS, key=len, reverse=True))))
+
+
+# normalize an address string so equivalent addresses share a key
+def normalize_address(address):
+    """
+    Normalize an address (upper case, no punctuation, single spaces).
+    :param address: address string
+    :return: normalized address string
+    """
+    address = str(address).upper()
+    address = re.sub(r'[.,#]', ' ', address)
+    address = re.sub(r'\s+', ' ', address)
+
+    return address.strip()
+
+
+# normalize a column of strings
+def normalize_series(series):
+    """
+    Vectorized normalize_address for a pandas series.
+    :param series: pandas series of strings
+    :return: pandas series of normalized strings
+    """
+    series = series.astype(str).str.upper()
+    series = series.str.replace(r'[.,#]', ' ', regex=True)
+    series = series.str.replace(r'\s+', ' ', regex=True)
+
+    return series.str.strip()
+
+
+# canonical form of an address, used as the geocoding key
+def canonical_address(address):
+    """
+    Normalize an address and replace street suffixes, directionals and unit designators with their standard
+    abbreviations, so variants such as '123 North Main Street' and '123 N. Main St' share a key.
+    :param address: address string
+    :return: canonical address string
+    """
+    return ABBREVIATION_PATTERN.sub(lambda m: ADDRESS_ABBREVIATIONS[m.group(1)], normalize_address(address))
+
+
+# canonical form of a column of addresses
+def canonical_series(series):
+    """
+    Vectorized canonical_address for a pandas series.
+    :param series: pandas series of strings
+    :return: pandas series of canonical strings
+    """
+    return normalize_series(series).str.replace(ABBREVIATION_PATTERN, lambda m: ADDRESS_ABBREVIATIONS[m.group(1)], regex=True)
@@ -2,26 +2,27 @@
 # Jessica Embury
 
 # import statements
-from my_tokens import arcgis_token, bing_token, google_token
+from metrics import exception_outcome, metrics
+from providers import get_provider
 
-from geopy import distance
-from geopy.geocoders import Nominatim
-from geopy.geocoders import GoogleV3
-from geopy.geocoders import Bing
-import requests
+import time
 
 
 # define Point class
 class Point:
 
+    # slots keep Point objects small (rows of a PointStore are viewed as Point objects)
+    __slots__ = ('id_num', 'name', 'address', 'gc_service', 'latitude', 'longitude', 'confidence')
+
     # constructor
-    def __init__(self, id_num, name, address, gc_service=None, latitude=None, longitude=None):
+    def __init__(self, id_num, name, address, gc_service=None, latitude=None, longitude=None, confidence=None):
         self.id_num = id_num
         self.name = name
         self.address = address
         self.gc_service = gc_service
         self.latitude = latitude
         self.longitude = longitude
+        self.confidence = confidence
 
     ###########
     # METHODS #
@@ -36,13 +37,13 @@ class Point:
         """
         if gc is None:
             gc = input("Select a geocoding service: 1. Nominatim/OSM, 2. Google, 3. ArcGIS/Esri, 4. Bing \nEnter 1, 2, 3 or 4. Any other entry will cancel the operation.")
-        if gc is '1' or gc is 1:
+        if gc == '1' or gc == 1:
             self.gc_service = 'nominatim'
-        elif gc is '2' or gc is 2:
+        elif gc == '2' or gc == 2:
             self.gc_service = 'google'
-        elif gc is '3' or gc is 3:
+        elif gc == '3' or gc == 3:
             self.gc_service = 'arcgis'
-        elif gc is '4' or gc is 4:
+        elif gc == '4' or gc == 4:
             self.gc_service = 'bing'
         else:
             print("Canceled. Geocoding service has not been selected.")
@@ -62,47 +63,29 @@ class Point:
     # geocode address to get latitude and longitude
     def geocode(self):
         """
-        Geocodes the Point object's address using the geocoding service selected by gc_service, sets latitude/longitude
-        :return: None
+        Geocodes the Point object's address using the provider registered for gc_service (see providers.py), sets
+        latitude/longitude and the match confidence the service reports (between 0 and 1, None if not reported)
+        :return: request outcome ('success', 'failure', 'timeout', 'quota', 'unavailable', 'auth' or 'error', see
+        metrics.exception_outcome)
         """
         # set gc_service if None
         if self.gc_service is None:
             self.set_gc_service()
 
-        # create geolocator instance based upon gc_service
-        if self.gc_service is 'nominatim':
-            geolocator = Nominatim(user_agent='sdsu_geog582_final')
-        elif self.gc_service is 'google':
-            geolocator = GoogleV3(google_token)
-        elif self.gc_service is 'bing':
-            geolocator = Bing(bing_token)
-
-        # geocode input address, set self.latitude and self.longitude
-        if self.gc_service is 'nominatim' or self.gc_service is 'google' or self.gc_service is 'bing':
-            try:
-                location = geolocator.geocode(self.address)
-
-                self.latitude = location.latitude
-                self.longitude = location.longitude
-            # print exception if geocode not successful
-            except Exception as e:
-                print('Exception for {}, {}, {}: {}'.format(self.id_num, self.name, self.address, e))
-
-        # use requests library to geocode with arcgis
-        if self.gc_service is 'arcgis':
-            token = arcgis_token
-            addr = self.address
-            try:
-                url = 'https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/findAddressCandidates?singleLine={}&forStorage=true&token={}&f=pjson'.format(addr, token)
-                r = requests.get(url)
-                results = r.json()
-                self.latitude = results['candidates'][0]['location']['y']
-                self.longitude = results['candidates'][0]['location']['x']
-            # print exception if geocode not successful
-            except Exception as e:
-                print('Exception for {}, {}, {}: {}'.format(self.id_num, self.name, self.address, e))
+        # geocode input address with the service's provider, set self.latitude and self.longitude
+        start = time.perf_counter()
+        outcome = 'success'
+        try:
+            self.latitude, self.longitude, self.confidence = get_provider(self.gc_service).geocode(self.address)
+        # print exception if geocode not successful
+        except Exception as e:
+            outcome = exception_outcome(e)
+            print('Exception for {}, {}, {}: {}'.format(self.id_num, self.name, self.address, e))
 
-        return None
+        # request latency and outcome
+        metrics.record_request(self.gc_service, time.perf_counter() - start, outcome)
+
+        return outcome
 
     # calculate distance between 2 points
     def calc_distance_feet(self, point2):
@@ -111,6 +94,8 @@ class Point:
         :param point2: Point object used to calculate distance from self
         :return: distance between 2 Point objects in miles
         """
+        from geopy import distance
+
         pt1 = (self.latitude, self.longitude)
         pt2 = (point2.latitude, point2.longitude)
         dist = distance.distance(pt1, pt2).feet
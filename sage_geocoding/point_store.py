@@ -0,0 +1,248 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from normalize import canonical_series
+from point import Point
+
+import numpy as np
+import pandas as pd
+
+# geocode status codes
+STATUS_PENDING = 0
+STATUS_OK = 1
+STATUS_FAILED = 2
+
+
+# coordinate and confidence arrays from a list of Point objects
+def point_results(points):
+    """
+    Get latitude, longitude and match confidence arrays from a list of Point objects (NaN where a value is None).
+    :param points: list of Point objects
+    :return: numpy array of latitudes, numpy array of longitudes, numpy array of confidences
+    """
+    latitude = np.array([np.nan if p.latitude is None else p.latitude for p in points], dtype='float64')
+    longitude = np.array([np.nan if p.longitude is None else p.longitude for p in points], dtype='float64')
+    confidence = np.array([np.nan if p.confidence is None else p.confidence for p in points], dtype='float64')
+
+    return latitude, longitude, confidence
+
+
+# define PointStore class
+class PointStore:
+
+    # constructor
+    def __init__(self, id_num, name, address):
+        """
+        Columnar store of points: one id/name/address per row and, for each geocoding service, float64 latitude,
+        longitude and match confidence arrays and an int8 status array. Point objects are created on demand as views of
+        a single row.
+        :param id_num: sequence of id numbers
+        :param name: sequence of names
+        :param address: sequence of addresses
+        """
+        self.id_num = np.asarray(id_num, dtype='int64')
+        self.name = np.asarray(name, dtype=object)
+        self.address = np.asarray(address, dtype=object)
+
+        # service: array
+        self.latitude = {}
+        self.longitude = {}
+        self.confidence = {}
+        self.status = {}
+
+        # canonical address of each row, computed on first use
+        self.keys = None
+
+    # create a store from an address table
+    @classmethod
+    def from_table(cls, address_table, name_col, address_col):
+        """
+        Create a store with the id numbers, names and addresses of the address table.
+        :param address_table: pandas df with addresses and identifiers
+        :param name_col: name field
+        :param address_col: address field
+        :return: PointStore
+        """
+        return cls(address_table['id_num'].to_numpy(), address_table[name_col].to_numpy(), address_table[address_col].to_numpy())
+
+    def __len__(self):
+        return len(self.id_num)
+
+    ###########
+    # METHODS #
+    ###########
+
+    # services in the store
+    def services(self):
+        """
+        Return the services that have coordinates in the store.
+        :return: list of service names
+        """
+        return list(self.status)
+
+    # add empty arrays for a service
+    def add_service(self, service):
+        """
+        Add NaN coordinates and confidences and pending status for every row for the service (existing results are
+        kept).
+        :param service: geocoding service name (or 'known')
+        :return: None
+        """
+        if service not in self.status:
+            self.latitude[service] = np.full(len(self), np.nan)
+            self.longitude[service] = np.full(len(self), np.nan)
+            self.confidence[service] = np.full(len(self), np.nan)
+            self.status[service] = np.full(len(self), STATUS_PENDING, dtype='int8')
+
+        return None
+
+    # set coordinates for a service
+    def set_coordinates(self, service, latitude, longitude, rows=None, confidence=None):
+        """
+        Set coordinates for the service. Rows with both coordinates are marked OK, the rest are marked FAILED.
+        :param service: geocoding service name (or 'known')
+        :param latitude: array of latitudes (NaN or None for failed geocodes)
+        :param longitude: array of longitudes (NaN or None for failed geocodes)
+        :param rows: optional row indices to set (default: all rows)
+        :param confidence: optional array of match confidences between 0 and 1 (default: NaN, not reported)
+        :return: None
+        """
+        self.add_service(service)
+        latitude = np.asarray(latitude, dtype='float64')
+        longitude = np.asarray(longitude, dtype='float64')
+        confidence = np.nan if confidence is None else np.asarray(confidence, dtype='float64')
+        if rows is None:
+            rows = slice(None)
+
+        self.latitude[service][rows] = latitude
+        self.longitude[service][rows] = longitude
+        self.confidence[service][rows] = confidence
+        self.status[service][rows] = np.where(np.isnan(latitude) | np.isnan(longitude), STATUS_FAILED, STATUS_OK)
+
+        return None
+
+    # row indices with a status
+    def rows(self, service, status=STATUS_OK):
+        """
+        Return the row indices of the service's points with the given status.
+        :param service: geocoding service name (or 'known')
+        :param status: status code
+        :return: numpy array of row indices
+        """
+        return np.flatnonzero(self.status[service] == status)
+
+    # rows that still need geocoding
+    def pending_rows(self, service):
+        """
+        Return the row indices that have no result for the service yet (all rows if the service is not in the store).
+        :param service: geocoding service name
+        :return: numpy array of row indices
+        """
+        if service not in self.status:
+            return np.arange(len(self))
+
+        return self.rows(service, STATUS_PENDING)
+
+    # canonical address keys
+    def address_keys(self):
+        """
+        Return the canonical address of every row (see normalize.canonical_address).
+        :return: numpy array of address keys
+        """
+        if self.keys is None:
+            self.keys = canonical_series(pd.Series(self.address, dtype=object)).to_numpy(dtype=object)
+
+        return self.keys
+
+    # unique addresses among rows
+    def unique_rows(self, rows):
+        """
+        Collapse rows that share an address key, so each unique address is geocoded once.
+        :param rows: row indices
+        :return: numpy array with one row index per unique address, numpy array mapping each of rows to its position in
+        the unique rows (unique coordinates[inverse] gives coordinates for every row)
+        """
+        rows = np.asarray(rows, dtype='int64')
+        codes, uniques = pd.factorize(self.address_keys()[rows])
+        first = np.full(len(uniques), len(rows), dtype='int64')
+        np.minimum.at(first, codes, np.arange(len(rows)))
+
+        return rows[first], codes
+
+    # copy results to pending rows with the same address
+    def fill_duplicates(self, service):
+        """
+        Give pending rows the result (coordinates, confidence and status) of a finished row with the same address key, e.g. rows
+        whose address was geocoded before an interrupted run was resumed.
+        :param service: geocoding service name
+        :return: number of filled rows
+        """
+        if service not in self.status:
+            return 0
+
+        keys = pd.Series(self.address_keys())
+        done = self.status[service] != STATUS_PENDING
+
+        # first finished row for each address key
+        finished = pd.Series(np.flatnonzero(done), index=keys[done].to_numpy())
+        finished = finished[~finished.index.duplicated()]
+
+        pending = np.flatnonzero(~done)
+        source = keys.iloc[pending].map(finished).to_numpy()
+        found = ~pd.isna(source)
+        rows, source = pending[found], source[found].astype('int64')
+
+        self.latitude[service][rows] = self.latitude[service][source]
+        self.longitude[service][rows] = self.longitude[service][source]
+        self.confidence[service][rows] = self.confidence[service][source]
+        self.status[service][rows] = self.status[service][source]
+
+        return len(rows)
+
+    # store with a subset of rows
+    def subset(self, rows):
+        """
+        Create a new store with the ids, names, addresses and address keys of the given rows (coordinates are not copied).
+        :param rows: row indices
+        :return: PointStore
+        """
+        store = PointStore(self.id_num[rows], self.name[rows], self.address[rows])
+        if self.keys is not None:
+            store.keys = self.keys[rows]
+
+        return store
+
+    # view a single row as a Point object
+    def point(self, service, i):
+        """
+        Create a Point object for row i of the service.
+        :param service: geocoding service name (or 'known')
+        :param i: row index
+        :return: Point object
+        """
+        latitude = self.latitude[service][i]
+        longitude = self.longitude[service][i]
+        confidence = self.confidence[service][i]
+        return Point(int(self.id_num[i]), self.name[i], self.address[i], None if service == 'known' else service,
+                     None if np.isnan(latitude) else float(latitude), None if np.isnan(longitude) else float(longitude),
+                     None if np.isnan(confidence) else float(confidence))
+
+    # view rows as Point objects
+    def points(self, service, status=STATUS_OK):
+        """
+        Create Point objects for the service's rows with the given status.
+        :param service: geocoding service name (or 'known')
+        :param status: status code
+        :return: list of Point objects
+        """
+        return [self.point(service, i) for i in self.rows(service, status)]
+
+    # new Point objects for geocoding
+    def new_points(self, gc_service):
+        """
+        Create a Point object without coordinates for every row, ready to be geocoded.
+        :param gc_service: geocoding service name
+        :return: list of Point objects
+        """
+        return [Point(int(id_num), name, address, gc_service) for id_num, name, address in zip(self.id_num, self.name, self.address)]
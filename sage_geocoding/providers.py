@@ -0,0 +1,481 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from local_geocoder import MIN_SCORE, AddressPointIndex
+
+import os
+import requests
+import threading
+
+# name of the api token in my_tokens.py for each service that needs one
+TOKEN_NAMES = {'google': 'google_token', 'arcgis': 'arcgis_token', 'bing': 'bing_token'}
+
+# match confidence between 0 and 1 for the result quality each service reports: Google location types, Bing confidence
+# levels and Nominatim result classes (ArcGIS reports a 0-100 score, the local provider its match score)
+GOOGLE_CONFIDENCE = {'ROOFTOP': 1.0, 'RANGE_INTERPOLATED': 0.8, 'GEOMETRIC_CENTER': 0.5, 'APPROXIMATE': 0.2}
+BING_CONFIDENCE = {'High': 1.0, 'Medium': 0.6, 'Low': 0.3}
+NOMINATIM_CONFIDENCE = {'building': 1.0, 'place': 0.8, 'highway': 0.5}
+
+# error codes of a rejected or expired api token in ArcGIS responses (sent with HTTP 200)
+ARCGIS_AUTH_CODES = (401, 403, 498, 499)
+
+
+# define ServiceAuthenticationError class
+class ServiceAuthenticationError(Exception):
+    """
+    A geocoding service rejected the request's api key in an otherwise successful response (classified as 'auth' by
+    metrics.exception_outcome, which stops the service).
+    """
+
+
+# get api token for a geocoding service
+def get_token(gc_service):
+    """
+    Return the api token for a geocoding service. my_tokens.py is only imported when a token is needed, so services
+    without tokens (nominatim, local) work without it.
+    :param gc_service: geocoding service name
+    :return: token string, None for services without tokens
+    """
+    if gc_service not in TOKEN_NAMES:
+        return None
+    import my_tokens
+
+    return getattr(my_tokens, TOKEN_NAMES[gc_service])
+
+
+# define GeocoderProvider class
+class GeocoderProvider:
+
+    # service name (set by register_provider) and default request limits (web services are throttled to 1 request per
+    # second unless their provider sets the interval of its quota)
+    name = None
+    min_interval = 1.0
+    concurrency = 8
+
+    # web service (requests described by build_request/parse_response) and whether results are worth caching
+    http = True
+    cacheable = True
+
+    # distance column label and map style (folium marker color and icon); providers that do not set them get the title
+    # cased service name and the default style (see utility.service_style)
+    label = None
+    map_color = None
+    map_icon = None
+
+    ###########
+    # METHODS #
+    ###########
+
+    # geocode an address
+    def geocode(self, address):
+        """
+        Geocode an address. Raise an exception if the address cannot be geocoded (see metrics.exception_outcome for how
+        exceptions are counted: LookupError, AttributeError and TypeError are 'failure', timeouts, 429 and 5xx errors
+        are retried).
+        :param address: address string
+        :return: latitude, longitude, match confidence between 0 and 1 (None if the service does not report one)
+        """
+        raise NotImplementedError
+
+    # match confidence of a result
+    def result_confidence(self, result):
+        """
+        Read the match quality the service reports for a result (e.g. a score or location type) as a confidence between
+        0 and 1, so results can be compared across services.
+        :param result: first result of the service's response
+        :return: confidence, None if the service does not report one
+        """
+        return None
+
+    # api token
+    def token(self):
+        """
+        Return the provider's api token.
+        :return: token string, None if the provider does not need one
+        """
+        return None
+
+    # url and query parameters for an address
+    def build_request(self, address, base_url=None, token=None):
+        """
+        Build the http request for an address (used by the asyncio engine).
+        :param address: address string
+        :param base_url: service base url (default: the provider's base_url)
+        :param token: api token (default: the provider's token)
+        :return: url, dictionary of query parameters
+        """
+        raise NotImplementedError('{} has no http api'.format(self.name))
+
+    # coordinates and match confidence from a response
+    def parse_response(self, results):
+        """
+        Get the coordinates and match confidence of the first result from the service's json response.
+        :param results: decoded json response
+        :return: latitude, longitude, match confidence (None if the service does not report one)
+        """
+        raise NotImplementedError('{} has no http api'.format(self.name))
+
+    # release clients and sessions
+    def close(self):
+        """
+        Close the provider's clients and sessions.
+        :return: None
+        """
+        return None
+
+
+# define HttpProvider class
+class HttpProvider(GeocoderProvider):
+
+    # default service endpoint
+    base_url = None
+
+    # constructor
+    def __init__(self, base_url=None, token=None, min_interval=None, concurrency=None, timeout=10):
+        """
+        Web geocoding service with its own keep-alive http session (also used by the batch endpoints).
+        :param base_url: service base url (default: the class base_url)
+        :param token: api token (default: read from my_tokens.py on first use)
+        :param min_interval: minimum seconds between requests (default: the class min_interval)
+        :param concurrency: maximum number of requests in flight for the asyncio engine (default: the class concurrency)
+        :param timeout: request timeout in seconds
+        """
+        self.base_url = (base_url or self.base_url).rstrip('/')
+        self.api_token = token
+        if min_interval is not None:
+            self.min_interval = min_interval
+        if concurrency is not None:
+            self.concurrency = concurrency
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    ###########
+    # METHODS #
+    ###########
+
+    # api token
+    def token(self):
+        """
+        Return the provider's api token, reading it from my_tokens.py if it was not given.
+        :return: token string, None if the provider does not need one
+        """
+        if self.api_token is None:
+            self.api_token = get_token(self.name)
+
+        return self.api_token
+
+    # geocode an address with the provider's session
+    def geocode(self, address):
+        """
+        Geocode an address with one request over the provider's session.
+        :param address: address string
+        :return: latitude, longitude, match confidence
+        """
+        url, params = self.build_request(address)
+        r = self.session.get(url, params=params, timeout=self.timeout)
+        r.raise_for_status()
+
+        return self.parse_response(r.json())
+
+    # close session
+    def close(self):
+        """
+        Close the http session.
+        :return: None
+        """
+        self.session.close()
+
+        return None
+
+
+# define GeopyProvider class
+class GeopyProvider(HttpProvider):
+
+    # constructor
+    def __init__(self, **kwargs):
+        """
+        Web geocoding service queried through a geopy geolocator (created on first use). The asyncio engine sends the
+        same requests itself using build_request/parse_response.
+        :param kwargs: HttpProvider parameters
+        """
+        super().__init__(**kwargs)
+        self.geolocator = None
+
+    ###########
+    # METHODS #
+    ###########
+
+    # geopy geolocator for the service
+    def create_geolocator(self):
+        """
+        Create the geopy geolocator for the service (geopy is imported here, so services that do not use it start
+        without loading it).
+        :return: geopy geolocator
+        """
+        raise NotImplementedError
+
+    # geocode an address with geopy
+    def geocode(self, address):
+        """
+        Geocode an address with the shared geolocator ('no result' answers raise AttributeError). The match confidence
+        is read from the raw result, which has the same fields as the service's json response.
+        :param address: address string
+        :return: latitude, longitude, match confidence
+        """
+        if self.geolocator is None:
+            self.geolocator = self.create_geolocator()
+        location = self.geolocator.geocode(address)
+
+        return location.latitude, location.longitude, self.result_confidence(location.raw)
+
+
+# registered provider classes, their constructor options and the shared instance of each provider
+PROVIDERS = {}
+provider_options = {}
+providers = {}
+providers_lock = threading.Lock()
+
+
+# register a provider class
+def register_provider(name):
+    """
+    Class decorator registering a GeocoderProvider subclass under a service name, which can then be used in the
+    gc_services list like the built in services.
+    :param name: geocoding service name
+    :return: decorator
+    """
+    def register(cls):
+        cls.name = name
+        PROVIDERS[name] = cls
+        return cls
+
+    return register
+
+
+# set options for a provider
+def configure_provider(name, **options):
+    """
+    Set the constructor options of a provider (e.g. the local provider's reference file or a token). The shared
+    instance is created again with the new options on next use.
+    :param name: geocoding service name
+    :param options: constructor parameters
+    :return: None
+    """
+    with providers_lock:
+        provider_options[name] = options
+        provider = providers.pop(name, None)
+    if provider is not None:
+        provider.close()
+
+    return None
+
+
+# get the shared provider for a service
+def get_provider(name):
+    """
+    Return the provider for the geocoding service, creating it on first use.
+    :param name: geocoding service name
+    :return: GeocoderProvider
+    """
+    with providers_lock:
+        if name not in providers:
+            if name not in PROVIDERS:
+                raise ValueError('Unknown geocoding service: {} (registered: {})'.format(name, ', '.join(PROVIDERS)))
+            providers[name] = PROVIDERS[name](**provider_options.get(name, {}))
+
+        return providers[name]
+
+
+# names of registered providers
+def available_providers():
+    """
+    Return the names of the registered geocoding services.
+    :return: list of service names
+    """
+    return list(PROVIDERS)
+
+
+# define NominatimProvider class
+@register_provider('nominatim')
+class NominatimProvider(GeopyProvider):
+
+    # Nominatim usage policy allows 1 request per second
+    base_url = 'https://nominatim.openstreetmap.org'
+    min_interval = 1.0
+
+    # distance column and map markers
+    label = 'Nominatim'
+    map_color = 'orange'
+    map_icon = 'cloud'
+
+    ###########
+    # METHODS #
+    ###########
+
+    def create_geolocator(self):
+        from geopy.geocoders import Nominatim
+        return Nominatim(user_agent='sdsu_geog582_final')
+
+    def build_request(self, address, base_url=None, token=None):
+        return (base_url or self.base_url) + '/search', {'q': address, 'format': 'json', 'limit': 1}
+
+    def parse_response(self, results):
+        return float(results[0]['lat']), float(results[0]['lon']), self.result_confidence(results[0])
+
+    # house numbers and buildings are address matches, streets and areas are not
+    def result_confidence(self, result):
+        if result.get('type') == 'house':
+            return 1.0
+        return NOMINATIM_CONFIDENCE.get(result.get('class'), 0.2) if 'class' in result else None
+
+
+# define GoogleProvider class
+@register_provider('google')
+class GoogleProvider(GeopyProvider):
+
+    # Geocoding API allows 50 requests per second
+    base_url = 'https://maps.googleapis.com'
+    min_interval = 0.02
+
+    # distance column and map markers
+    label = 'Google'
+    map_color = 'green'
+    map_icon = 'flash'
+
+    ###########
+    # METHODS #
+    ###########
+
+    def create_geolocator(self):
+        from geopy.geocoders import GoogleV3
+        return GoogleV3(self.token())
+
+    def build_request(self, address, base_url=None, token=None):
+        return (base_url or self.base_url) + '/maps/api/geocode/json', {'address': address, 'key': token or self.token()}
+
+    def parse_response(self, results):
+        if results.get('status') == 'REQUEST_DENIED':
+            raise ServiceAuthenticationError(results.get('error_message', 'REQUEST_DENIED'))
+        result = results['results'][0]
+        return result['geometry']['location']['lat'], result['geometry']['location']['lng'], self.result_confidence(result)
+
+    # location type, lowered for partial matches
+    def result_confidence(self, result):
+        location_type = result['geometry'].get('location_type')
+        if location_type not in GOOGLE_CONFIDENCE:
+            return None
+        return GOOGLE_CONFIDENCE[location_type] * (0.8 if result.get('partial_match') else 1.0)
+
+
+# define ArcGISProvider class
+@register_provider('arcgis')
+class ArcGISProvider(HttpProvider):
+
+    # World Geocoding Service rate limit: 50 requests per second
+    base_url = 'https://geocode.arcgis.com'
+    min_interval = 0.02
+
+    # distance column and map markers
+    label = 'ArcGIS'
+    map_color = 'red'
+    map_icon = 'globe'
+
+    ###########
+    # METHODS #
+    ###########
+
+    def build_request(self, address, base_url=None, token=None):
+        return ((base_url or self.base_url) + '/arcgis/rest/services/World/GeocodeServer/findAddressCandidates',
+                {'singleLine': address, 'forStorage': 'true', 'token': token or self.token(), 'f': 'json'})
+
+    def parse_response(self, results):
+        if results.get('error', {}).get('code') in ARCGIS_AUTH_CODES:
+            raise ServiceAuthenticationError(results['error'].get('message', results['error']['code']))
+        candidate = results['candidates'][0]
+        return candidate['location']['y'], candidate['location']['x'], self.result_confidence(candidate)
+
+    # candidate score (0-100)
+    def result_confidence(self, result):
+        return result['score'] / 100 if result.get('score') is not None else None
+
+
+# define BingProvider class
+@register_provider('bing')
+class BingProvider(GeopyProvider):
+
+    # Bing Maps basic keys are throttled above about 5 requests per second
+    base_url = 'https://dev.virtualearth.net'
+    min_interval = 0.2
+
+    # distance column and map markers
+    label = 'Bing'
+    map_color = 'blue'
+    map_icon = 'paperclip'
+
+    ###########
+    # METHODS #
+    ###########
+
+    def create_geolocator(self):
+        from geopy.geocoders import Bing
+        return Bing(self.token())
+
+    def build_request(self, address, base_url=None, token=None):
+        return (base_url or self.base_url) + '/REST/v1/Locations', {'query': address, 'maxResults': 1, 'key': token or self.token()}
+
+    def parse_response(self, results):
+        resource = results['resourceSets'][0]['resources'][0]
+        return resource['point']['coordinates'][0], resource['point']['coordinates'][1], self.result_confidence(resource)
+
+    # confidence level, at most medium for results that are not addresses (e.g. a postal code or city)
+    def result_confidence(self, result):
+        if result.get('confidence') not in BING_CONFIDENCE:
+            return None
+        confidence = BING_CONFIDENCE[result['confidence']]
+        return confidence if result.get('entityType', 'Address') == 'Address' else min(confidence, BING_CONFIDENCE['Medium'])
+
+
+# define LocalProvider class
+@register_provider('local')
+class LocalProvider(GeocoderProvider):
+
+    # answers from memory: no rate limit, no http session, nothing worth caching
+    min_interval = 0.0
+    http = False
+    cacheable = False
+
+    # distance column and map markers
+    label = 'Local'
+    map_color = 'purple'
+    map_icon = 'home'
+
+    # constructor
+    def __init__(self, reference_path=None, address_col='Address', lat_col='Latitude', lon_col='Longitude',
+                 min_score=MIN_SCORE):
+        """
+        Offline geocoder matching addresses against a local reference file of address points with an inverted index
+        over normalized street tokens (see local_geocoder.AddressPointIndex). Set the reference file with
+        configure_provider('local', reference_path=...).
+        :param reference_path: reference address points: csv file, or .npz file saved with AddressPointIndex.save
+        :param address_col: csv address field, or a list of fields joined with spaces
+        :param lat_col: csv latitude field
+        :param lon_col: csv longitude field
+        :param min_score: minimum match score between 0 and 1
+        """
+        if reference_path is None:
+            raise ValueError("The local geocoder needs a reference file: configure_provider('local', reference_path=...)")
+
+        if os.path.splitext(reference_path)[1].lower() == '.npz':
+            self.index = AddressPointIndex.load(reference_path)
+        else:
+            self.index = AddressPointIndex.from_csv(reference_path, address_col, lat_col, lon_col)
+        self.min_score = min_score
+
+    ###########
+    # METHODS #
+    ###########
+
+    # the match score is the confidence
+    def geocode(self, address):
+        return self.index.geocode(address, self.min_score)
@@ -0,0 +1,41 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+import threading
+import time
+
+
+# define RateLimiter class
+class RateLimiter:
+
+    # constructor
+    def __init__(self, min_interval=1.0):
+        """
+        Thread-safe rate limiter that spaces out requests to a single geocoding service.
+        :param min_interval: minimum number of seconds between requests
+        """
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    ###########
+    # METHODS #
+    ###########
+
+    # block until the next request is allowed
+    def wait(self):
+        """
+        Block until at least min_interval seconds have passed since the previous request.
+        :return: None
+        """
+        # reserve the next request slot while holding the lock, then sleep outside of it
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.min_interval
+
+        if start > now:
+            time.sleep(start - now)
+
+        return None
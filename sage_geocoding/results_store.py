@@ -0,0 +1,300 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from point_store import PointStore, STATUS_PENDING
+
+import numpy as np
+import os
+import pandas as pd
+import pyarrow as pa
+
+# files of a results store directory
+POINTS_FILE = 'points.arrow'
+DISTANCES_FILE = 'distances.arrow'
+
+# per-service point fields and their types
+POINT_FIELDS = (('latitude', pa.float64()), ('longitude', pa.float64()), ('confidence', pa.float64()), ('status', pa.int8()))
+
+
+# column name of a service's point field
+def point_column(service, field):
+    """
+    Get the name of a service's point field in the points file.
+    :param service: geocoding service name (or 'known')
+    :param field: 'latitude', 'longitude', 'confidence' or 'status'
+    :return: column name
+    """
+    return '{}.{}'.format(service, field)
+
+
+# string array from names or addresses
+def string_array(values):
+    """
+    Convert an object array of names or addresses to an Arrow string array (None and NaN become nulls, other values
+    are converted with str).
+    :param values: numpy array of values
+    :return: pyarrow.StringArray
+    """
+    try:
+        return pa.array(values, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if pd.isna(value) else str(value) for value in values], type=pa.string())
+
+
+# arrow table of a point store
+def points_table(store, services):
+    """
+    Create an Arrow table with the ids, names and addresses of a point store and the coordinates, confidences and
+    statuses of each service.
+    :param store: PointStore
+    :param services: services to include (each must be in the store)
+    :return: pyarrow.Table
+    """
+    fields = [pa.field('id_num', pa.int64()), pa.field('name', pa.string()), pa.field('address', pa.string())]
+    arrays = [pa.array(store.id_num, type=pa.int64()), string_array(store.name), string_array(store.address)]
+    for service in services:
+        values = {'latitude': store.latitude[service], 'longitude': store.longitude[service],
+                  'confidence': store.confidence[service], 'status': store.status[service]}
+        for field, field_type in POINT_FIELDS:
+            fields.append(pa.field(point_column(service, field), field_type))
+            arrays.append(pa.array(values[field], type=field_type))
+
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+# define ResultsWriter class
+class ResultsWriter:
+
+    # constructor
+    def __init__(self, path):
+        """
+        Writes the points and distances files of a results store one table (e.g. one streaming chunk) at a time. Each
+        file is written next to its final path and moved into place on close, so readers never see a partial file.
+        :param path: results store directory
+        """
+        self.path = path
+        self.writers = {}
+
+    ###########
+    # METHODS #
+    ###########
+
+    # append a table to a file
+    def write_table(self, name, table):
+        """
+        Append an Arrow table to a file of the store, opening the file with the first table's schema.
+        :param name: POINTS_FILE or DISTANCES_FILE
+        :param table: pyarrow.Table
+        :return: None
+        """
+        if name not in self.writers:
+            os.makedirs(self.path, exist_ok=True)
+            sink = pa.OSFile(os.path.join(self.path, name + '.tmp'), 'wb')
+            self.writers[name] = (sink, pa.ipc.new_file(sink, table.schema), table.schema)
+        _, writer, schema = self.writers[name]
+        writer.write_table(table.cast(schema))
+
+        return None
+
+    # append points
+    def write_points(self, store, services=None):
+        """
+        Append the rows of a point store to the points file.
+        :param store: PointStore
+        :param services: services to write (default: every service in the store)
+        :return: None
+        """
+        return self.write_table(POINTS_FILE, points_table(store, store.services() if services is None else services))
+
+    # append distances
+    def write_distances(self, distance_table):
+        """
+        Append the rows of a distance table to the distances file.
+        :param distance_table: pandas df with id_num and distance columns (written with their pandas types)
+        :return: None
+        """
+        return self.write_table(DISTANCES_FILE, pa.Table.from_pandas(distance_table, preserve_index=False))
+
+    # finish the files
+    def close(self):
+        """
+        Close the files and move them into place.
+        :return: None
+        """
+        for name, (sink, writer, _) in self.writers.items():
+            writer.close()
+            sink.close()
+            os.replace(os.path.join(self.path, name + '.tmp'), os.path.join(self.path, name))
+        self.writers = {}
+
+        return None
+
+
+# define ResultsStore class
+class ResultsStore:
+
+    # constructor
+    def __init__(self, path):
+        """
+        Typed columnar store of pipeline results, shared between the pipeline stages: a directory with an Arrow IPC file
+        of points (id numbers, names, addresses and, for each service, latitude, longitude, confidence and status
+        columns) and one of distance table columns. Files are memory mapped on read and only the requested columns are
+        loaded, so no text is parsed between stages; the csv and vector files are exports.
+        :param path: results store directory
+        """
+        self.path = path
+
+    ###########
+    # METHODS #
+    ###########
+
+    # path of a file of the store
+    def file_path(self, name):
+        """
+        Get the path of a file of the store.
+        :param name: POINTS_FILE or DISTANCES_FILE
+        :return: file path
+        """
+        return os.path.join(self.path, name)
+
+    # check for written points
+    def exists(self):
+        """
+        Check whether the store has a points file.
+        :return: True or False
+        """
+        return os.path.exists(self.file_path(POINTS_FILE))
+
+    # writer for the store's files
+    def writer(self):
+        """
+        Create a writer that replaces the store's files with tables appended one at a time.
+        :return: ResultsWriter
+        """
+        return ResultsWriter(self.path)
+
+    # write a point store
+    def write_points(self, store, services=None):
+        """
+        Replace the points file with the rows of a point store.
+        :param store: PointStore
+        :param services: services to write (default: every service in the store)
+        :return: None
+        """
+        writer = self.writer()
+        writer.write_points(store, services)
+        writer.close()
+
+        return None
+
+    # write a distance table
+    def write_distances(self, distance_table):
+        """
+        Replace the distances file with a distance table.
+        :param distance_table: pandas df with id_num and distance columns
+        :return: None
+        """
+        writer = self.writer()
+        writer.write_distances(distance_table)
+        writer.close()
+
+        return None
+
+    # memory mapped table
+    def read_table(self, name, columns=None):
+        """
+        Memory map a file of the store and select columns (columns that are not selected are never read from disk).
+        :param name: POINTS_FILE or DISTANCES_FILE
+        :param columns: optional list of column names (default: every column)
+        :return: pyarrow.Table
+        """
+        path = self.file_path(name)
+        if not os.path.exists(path):
+            raise FileNotFoundError('Results store {} has no {}; run the earlier pipeline steps first'.format(self.path, name))
+
+        table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+        return table if columns is None else table.select(columns)
+
+    # column names of a file
+    def columns(self, name):
+        """
+        Get the column names of a file of the store without reading its data.
+        :param name: POINTS_FILE or DISTANCES_FILE
+        :return: list of column names (empty if the file does not exist)
+        """
+        path = self.file_path(name)
+        if not os.path.exists(path):
+            return []
+
+        return pa.ipc.open_file(pa.memory_map(path, 'r')).schema.names
+
+    # services in the points file
+    def services(self):
+        """
+        Get the services (including 'known') with points in the store.
+        :return: list of service names
+        """
+        return [column[:-len('.status')] for column in self.columns(POINTS_FILE) if column.endswith('.status')]
+
+    # read points
+    def read_points(self, services=None, text=True):
+        """
+        Read points into a point store.
+        :param services: services to read (default: every service in the store)
+        :param text: also read names and addresses (without them the store's names and addresses are None)
+        :return: PointStore
+        """
+        if services is None:
+            services = self.services()
+        columns = ['id_num'] + (['name', 'address'] if text else [])
+        columns += [point_column(service, field) for service in services for field, _ in POINT_FIELDS]
+        table = self.read_table(POINTS_FILE, columns)
+
+        # ids, names and addresses
+        id_num = table.column('id_num').to_numpy()
+        if text:
+            name = table.column('name').to_numpy(zero_copy_only=False)
+            address = table.column('address').to_numpy(zero_copy_only=False)
+        else:
+            name = address = np.full(len(id_num), None, dtype=object)
+        store = PointStore(id_num, name, address)
+
+        # coordinates, confidences and statuses (copied, so the store can be updated)
+        for service in services:
+            store.latitude[service] = np.array(table.column(point_column(service, 'latitude')))
+            store.longitude[service] = np.array(table.column(point_column(service, 'longitude')))
+            store.confidence[service] = np.array(table.column(point_column(service, 'confidence')))
+            store.status[service] = np.array(table.column(point_column(service, 'status')))
+
+        return store
+
+    # read distances
+    def read_distances(self, columns=None):
+        """
+        Read distance table columns.
+        :param columns: optional list of column names (default: every column)
+        :return: pandas df
+        """
+        return self.read_table(DISTANCES_FILE, columns).to_pandas()
+
+    # results of a previous run
+    def previous_results(self, services):
+        """
+        Read the results of each service for an incremental run (see incremental.previous_results).
+        :param services: list of geocoding services
+        :return: dictionary of service: pandas df with id_num, name, address, latitude, longitude and confidence (NaN
+        for failed geocodes); services that are not in the store are left out
+        """
+        store = self.read_points([service for service in services if service in self.services()])
+
+        previous = {}
+        for service in store.services():
+            rows = np.flatnonzero(store.status[service] != STATUS_PENDING)
+            previous[service] = pd.DataFrame({'id_num': store.id_num[rows], 'name': store.name[rows],
+                                              'address': store.address[rows], 'latitude': store.latitude[service][rows],
+                                              'longitude': store.longitude[service][rows],
+                                              'confidence': store.confidence[service][rows]})
+
+        return previous
@@ -0,0 +1,353 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from metrics import metrics
+
+import asyncio
+from collections import deque
+import heapq
+import random
+import threading
+import time
+
+# request outcomes worth retrying (see metrics.exception_outcome)
+TRANSIENT_OUTCOMES = ('timeout', 'quota', 'unavailable')
+
+# outcomes that stop every request to the service (no other address can succeed with a rejected key)
+FATAL_OUTCOMES = ('auth',)
+
+# outcomes that are answers about the address, worth caching and journaling; the rest ('error', 'auth' and
+# transient outcomes) are left for the next run
+FINAL_OUTCOMES = ('success', 'failure')
+
+
+# transient or permanent outcome
+def is_transient(outcome):
+    """
+    Check whether a request outcome is a transient error (timeout, quota/rate limit, server unavailable).
+    :param outcome: request outcome
+    :return: True if the request should be retried
+    """
+    return outcome in TRANSIENT_OUTCOMES
+
+
+# error that stops the service
+def is_fatal(outcome):
+    """
+    Check whether a request outcome is a configuration or authentication error that stops the service.
+    :param outcome: request outcome
+    :return: True if no more requests should be sent to the service
+    """
+    return outcome in FATAL_OUTCOMES
+
+
+# answer worth keeping
+def is_final(outcome):
+    """
+    Check whether a request outcome answers the address (a result or no result), so it can be cached and journaled.
+    :param outcome: request outcome
+    :return: True if the outcome is kept between runs
+    """
+    return outcome in FINAL_OUTCOMES
+
+
+# define RetryPolicy class
+class RetryPolicy:
+
+    # constructor
+    def __init__(self, max_retries=4, base_delay=1.0, max_delay=60.0, max_outage=600.0):
+        """
+        Retry settings: jittered exponential backoff between attempts and a limit on how long to wait for a provider
+        whose circuit breaker is open.
+        :param max_retries: retries after the first attempt
+        :param base_delay: backoff before the first retry (seconds, doubled for each retry)
+        :param max_delay: maximum backoff (seconds)
+        :param max_outage: give up on the remaining requests once the provider has been down this long (seconds)
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_outage = max_outage
+
+    ###########
+    # METHODS #
+    ###########
+
+    # backoff before a retry
+    def delay(self, attempt):
+        """
+        Return a random backoff between 0 and base_delay * 2 ** attempt seconds, capped at max_delay ("full jitter", so
+        retries from many requests do not arrive together).
+        :param attempt: number of attempts made so far minus one
+        :return: seconds to wait
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+# define CircuitBreaker class
+class CircuitBreaker:
+
+    # constructor
+    def __init__(self, service, failure_threshold=5, reset_timeout=30.0):
+        """
+        Per-service circuit breaker. After failure_threshold transient errors in a row the circuit opens and no requests
+        are sent for reset_timeout seconds; then a single probe request is allowed (half open). A successful probe closes
+        the circuit, a failed probe opens it again. A configuration or authentication error stops the service for the
+        rest of the run.
+        :param service: geocoding service name
+        :param failure_threshold: consecutive transient errors that open the circuit
+        :param reset_timeout: seconds the circuit stays open before a probe
+        """
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.outage_start = None
+        self.probe_in_flight = False
+
+    ###########
+    # METHODS #
+    ###########
+
+    # permission to send a request
+    def wait_time(self):
+        """
+        Return 0 if a request may be sent now (a half open circuit reserves its probe for the caller), otherwise the
+        seconds to wait before asking again.
+        :return: seconds to wait
+        """
+        with self.lock:
+            if self.state == 'closed':
+                return 0.0
+
+            if self.state == 'open':
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    return remaining
+                self.state = 'half_open'
+
+            # half open: one probe at a time
+            if self.probe_in_flight:
+                return min(1.0, self.reset_timeout)
+            self.probe_in_flight = True
+            return 0.0
+
+    # seconds since the provider went down
+    def outage_seconds(self):
+        """
+        Return how long the circuit has been open or half open (0 while closed).
+        :return: seconds
+        """
+        with self.lock:
+            return 0.0 if self.outage_start is None else time.monotonic() - self.outage_start
+
+    # provider answered
+    def record_success(self):
+        """
+        Record a response from the provider (including 'no result' answers), closing the circuit.
+        :return: None
+        """
+        with self.lock:
+            if self.state == 'stopped':
+                return None
+            self.state = 'closed'
+            self.failures = 0
+            self.outage_start = None
+            self.probe_in_flight = False
+
+        return None
+
+    # provider failed
+    def record_failure(self):
+        """
+        Record a transient error, opening the circuit after failure_threshold errors in a row or a failed probe.
+        :return: None
+        """
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                now = time.monotonic()
+                if self.state == 'closed':
+                    self.outage_start = now
+                    metrics.inc('circuit_breaker_open_total', service=self.service)
+                self.state = 'open'
+                self.opened_at = now
+                self.probe_in_flight = False
+
+        return None
+
+    # configuration or authentication error
+    def stop(self):
+        """
+        Stop sending requests to the service for the rest of the run (e.g. the api key was rejected).
+        :return: None
+        """
+        with self.lock:
+            if self.state != 'stopped':
+                print('Stopping {} geocoding: configuration or authentication error'.format(self.service))
+                metrics.inc('circuit_breaker_stopped_total', service=self.service)
+            self.state = 'stopped'
+            self.probe_in_flight = False
+
+        return None
+
+    # service stopped
+    def is_stopped(self):
+        """
+        Check whether the service was stopped by a configuration or authentication error.
+        :return: True or False
+        """
+        return self.state == 'stopped'
+
+
+# circuit breakers shared by every geocoding pass (one per service)
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+# get the shared circuit breaker for a service
+def get_breaker(service):
+    """
+    Return the circuit breaker for the service, creating it on first use.
+    :param service: geocoding service name
+    :return: CircuitBreaker
+    """
+    with breakers_lock:
+        if service not in breakers:
+            breakers[service] = CircuitBreaker(service)
+
+        return breakers[service]
+
+
+# run requests with retries
+def run_with_retries(items, attempt, service, policy=None, breaker=None, done=None, sleep=time.sleep):
+    """
+    Send one request per item, retrying transient errors from a retry queue with jittered exponential backoff. Items
+    wait in the queue while their backoff runs, so later items are not held up. No requests are sent while the
+    service's circuit breaker is open; once the outage would last longer than policy.max_outage the remaining items are
+    given up with the 'unavailable' outcome. A configuration or authentication error stops the breaker and gives up the
+    remaining items with the 'auth' outcome.
+    :param items: items to process (e.g. row indices)
+    :param attempt: function sending the request for an item and returning its outcome
+    :param service: geocoding service name
+    :param policy: RetryPolicy (default: RetryPolicy())
+    :param breaker: CircuitBreaker (default: get_breaker(service))
+    :param done: optional function called with (item, outcome) as soon as an item's final outcome is known
+    :param sleep: sleep function
+    :return: dictionary of item: final outcome
+    """
+    if policy is None:
+        policy = RetryPolicy()
+    if breaker is None:
+        breaker = get_breaker(service)
+
+    # items ready to send (item, attempt number) and retries waiting for their backoff (ready time, order, item, attempt)
+    queue = deque((item, 0) for item in items)
+    delayed = []
+    order = 0
+    outcomes = {}
+
+    def finish(item, outcome):
+        outcomes[item] = outcome
+        if done is not None:
+            done(item, outcome)
+
+    while queue or delayed:
+        # give up every item once the service is stopped
+        if breaker.is_stopped():
+            for item, _ in queue:
+                finish(item, 'auth')
+            for _, _, item, _ in delayed:
+                finish(item, 'auth')
+            break
+
+        # move retries whose backoff is over to the queue
+        now = time.monotonic()
+        while delayed and delayed[0][0] <= now:
+            _, _, item, tries = heapq.heappop(delayed)
+            queue.append((item, tries))
+        if not queue:
+            sleep(delayed[0][0] - now)
+            continue
+
+        # wait while the circuit is open, give up after a long outage
+        wait = breaker.wait_time()
+        if wait > 0:
+            if breaker.outage_seconds() + wait > policy.max_outage:
+                for item, _ in queue:
+                    finish(item, 'unavailable')
+                for _, _, item, _ in delayed:
+                    finish(item, 'unavailable')
+                break
+            sleep(wait)
+            continue
+
+        # send request
+        item, tries = queue.popleft()
+        outcome = attempt(item)
+        if is_fatal(outcome):
+            breaker.stop()
+        elif is_transient(outcome):
+            breaker.record_failure()
+            if tries < policy.max_retries:
+                metrics.inc('geocode_retries_total', service=service)
+                heapq.heappush(delayed, (time.monotonic() + policy.delay(tries), order, item, tries + 1))
+                order += 1
+                continue
+        else:
+            breaker.record_success()
+        finish(item, outcome)
+
+    return outcomes
+
+
+# run one request with retries in an event loop
+async def retry_async(attempt, service, policy=None, breaker=None):
+    """
+    Asyncio version of run_with_retries for a single item: await attempt() until it returns a final outcome, sleeping
+    for the backoff between tries and while the circuit breaker is open (other items keep running meanwhile).
+    :param attempt: coroutine function sending the request and returning its outcome
+    :param service: geocoding service name
+    :param policy: RetryPolicy (default: RetryPolicy())
+    :param breaker: CircuitBreaker (default: get_breaker(service))
+    :return: final outcome
+    """
+    if policy is None:
+        policy = RetryPolicy()
+    if breaker is None:
+        breaker = get_breaker(service)
+
+    tries = 0
+    while True:
+        if breaker.is_stopped():
+            return 'auth'
+
+        # wait while the circuit is open, give up after a long outage
+        wait = breaker.wait_time()
+        if wait > 0:
+            if breaker.outage_seconds() + wait > policy.max_outage:
+                return 'unavailable'
+            await asyncio.sleep(wait)
+            continue
+
+        # send request
+        outcome = await attempt()
+        if is_fatal(outcome):
+            breaker.stop()
+            return outcome
+        if not is_transient(outcome):
+            breaker.record_success()
+            return outcome
+        breaker.record_failure()
+        if tries >= policy.max_retries:
+            return outcome
+
+        # back off before the next try
+        metrics.inc('geocode_retries_total', service=service)
+        await asyncio.sleep(policy.delay(tries))
+        tries += 1
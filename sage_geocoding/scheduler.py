@@ -0,0 +1,346 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from metrics import STAGE_BUCKETS, metrics
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import hashlib
+import json
+import os
+import pickle
+import time
+import numpy as np
+import pandas as pd
+
+
+# define StageResult class
+class StageResult:
+
+    # constructor
+    def __init__(self, stage):
+        """
+        Placeholder for the return value of another stage, used in a stage's args or kwargs. The stage runs after the
+        stage it refers to.
+        :param stage: stage name
+        """
+        self.stage = stage
+
+
+# define Stage class
+class Stage:
+
+    # constructor
+    def __init__(self, name, func, args=(), kwargs=None, inputs=(), outputs=()):
+        """
+        A pipeline stage: a call of func with args and kwargs that reads the input files and writes the output files.
+        func must be a module level function (stages run in worker processes).
+        :param name: unique stage name
+        :param func: function to call
+        :param args: positional arguments (may contain StageResult placeholders)
+        :param kwargs: keyword arguments (may contain StageResult placeholders)
+        :param inputs: files read by the stage (a stage that writes one of them runs first)
+        :param outputs: files written by the stage
+        """
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    ###########
+    # METHODS #
+    ###########
+
+    # stages whose results are arguments of this stage
+    def result_dependencies(self):
+        """
+        Return the names of the stages referenced by StageResult placeholders in args and kwargs.
+        :return: list of stage names
+        """
+        names = []
+        find_results(self.args, names)
+        find_results(self.kwargs, names)
+
+        return names
+
+
+# StageResult placeholders in a value
+def find_results(value, names):
+    """
+    Collect the stage names of StageResult placeholders in a value (searching tuples, lists and dicts).
+    :param value: argument value
+    :param names: list of stage names, updated in place
+    :return: None
+    """
+    if isinstance(value, StageResult):
+        names.append(value.stage)
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            find_results(item, names)
+    elif isinstance(value, dict):
+        for item in value.values():
+            find_results(item, names)
+
+    return None
+
+
+# replace StageResult placeholders with results
+def resolve_results(value, results):
+    """
+    Replace StageResult placeholders in a value with the results of their stages.
+    :param value: argument value
+    :param results: dictionary of stage name: result
+    :return: value with results
+    """
+    if isinstance(value, StageResult):
+        return results[value.stage]
+    if isinstance(value, tuple):
+        return tuple(resolve_results(item, results) for item in value)
+    if isinstance(value, list):
+        return [resolve_results(item, results) for item in value]
+    if isinstance(value, dict):
+        return {key: resolve_results(item, results) for key, item in value.items()}
+
+    return value
+
+
+# hash of a file's contents
+def file_digest(path, block_size=1 << 20):
+    """
+    Return the sha256 digest of a file's contents.
+    :param path: file path
+    :param block_size: bytes read at a time
+    :return: hex digest, None if the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+# hash of a value's contents
+def value_digest(value, fingerprints, memo):
+    """
+    Return a digest of an argument value: scalars by repr, numpy arrays and pandas objects by content, containers and
+    plain objects (e.g. PointStore) by their items or attributes, StageResult placeholders by the fingerprint of their
+    stage, anything else by its pickle.
+    :param value: argument value
+    :param fingerprints: dictionary of stage name: fingerprint
+    :param memo: dictionary of id(value): digest for large values already hashed
+    :return: hex digest
+    """
+    if isinstance(value, StageResult):
+        return 'stage:' + fingerprints[value.stage]
+    if value is None or isinstance(value, (str, bytes, bool, int, float)):
+        return repr(value)
+    if id(value) in memo:
+        return memo[id(value)]
+
+    digest = hashlib.sha256(type(value).__name__.encode('utf-8'))
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(repr(list(value.columns) if isinstance(value, pd.DataFrame) else value.name).encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(value).to_numpy().tobytes())
+    elif isinstance(value, np.ndarray):
+        digest.update('{}{}'.format(value.dtype.str, value.shape).encode('utf-8'))
+        if value.dtype == object:
+            digest.update(pd.util.hash_array(value.ravel()).tobytes())
+        else:
+            digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            digest.update(value_digest(item, fingerprints, memo).encode('utf-8'))
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            digest.update(repr(key).encode('utf-8'))
+            digest.update(value_digest(item, fingerprints, memo).encode('utf-8'))
+    elif hasattr(value, '__dict__'):
+        digest.update(value_digest(vars(value), fingerprints, memo).encode('utf-8'))
+    else:
+        digest.update(pickle.dumps(value))
+
+    memo[id(value)] = digest.hexdigest()
+
+    return memo[id(value)]
+
+
+# call a stage function
+def call_stage(func, args, kwargs):
+    """
+    Call a stage function and time it (runs in a worker process).
+    :param func: stage function
+    :param args: positional arguments
+    :param kwargs: keyword arguments
+    :return: return value of func, wall time in seconds
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+
+    return result, time.perf_counter() - start
+
+
+# order stages so each stage comes after the stages it depends on
+def stage_order(stages):
+    """
+    Find the dependencies of each stage (StageResult placeholders and input files written by other stages) and sort
+    the stages topologically.
+    :param stages: list of Stage objects
+    :return: list of stage names in run order, dictionary of stage name: set of stage names it depends on
+    """
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError('Stage names must be unique')
+
+    # stage writing each output file
+    producers = {}
+    for stage in stages:
+        for path in stage.outputs:
+            producers[os.path.abspath(path)] = stage.name
+
+    # dependencies of each stage
+    dependencies = {}
+    for stage in stages:
+        dependencies[stage.name] = set(stage.result_dependencies())
+        for path in stage.inputs:
+            if os.path.abspath(path) in producers:
+                dependencies[stage.name].add(producers[os.path.abspath(path)])
+        dependencies[stage.name].discard(stage.name)
+        unknown = dependencies[stage.name].difference(names)
+        if unknown:
+            raise ValueError('Stage {} depends on unknown stages: {}'.format(stage.name, ', '.join(sorted(unknown))))
+
+    # topological sort, keeping the declared order among independent stages
+    order = []
+    done = set()
+    while len(order) < len(stages):
+        ready = [name for name in names if name not in done and dependencies[name] <= done]
+        if not ready:
+            raise ValueError('Stage dependencies contain a cycle: {}'.format(', '.join(name for name in names if name not in done)))
+        order.extend(ready)
+        done.update(ready)
+
+    return order, dependencies
+
+
+# run a DAG of stages
+def run_stages(stages, state_path=None, workers=None, force=False):
+    """
+    Run pipeline stages on a process pool, starting each stage as soon as the stages it depends on have finished, so
+    independent stages run at the same time.
+
+    Each stage has a fingerprint computed from its function, arguments and input files; a placeholder or input file
+    produced by another stage contributes that stage's fingerprint. With a state file, a stage is skipped when its
+    fingerprint matches the last successful run and its output files exist. Results that later stages need are saved
+    next to the state file, so a skipped stage's result can be loaded instead of computed.
+    :param stages: list of Stage objects
+    :param state_path: optional path to save stage fingerprints (JSON), None runs every stage
+    :param workers: number of worker processes (default: number of cpus), 1 runs the stages in this process
+    :param force: run every stage even if it is up to date
+    :return: dictionary of stage name: result for stages that were run or whose results were loaded
+    """
+    by_name = {stage.name: stage for stage in stages}
+    order, dependencies = stage_order(stages)
+
+    # stages that use each stage's result
+    consumers = {name: [other for other in order if name in by_name[other].result_dependencies()] for name in order}
+
+    # saved fingerprints and results
+    state = {}
+    if state_path is not None and os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    results_dir = None if state_path is None else os.path.splitext(state_path)[0] + '_results'
+
+    def result_path(name):
+        return os.path.join(results_dir, '{}.pkl'.format(name))
+
+    # stage writing each output file
+    producers = {os.path.abspath(path): stage.name for stage in stages for path in stage.outputs}
+
+    # fingerprint of every stage, in dependency order
+    fingerprints = {}
+    memo = {}
+    for name in order:
+        stage = by_name[name]
+        digest = hashlib.sha256('{}.{}'.format(stage.func.__module__, stage.func.__qualname__).encode('utf-8'))
+        digest.update(value_digest(stage.args, fingerprints, memo).encode('utf-8'))
+        digest.update(value_digest(stage.kwargs, fingerprints, memo).encode('utf-8'))
+        for path in stage.inputs:
+            producer = producers.get(os.path.abspath(path))
+            digest.update((fingerprints[producer] if producer not in (None, name) else str(file_digest(path))).encode('utf-8'))
+        fingerprints[name] = digest.hexdigest()
+
+    # stages to run: changed fingerprint, missing output file or missing saved result
+    def up_to_date(name):
+        stage = by_name[name]
+        return (not force and state_path is not None and state.get(name) == fingerprints[name]
+                and all(os.path.exists(path) for path in stage.outputs)
+                and (not consumers[name] or os.path.exists(result_path(name))))
+
+    to_run = [name for name in order if not up_to_date(name)]
+    for name in order:
+        if name not in to_run:
+            metrics.inc('stage_skipped_total', stage=name)
+            print('Stage {} is up to date, skipped'.format(name))
+
+    # results of finished stages (saved results of skipped stages are loaded when a running stage needs them)
+    results = {}
+
+    def arguments(stage):
+        for dep in stage.result_dependencies():
+            if dep not in results:
+                with open(result_path(dep), 'rb') as f:
+                    results[dep] = pickle.load(f)
+        return resolve_results(stage.args, results), resolve_results(stage.kwargs, results)
+
+    def finish(name, result, seconds):
+        results[name] = result
+        metrics.observe('stage_seconds', seconds, STAGE_BUCKETS, stage=name)
+        print('Stage {} finished in {:.1f} s'.format(name, seconds))
+
+        # save result for later stages and the stage's fingerprint
+        if state_path is None:
+            return
+        if consumers[name]:
+            os.makedirs(results_dir, exist_ok=True)
+            with open(result_path(name), 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        state[name] = fingerprints[name]
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(state_path + '.tmp', state_path)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # run in this process
+    if workers == 1 or len(to_run) <= 1:
+        for name in to_run:
+            args, kwargs = arguments(by_name[name])
+            finish(name, *call_stage(by_name[name].func, args, kwargs))
+        return results
+
+    # run on a process pool, submitting each stage once its dependencies have finished
+    done = set(order).difference(to_run)
+    waiting = list(to_run)
+    running = {}
+    with ProcessPoolExecutor(max_workers=min(workers, len(to_run))) as executor:
+        while waiting or running:
+            for name in [name for name in waiting if dependencies[name] <= done]:
+                args, kwargs = arguments(by_name[name])
+                running[executor.submit(call_stage, by_name[name].func, args, kwargs)] = name
+                waiting.remove(name)
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                finish(name, *future.result())
+                done.add(name)
+
+    return results
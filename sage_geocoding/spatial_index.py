@@ -0,0 +1,138 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from geodesic import geodesic_distance_feet
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# WGS84 ellipsoid: semi-major axis (feet) and first eccentricity squared
+WGS84_A_FEET = 6378137.0 / 0.3048
+WGS84_E2 = 6.69437999014e-3
+
+
+# earth-centered, earth-fixed coordinates
+def ecef_feet(latitude, longitude):
+    """
+    Convert latitudes and longitudes to 3D earth-centered coordinates on the WGS84 ellipsoid, in feet. The straight-line
+    distance between two points is never longer than the geodesic distance and, at the scale of a county, differs from
+    it by a tiny fraction of a foot, so a KD-tree on these coordinates gives geodesic neighbours anywhere on the globe.
+    :param latitude: numpy array of latitudes
+    :param longitude: numpy array of longitudes
+    :return: numpy array of shape (n, 3)
+    """
+    lat = np.radians(latitude)
+    lon = np.radians(longitude)
+    n = WGS84_A_FEET / np.sqrt(1 - WGS84_E2 * np.sin(lat) ** 2)
+
+    return np.column_stack([n * np.cos(lat) * np.cos(lon), n * np.cos(lat) * np.sin(lon), n * (1 - WGS84_E2) * np.sin(lat)])
+
+
+# define KnownSiteIndex class
+class KnownSiteIndex:
+
+    # constructor
+    def __init__(self, id_num, latitude, longitude):
+        """
+        KD-tree over known site locations that answers nearest-site and radius queries for many points at once.
+        Candidates are found by straight-line distance between earth-centered coordinates and reported with geodesic
+        distances in feet.
+        :param id_num: array of known site id numbers
+        :param latitude: array of known latitudes (rows with NaN coordinates are left out)
+        :param longitude: array of known longitudes
+        """
+        latitude = np.asarray(latitude, dtype='float64')
+        longitude = np.asarray(longitude, dtype='float64')
+        valid = ~(np.isnan(latitude) | np.isnan(longitude))
+
+        self.id_num = np.asarray(id_num, dtype='int64')[valid]
+        self.latitude = latitude[valid]
+        self.longitude = longitude[valid]
+        self.tree = cKDTree(ecef_feet(self.latitude, self.longitude))
+
+    # create an index from a point store
+    @classmethod
+    def from_store(cls, store, service='known'):
+        """
+        Create an index over the points of the store that have coordinates for the service.
+        :param store: PointStore
+        :param service: service with the site coordinates (default: 'known')
+        :return: KnownSiteIndex
+        """
+        return cls(store.id_num, store.latitude[service], store.longitude[service])
+
+    def __len__(self):
+        return len(self.id_num)
+
+    ###########
+    # METHODS #
+    ###########
+
+    # k nearest known sites
+    def nearest(self, latitude, longitude, k=1):
+        """
+        Find the k nearest known sites of each point.
+        :param latitude: numpy array of latitudes (NaN for points without coordinates)
+        :param longitude: numpy array of longitudes
+        :param k: number of neighbours
+        :return: numpy array of distances in feet (n, k), numpy array of site id numbers (n, k); NaN distance and id -1
+        where a point has no coordinates or there are fewer than k sites
+        """
+        latitude = np.asarray(latitude, dtype='float64')
+        longitude = np.asarray(longitude, dtype='float64')
+        distance = np.full((len(latitude), k), np.nan)
+        id_num = np.full((len(latitude), k), -1, dtype='int64')
+
+        valid = np.flatnonzero(~(np.isnan(latitude) | np.isnan(longitude)))
+        if len(valid) == 0 or len(self) == 0:
+            return distance, id_num
+
+        # candidates by straight-line distance (missing neighbours have index len(self))
+        _, index = self.tree.query(ecef_feet(latitude[valid], longitude[valid]), k=k)
+        index = index.reshape(len(valid), k)
+        found = index < len(self)
+
+        # geodesic distances for every candidate
+        rows = np.repeat(valid, k).reshape(len(valid), k)
+        site = np.where(found, index, 0)
+        feet = geodesic_distance_feet(latitude[rows], longitude[rows], self.latitude[site], self.longitude[site])
+        feet = np.where(found, feet, np.nan)
+
+        # order each point's neighbours by geodesic distance (missing neighbours last)
+        order = np.argsort(np.where(found, feet, np.inf), axis=1)
+        distance[valid] = np.take_along_axis(feet, order, axis=1)
+        id_num[valid] = np.where(np.take_along_axis(found, order, axis=1), self.id_num[np.take_along_axis(site, order, axis=1)], -1)
+
+        return distance, id_num
+
+    # known sites within a radius
+    def within(self, latitude, longitude, radius_feet):
+        """
+        Find every known site within radius_feet of each point.
+        :param latitude: numpy array of latitudes (NaN for points without coordinates)
+        :param longitude: numpy array of longitudes
+        :param radius_feet: search radius in feet
+        :return: numpy array of point positions, numpy array of site id numbers, numpy array of distances in feet (one
+        entry per point/site pair within the radius)
+        """
+        latitude = np.asarray(latitude, dtype='float64')
+        longitude = np.asarray(longitude, dtype='float64')
+
+        valid = np.flatnonzero(~(np.isnan(latitude) | np.isnan(longitude)))
+        if len(valid) == 0 or len(self) == 0:
+            return np.empty(0, dtype='int64'), np.empty(0, dtype='int64'), np.empty(0)
+
+        # candidates within the straight-line radius (a superset of the sites within the geodesic radius)
+        candidates = self.tree.query_ball_point(ecef_feet(latitude[valid], longitude[valid]), radius_feet)
+
+        # flatten to point/site pairs
+        counts = np.array([len(c) for c in candidates], dtype='int64')
+        rows = np.repeat(valid, counts)
+        site = np.concatenate([np.asarray(c, dtype='int64') for c in candidates]) if counts.sum() else np.empty(0, dtype='int64')
+
+        # keep pairs within the geodesic radius
+        feet = geodesic_distance_feet(latitude[rows], longitude[rows], self.latitude[site], self.longitude[site])
+        keep = feet <= radius_feet
+
+        return rows[keep], self.id_num[site[keep]], feet[keep]
@@ -0,0 +1,166 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from distance_stats import DistanceStatistics
+from incremental import restore_previous_results
+from metrics import metrics
+from point_store import STATUS_FAILED
+from results_store import ResultsStore
+from spatial_index import KnownSiteIndex
+from utility import CASCADE_AGREE_FEET, \
+    CASCADE_MIN_CONFIDENCE, \
+    generate_id_nums, \
+    create_points_known_coords, \
+    geocode_services, \
+    result_services, \
+    output_geocode_results_csv, \
+    output_geocode_results_vector, \
+    create_distance_table, \
+    distance_column
+
+import numpy as np
+import os
+import pandas as pd
+
+
+# check that the vector output can be written chunk by chunk
+def check_streaming_vector_format(shp_out):
+    """
+    Raise an error for vector formats that cannot be appended to (FlatGeobuf), so a streaming run fails before any
+    address is geocoded rather than when the second chunk is written.
+    :param shp_out: vector file path with {} for the service name
+    :return: None
+    """
+    if os.path.splitext(shp_out)[1].lower() == '.fgb':
+        raise ValueError('FlatGeobuf files cannot be appended to, use .shp or .gpkg for streaming runs: {}'.format(shp_out))
+
+    return None
+
+
+# build a known site index from the whole input file
+def known_site_index(csv_in, name_col='Name ', address_col='Address', lat_col='Latitude', lon_col='Longitude',
+                     chunk_size=10000):
+    """
+    Read the id fields and known coordinates of the address csv in chunks and index every known site, so nearest site
+    queries for a chunk also find sites in other chunks.
+    :param csv_in: path to csv with address info
+    :param name_col: name field
+    :param address_col: address field
+    :param lat_col: known latitude field
+    :param lon_col: known longitude field
+    :param chunk_size: number of rows per chunk
+    :return: KnownSiteIndex
+    """
+    seen = {}
+    id_num, latitude, longitude = [], [], []
+    for chunk in pd.read_csv(csv_in, chunksize=chunk_size, usecols=[name_col, address_col, lat_col, lon_col]):
+        chunk = chunk.reset_index(drop=True)
+        id_num.append(generate_id_nums(chunk, name_col, address_col, seen))
+        latitude.append(pd.to_numeric(chunk[lat_col], errors='coerce').to_numpy(dtype='float64'))
+        longitude.append(pd.to_numeric(chunk[lon_col], errors='coerce').to_numpy(dtype='float64'))
+
+    return KnownSiteIndex(np.concatenate(id_num), np.concatenate(latitude), np.concatenate(longitude))
+
+
+# run the geocoding pipeline one chunk of the input file at a time
+def run_streaming_pipeline(csv_in, gc_services, csv_out, csv_out2, shp_out, dist_out, stats_out, name_col='Name ',
+                           address_col='Address', lat_col='Latitude', lon_col='Longitude', chunk_size=10000,
+                           geocode_mode='threads', cache=None, batch_size=None, journal=None, nearest_k=None,
+                           site_radius_feet=None, previous=None, min_confidence=CASCADE_MIN_CONFIDENCE,
+                           agree_feet=CASCADE_AGREE_FEET, results_dir=None):
+    """
+    Read the address csv in chunks and run each chunk through the pipeline (ids, geocoding, distances), appending to the
+    results store, results csv files, shapefiles and distance table. Only one chunk is held in memory at a time; distance statistics
+    are accumulated across chunks and saved at the end.
+    :param csv_in: path to csv with address info
+    :param gc_services: list of geocoding services
+    :param csv_out: results csv path with {} for the service name
+    :param csv_out2: fails csv path with {} for the service name
+    :param shp_out: shapefile path with {} for the service name
+    :param dist_out: path to save distance table as CSV
+    :param stats_out: path to save statistics table as CSV
+    :param name_col: name field
+    :param address_col: address field
+    :param lat_col: known latitude field
+    :param lon_col: known longitude field
+    :param chunk_size: number of rows per chunk
+    :param geocode_mode: 'sequential', 'threads', 'async' or 'cascade' (see geocode_services)
+    :param cache: optional GeocodeCache shared by all services
+    :param batch_size: if set, services with a batch endpoint submit chunks of batch_size addresses
+    :param journal: optional GeocodeJournal; journaled outcomes are restored and only pending rows are geocoded
+    :param nearest_k: if set, add the nearest_k known sites of each geocoded point to the distance table (known sites
+    are indexed from the whole file in a first pass)
+    :param site_radius_feet: if set with nearest_k, also add the number of known sites within this radius
+    :param previous: optional results of the previous run (see incremental.previous_results); rows with a previous
+    result are not geocoded again
+    :param min_confidence: cascade mode: match confidence at which a result is accepted
+    :param agree_feet: cascade mode: distance in feet within which two services' results agree
+    :param results_dir: optional ResultsStore directory; the points and distances of each chunk are appended to it
+    :return: statistics table
+    """
+    check_streaming_vector_format(shp_out)
+
+    # known sites of the whole file
+    site_index = None
+    if nearest_k is not None:
+        site_index = known_site_index(csv_in, name_col, address_col, lat_col, lon_col, chunk_size)
+
+    # running distance statistics
+    services = result_services(gc_services, geocode_mode)
+    stats = DistanceStatistics([distance_column(service) for service in services])
+
+    # results store files are written chunk by chunk and moved into place at the end
+    results = None if results_dir is None else ResultsStore(results_dir).writer()
+
+    # name/address counts from earlier chunks keep ids unique across chunks
+    seen = {}
+
+    # process each chunk, the first chunk overwrites existing output files
+    append = False
+    for chunk in pd.read_csv(csv_in, chunksize=chunk_size):
+        # add stable ids
+        chunk = chunk.reset_index(drop=True)
+        chunk['id_num'] = generate_id_nums(chunk, name_col, address_col, seen)
+
+        # known coordinates
+        with metrics.stage('create_points_known_coords'):
+            store = create_points_known_coords(chunk, name_col, address_col, lat_col, lon_col)
+        if previous is not None:
+            restore_previous_results(store, previous)
+        with metrics.stage('output_known'):
+            output_geocode_results_csv(store, 'known', csv_out.format('known'), append=append)
+            output_geocode_results_vector(store, 'known', shp_out.format('known'), append=append)
+
+        # geocode chunk and output results
+        with metrics.stage('geocode_services'):
+            store = geocode_services(store, gc_services, geocode_mode, cache, batch_size, journal, min_confidence, agree_feet)
+        with metrics.stage('output_geocode_results'):
+            for service in services:
+                output_geocode_results_csv(store, service, csv_out.format(service), append=append)
+                output_geocode_results_csv(store, service, csv_out2.format(service), status=STATUS_FAILED, append=append)
+                output_geocode_results_vector(store, service, shp_out.format(service), append=append)
+
+        # distances for the chunk
+        with metrics.stage('create_distance_table'):
+            dist = create_distance_table(chunk, store, dist_out, append=append, site_index=site_index, k=nearest_k,
+                                         radius_feet=site_radius_feet)
+        with metrics.stage('calc_distance_statistics'):
+            stats.update(dist)
+
+        # points and distance columns for the results store
+        if results is not None:
+            with metrics.stage('write_results_store'):
+                results.write_points(store, ['known'] + services)
+                results.write_distances(dist[['id_num'] + [col for col in dist.columns if col not in chunk.columns]])
+
+        append = True
+
+    if results is not None:
+        results.close()
+
+    # save statistics table
+    table = stats.table()
+    table.to_csv(stats_out, index=False)
+
+    return table
@@ -0,0 +1,271 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from normalize import canonical_address
+
+from aiohttp import web
+import argparse
+import asyncio
+import json
+import random
+import threading
+import zlib
+
+# area covered by stub results (San Diego County)
+STUB_BOUNDS = (32.55, -117.30, 33.25, -116.10)
+
+# match quality of stub results: share of results (drawn per service and address) and offset in degrees from the
+# address location
+STUB_QUALITIES = (('rooftop', 0.7, 0.0), ('interpolated', 0.2, 0.0002), ('approximate', 0.1, 0.01))
+
+# how each service reports a match quality
+NOMINATIM_CLASSES = {'rooftop': ('place', 'house'), 'interpolated': ('highway', 'residential'), 'approximate': ('boundary', 'postal_code')}
+GOOGLE_TYPES = {'rooftop': 'ROOFTOP', 'interpolated': 'RANGE_INTERPOLATED', 'approximate': 'APPROXIMATE'}
+BING_LEVELS = {'rooftop': ('High', 'Address'), 'interpolated': ('Medium', 'Address'), 'approximate': ('Low', 'Postcode1')}
+ARCGIS_SCORES = {'rooftop': 100, 'interpolated': 88, 'approximate': 71}
+
+
+# deterministic location for an address key
+def key_location(key):
+    """
+    Return the stub location for a canonical address key.
+    :param key: canonical address string
+    :return: latitude, longitude
+    """
+    h = zlib.crc32(key.encode('utf-8'))
+    min_lat, min_lon, max_lat, max_lon = STUB_BOUNDS
+
+    return min_lat + (h & 0xffff) / 0xffff * (max_lat - min_lat), min_lon + (h >> 16) / 0xffff * (max_lon - min_lon)
+
+
+# deterministic location for an address
+def stub_location(address):
+    """
+    Return the location of an address on the stub server, reported by rooftop results (variants of the same address,
+    e.g. 'Street' and 'St.', get the same location).
+    :param address: address string
+    :return: latitude, longitude
+    """
+    return key_location(canonical_address(address))
+
+
+# deterministic result of a service for an address
+def stub_result(service, address):
+    """
+    Return the result a stub service reports for an address: most results are at the address location, some are
+    interpolated (a few feet off) or approximate (thousands of feet off). Each service draws its own match quality.
+    :param service: geocoding service name
+    :param address: address string
+    :return: latitude, longitude, match quality ('rooftop', 'interpolated' or 'approximate')
+    """
+    key = canonical_address(address)
+    lat, lon = key_location(key)
+    draw = zlib.crc32('{}|{}'.format(service, key).encode('utf-8')) / 0xffffffff
+    for quality, share, offset in STUB_QUALITIES:
+        if draw < share:
+            break
+        draw -= share
+
+    return lat + offset, lon - offset, quality
+
+
+# define StubGeocoderServer class
+class StubGeocoderServer:
+
+    # constructor
+    def __init__(self, latency=0.0, error_rate=0.0, host='127.0.0.1', port=0, seed=None, fail_first=0):
+        """
+        Local http server answering Nominatim, Google, Bing and ArcGIS geocoding requests with fake results, so the
+        pipeline can be run and benchmarked without calling paid services. Point the async engine (base_url) or the
+        batch functions (url) at base_url. GET /stats reports the number of requests answered. Run the module as a
+        script to serve from a separate process.
+        :param latency: seconds each response is delayed
+        :param error_rate: fraction of requests answered with an HTTP 500 error
+        :param host: host to listen on
+        :param port: port to listen on (0 picks a free port)
+        :param seed: random seed for errors
+        :param fail_first: number of first requests answered with an HTTP 500 error (e.g. to test retries)
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.fail_first = fail_first
+
+        # request counter, requests being answered (and the most at once) and client connections (address, port)
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.connections = set()
+
+        self.loop = None
+        self.runner = None
+        self.thread = None
+
+    ###########
+    # METHODS #
+    ###########
+
+    # base url of the running server
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    # count a request while it is answered
+    @web.middleware
+    async def track(self, request, handler):
+        """
+        Count requests in flight and the client connections they arrive on (a client with a keep-alive session sends
+        many requests on each connection).
+        :param request: aiohttp request
+        :param handler: route handler
+        :return: aiohttp response
+        """
+        self.connections.add(request.transport.get_extra_info('peername'))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+
+    # handle a single address request
+    async def handle(self, request):
+        """
+        Answer a geocoding request in the format of the service selected by the request path.
+        :param request: aiohttp request
+        :return: aiohttp json response
+        """
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.requests <= self.fail_first or (self.error_rate and self.random.random() < self.error_rate):
+            return web.json_response({'error': 'stub error'}, status=500)
+
+        path = request.path
+        query = request.query
+        if path == '/search':
+            lat, lon, quality = stub_result('nominatim', query.get('q'))
+            result_class, result_type = NOMINATIM_CLASSES[quality]
+            return web.json_response([{'lat': str(lat), 'lon': str(lon), 'class': result_class, 'type': result_type}])
+        if path == '/maps/api/geocode/json':
+            lat, lon, quality = stub_result('google', query.get('address'))
+            return web.json_response({'status': 'OK', 'results': [{'geometry': {'location': {'lat': lat, 'lng': lon},
+                                                                                'location_type': GOOGLE_TYPES[quality]}}]})
+        if path == '/REST/v1/Locations':
+            lat, lon, quality = stub_result('bing', query.get('query'))
+            confidence, entity_type = BING_LEVELS[quality]
+            return web.json_response({'resourceSets': [{'resources': [{'point': {'coordinates': [lat, lon]}, 'confidence': confidence,
+                                                                       'entityType': entity_type}]}]})
+        if path.endswith('/findAddressCandidates'):
+            lat, lon, quality = stub_result('arcgis', query.get('singleLine'))
+            return web.json_response({'candidates': [{'location': {'y': lat, 'x': lon}, 'score': ARCGIS_SCORES[quality]}]})
+
+        return web.json_response({'error': 'unknown endpoint'}, status=404)
+
+    # report request count
+    async def handle_stats(self, request):
+        """
+        Report the number of geocoding requests answered so far.
+        :param request: aiohttp request
+        :return: aiohttp json response
+        """
+        return web.json_response({'requests': self.requests})
+
+    # handle an ArcGIS geocodeAddresses batch request
+    async def handle_batch(self, request):
+        """
+        Answer an ArcGIS geocodeAddresses request with a match for every record.
+        :param request: aiohttp request
+        :return: aiohttp json response
+        """
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.requests <= self.fail_first or (self.error_rate and self.random.random() < self.error_rate):
+            return web.json_response({'error': 'stub error'}, status=500)
+
+        data = await request.post()
+        locations = []
+        for record in json.loads(data['addresses'])['records']:
+            lat, lon, quality = stub_result('arcgis', record['attributes']['SingleLine'])
+            locations.append({'location': {'x': lon, 'y': lat},
+                              'attributes': {'ResultID': record['attributes']['OBJECTID'], 'Status': 'M',
+                                             'Score': ARCGIS_SCORES[quality]}})
+
+        return web.json_response({'locations': locations})
+
+    # web application
+    def app(self):
+        """
+        Create the aiohttp application with the stub routes.
+        :return: aiohttp web application
+        """
+        app = web.Application(middlewares=[self.track])
+        app.router.add_post('/arcgis/rest/services/World/GeocodeServer/geocodeAddresses', self.handle_batch)
+        app.router.add_get('/stats', self.handle_stats)
+        app.router.add_get('/{tail:.*}', self.handle)
+
+        return app
+
+    # start server in a background thread
+    def start(self):
+        """
+        Start the server in a daemon thread with its own event loop.
+        :return: base url of the server
+        """
+        started = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.runner = web.AppRunner(self.app(), access_log=None)
+            self.loop.run_until_complete(self.runner.setup())
+            site = web.TCPSite(self.runner, self.host, self.port)
+            self.loop.run_until_complete(site.start())
+            self.port = self.runner.addresses[0][1]
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.runner.cleanup())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+
+        return self.base_url
+
+    # stop server
+    def stop(self):
+        """
+        Stop the server and wait for its thread to finish.
+        :return: None
+        """
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+
+        return None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local stub geocoding server.')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds each response is delayed')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with an error')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for errors')
+    parser.add_argument('--fail-first', type=int, default=0, help='number of first requests answered with an error')
+    args = parser.parse_args()
+
+    server = StubGeocoderServer(args.latency, args.error_rate, port=args.port, seed=args.seed, fail_first=args.fail_first)
+    web.run_app(server.app(), host=server.host, port=server.port, print=None)
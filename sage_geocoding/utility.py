@@ -2,183 +2,556 @@
 # Jessica Embury
 
 # import statements
-from point import Point
-
-import folium
-import geopandas as gpd
-import matplotlib.pyplot as plt
+from batch_geocoder import BATCH_SERVICES, geocode_points_batch
+from distance_stats import DistanceStatistics, queried_column
+from geodesic import geodesic_distance_feet
+from normalize import normalize_series
+from metrics import metrics
+from point_store import PointStore, STATUS_OK, STATUS_PENDING, point_results
+from providers import PROVIDERS, available_providers, get_provider
+from ratelimit import RateLimiter
+from retry import is_final, run_with_retries
+
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from itertools import cycle, repeat
+
+import numpy as np
 import os
-from osgeo import ogr
-from osgeo import osr
 import pandas as pd
-import random
-import seaborn as sns
-import time
+
+# the asyncio engine (aiohttp), GDAL/OGR, matplotlib/seaborn and folium are imported by the functions that use them, so
+# geocoding, distance and statistics jobs (and stage worker processes) start without loading them
 
 # ignore pandas dataframe slice warning
 pd.options.mode.chained_assignment = None  # default='warn'
 
+# cascade geocoding: service name of the chosen results, confidence at which a result is accepted without asking more
+# services and distance within which two services' results agree
+CASCADE_SERVICE = 'cascade'
+CASCADE_MIN_CONFIDENCE = 0.9
+CASCADE_AGREE_FEET = 250
+
+# OGR driver for each vector output file extension
+VECTOR_DRIVERS = {'.shp': 'ESRI Shapefile', '.gpkg': 'GPKG', '.fgb': 'FlatGeobuf'}
+
+# css colors for folium marker colors that are not css color names
+MARKER_CSS_COLORS = {'darkpurple': '#5b396b', 'cadetblue': '#436978', 'lightred': '#ff8e7f'}
+
+# distance column label, map marker color and icon of result services that are not providers
+RESULT_STYLES = {'cascade': ('Cascade', 'cadetblue', 'ok')}
+
+# map marker color and icon of providers that do not set their own
+DEFAULT_MAP_COLOR = 'gray'
+DEFAULT_MAP_ICON = 'map-marker'
+
+# plot color of each built in distance column, and colors given in turn to other distance columns
+PLOT_COLORS = {'Nominatim': 'darkorange', 'Google': 'lawngreen', 'ArcGIS': 'red', 'Bing': 'deepskyblue', 'Local': 'orchid',
+               'Cascade': 'gold'}
+EXTRA_PLOT_COLORS = ['teal', 'sienna', 'slategray', 'olive', 'navy', 'magenta']
+
+
+# distance column label and map style of a service
+def service_style(service):
+    """
+    Get the distance column label and map marker style of a geocoding service: the provider's label, map_color and
+    map_icon, or the title cased service name and the default style for providers that do not set them.
+    :param service: geocoding service name (a registered provider or 'cascade')
+    :return: distance column label, marker color, marker icon
+    """
+    if service in RESULT_STYLES:
+        return RESULT_STYLES[service]
+
+    provider = PROVIDERS.get(service)
+    return (getattr(provider, 'label', None) or service.title(), getattr(provider, 'map_color', None) or DEFAULT_MAP_COLOR,
+            getattr(provider, 'map_icon', None) or DEFAULT_MAP_ICON)
 
-# generate random id numbers for Point objects
-def generate_id_nums(quantity=None, min_num=10000, max_num=99999):
+
+# distance table column of a service
+def distance_column(service):
     """
-    Returns a list of 'quantity' random numbers between 'min_num' and 'max_num'
-    :param quantity: int, number of values
-    :param min_num: int, minimum random number
-    :param max_num: int, maximum random number
-    :return: list of random numbers
+    Get the distance table column of a geocoding service (see service_style).
+    :param service: geocoding service name
+    :return: column name
     """
-    # ask for appropriate quantity, if needed
-    if type(quantity) is not int or quantity <= 0:
-        quantity = int(input('Invalid quantity. Please enter an integer greater than zero.'))
+    return service_style(service)[0]
 
-    # generate list of unique random integeres between min and max parameters
-    try:
-        id_num_list = random.sample(range(min_num, max_num), quantity)
-        return id_num_list
 
-    except Exception as e:
-        print('Exception: {}'.format(e))
-        return e
+# distance columns among stored column names
+def stored_distance_columns(columns):
+    """
+    Find the distance columns among the columns of a distance table: every column with a queried flag, and the columns
+    of known services in tables written before the flags were added.
+    :param columns: list of column names
+    :return: list of distance columns, in table order
+    """
+    known = [distance_column(service) for service in available_providers() + list(RESULT_STYLES)]
+
+    return [col for col in columns if queried_column(col) in columns or col in known]
 
 
-def create_address_table(csv_path):
+# generate stable id numbers from names and addresses
+def generate_id_nums(table, name_col, address_col, seen=None):
+    """
+    Returns an array of 63-bit id numbers, one per row, computed from a hash of the normalized name and address. Ids stay
+    the same between runs; repeated name/address pairs are numbered by order of appearance so each id is unique.
+    :param table: pandas df with names and addresses
+    :param name_col: name field
+    :param address_col: address field
+    :param seen: optional dictionary of name/address hash: count from earlier chunks of the same file (updated in place)
+    :return: numpy array of int64 id numbers
+    """
+    # normalized name and address, plus occurrence number for repeated records
+    keys = pd.DataFrame({'name': normalize_series(table[name_col]), 'address': normalize_series(table[address_col])})
+    keys['occurrence'] = keys.groupby(['name', 'address']).cumcount()
+
+    # continue occurrence numbers from earlier chunks
+    if seen is not None:
+        pair_hashes = pd.util.hash_pandas_object(keys[['name', 'address']], index=False)
+        keys['occurrence'] += pair_hashes.map(seen).fillna(0).astype('int64').to_numpy()
+        for pair_hash, count in pair_hashes.value_counts().items():
+            seen[pair_hash] = seen.get(pair_hash, 0) + count
+
+    # hash each row (pandas uses a fixed hash key, so results are the same for every run)
+    hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+    # keep 63 bits so ids are positive int64 values
+    return (hashes & np.uint64(0x7FFFFFFFFFFFFFFF)).astype('int64')
+
+
+def create_address_table(csv_path, name_col='Name ', address_col='Address'):
     """
     Create a pandas df from csv file and add unique identifiers.
     :param csv_path: path to csv with address info
+    :param name_col: name field
+    :param address_col: address field
     :return: dataframe with csv info and unique id numbers added to each record
     """
     # create dataframe
     table = pd.read_csv(csv_path)
 
-    # generate random ids
-    id_num_list = generate_id_nums(len(table))
-
-    # assign random ids
-    table['id_num'] = ''
-    for i, row in table.iterrows():
-        table['id_num'][i] = id_num_list[i]
+    # assign stable ids
+    table['id_num'] = generate_id_nums(table, name_col, address_col)
 
     return table
 
 
-# create point object list from address tables with known coordinates
+# create point store from address tables with known coordinates
 def create_points_known_coords(address_table, name_col, address_col, latitude, longitude):
     """
-    Create Point objects from known coordinates in the address table.
+    Create a point store holding the known coordinates in the address table.
     :param address_table: pandas df with addresses and identifiers
     :param name_col: name field
     :param address_col: address field
     :param latitude: latitude field
     :param longitude: longitude field
-    :return: updated address table and list containing known points objects
+    :return: PointStore with known coordinates stored as service 'known'
     """
-    # list to store Point objects
-    point_list = []
-
-    # add column for known Point objects
-    address_table['known'] = None
-
-    # for each row in the address table
-    for i, row in address_table.iterrows():
-        # create a Point object
-        point = Point(address_table['id_num'][i], address_table[name_col][i], address_table[address_col][i], latitude=address_table[latitude][i], longitude=address_table[longitude][i])
-
-        # add Point object to table and list
-        address_table['known'][i] = point
-        point_list.append(point)
+    store = PointStore.from_table(address_table, name_col, address_col)
+    store.set_coordinates('known', pd.to_numeric(address_table[latitude], errors='coerce'), pd.to_numeric(address_table[longitude], errors='coerce'))
 
-    return address_table, point_list
+    return store
 
 
-# using address table, create a list of geocoded points for each service
-def geocode_address_table(address_table, name_col, address_col, gc_service):
+# geocode each row of the point store without modifying the store
+def geocode_points(store, gc_service, cache=None, rate_limiter=None, journal=None, retry_policy=None):
     """
-    Geocode addresses in the address table and create point objects.
-    :param address_table: pandas df containing string addresses
-    :param name_col: name field
-    :param address_col: address field
+    Geocode the addresses in the point store and return coordinate arrays (the store is not modified, so this can run
+    in a separate thread for each geocoding service). Transient errors (timeouts, rate limits, unavailable service) are
+    retried with backoff and are not cached or journaled; no requests are sent while the service's circuit is open.
+    :param store: PointStore with ids, names and addresses
     :param gc_service: which geocoding service to use to get coordinates
-    :return: updated address table, list of successful Point objects, list of failed Point objects
+    :param cache: optional GeocodeCache, checked before sending a request to the geocoding service (not used for
+    providers that are not cacheable)
+    :param rate_limiter: RateLimiter spacing out requests to gc_service (default: the provider's min_interval)
+    :param journal: optional GeocodeJournal, each outcome is recorded as soon as it arrives
+    :param retry_policy: RetryPolicy for transient errors (default: RetryPolicy())
+    :return: numpy array of latitudes, numpy array of longitudes (NaN for failed geocodes), numpy array of match
+    confidences (NaN if not reported)
     """
-    # list to store successful Point objects
-    point_list = []
-
-    # list to store failed Point objects
-    fail_list = []
-
-    # add column for geocoded Point objects
-    address_table[gc_service] = None
-
-    # for each row in address table
-    for i, row in address_table.iterrows():
+    # request limits of the service's provider, results of offline providers are not cached
+    provider = get_provider(gc_service)
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(provider.min_interval)
+    if not provider.cacheable:
+        cache = None
+
+    # create a Point object for each row
+    points = store.new_points(gc_service)
+
+    # use cached results if available
+    pending = []
+    for i, point in enumerate(points):
+        cached = cache.get(gc_service, point.address) if cache is not None else None
+        if cached is None:
+            pending.append(i)
+            continue
+        point.latitude, point.longitude, point.confidence = cached
+        if journal is not None:
+            journal.record(gc_service, point.id_num, point.latitude, point.longitude, point.confidence)
+
+    # geocode the address to get lat, lon
+    def attempt(i):
+        rate_limiter.wait()
+        return points[i].geocode()
+
+    # cache and record answers ('success' or 'failure'), errors are left pending for the next run
+    def done(i, outcome):
+        point = points[i]
+        if not is_final(outcome):
+            return
+        if cache is not None:
+            cache.put(gc_service, point.address, point.latitude, point.longitude, point.confidence)
+        if journal is not None:
+            journal.record(gc_service, point.id_num, point.latitude, point.longitude, point.confidence)
+
+    run_with_retries(pending, attempt, gc_service, retry_policy, done=done)
+
+    return point_results(points)
+
+
+# using the point store, geocode the addresses with a service
+def geocode_address_table(store, gc_service, cache=None, batch_size=None, journal=None):
+    """
+    Geocode the addresses in the point store that do not have a result for the service yet and store the coordinates.
+    Rows that share an address key are geocoded once.
+    :param store: PointStore with ids, names and addresses
+    :param gc_service: which geocoding service to use to get coordinates
+    :param cache: optional GeocodeCache, checked before sending a request to the geocoding service
+    :param batch_size: if set, submit chunks of batch_size addresses to the service's batch endpoint (services without
+    a batch endpoint are geocoded one address at a time)
+    :param journal: optional GeocodeJournal, each outcome is recorded as soon as it arrives
+    :return: updated PointStore
+    """
+    # rows still pending (all rows unless results were restored from a journal), one row per unique address
+    store.fill_duplicates(gc_service)
+    rows = store.pending_rows(gc_service)
+    unique, inverse = store.unique_rows(rows)
+    pending = store.subset(unique)
 
-        # create a Point object
-        point = Point(address_table['id_num'][i], address_table[name_col][i], address_table[address_col][i], gc_service)
+    # geocode each unique address, in batches if the service supports it
+    if batch_size is not None and gc_service in BATCH_SERVICES:
+        latitude, longitude, confidence = geocode_points_batch(pending, gc_service, batch_size, cache, journal=journal)
+    else:
+        latitude, longitude, confidence = geocode_points(pending, gc_service, cache, journal=journal)
 
-        # geocode the address to get lat, lon
-        point.geocode()
+    # fan results out to every row with the address
+    store.set_coordinates(gc_service, latitude[inverse], longitude[inverse], rows=rows, confidence=confidence[inverse])
 
-        # if successful geocode, add to point list and address table
-        if point.latitude is not None and point.longitude is not None:
-            point_list.append(point)
-            address_table[gc_service][i] = point
+    return store
 
-        # if failed geocode, add to fail list
-        else:
-            fail_list.append(point)
 
-        # wait 1 second between geocoding requests
-        time.sleep(1)
+# geocode the point store with several services at the same time
+def geocode_address_table_concurrent(store, gc_services, cache=None, min_interval=None, batch_size=None, journal=None):
+    """
+    Geocode the addresses in the point store with each geocoding service in its own thread. Each service has its own
+    rate limiter, so total runtime is about the runtime of the slowest service. Only rows without a result are geocoded,
+    once per unique address.
+    :param store: PointStore with ids, names and addresses
+    :param gc_services: list of geocoding services
+    :param cache: optional GeocodeCache shared by all services
+    :param min_interval: minimum seconds between requests to the same service (default: each provider's min_interval)
+    :param batch_size: if set, services with a batch endpoint submit chunks of batch_size addresses
+    :param journal: optional GeocodeJournal, each outcome is recorded as soon as it arrives
+    :return: updated PointStore
+    """
+    # rows still pending for each service, one row per unique address
+    rows = {}
+    unique = {}
+    inverse = {}
+    for service in gc_services:
+        store.fill_duplicates(service)
+        rows[service] = store.pending_rows(service)
+        unique[service], inverse[service] = store.unique_rows(rows[service])
+
+    # start one geocoding pass per service
+    with ThreadPoolExecutor(max_workers=len(gc_services)) as executor:
+        futures = {}
+        for service in gc_services:
+            pending = store.subset(unique[service])
+            if batch_size is not None and service in BATCH_SERVICES:
+                futures[service] = executor.submit(geocode_points_batch, pending, service, batch_size, cache, journal=journal)
+            else:
+                interval = get_provider(service).min_interval if min_interval is None else min_interval
+                futures[service] = executor.submit(geocode_points, pending, service, cache, RateLimiter(interval), journal)
+
+        # wait for every service to finish
+        results = {}
+        for service in gc_services:
+            results[service] = futures[service].result()
+
+    # merge results into the store, fanned out to every row with the address (only the main thread modifies the store)
+    for service in gc_services:
+        latitude, longitude, confidence = results[service]
+        store.set_coordinates(service, latitude[inverse[service]], longitude[inverse[service]], rows=rows[service],
+                              confidence=confidence[inverse[service]])
+
+    return store
+
+
+# geocode the point store with services in cost order, stopping early for confident results
+def geocode_address_table_cascade(store, gc_services, min_confidence=CASCADE_MIN_CONFIDENCE, agree_feet=CASCADE_AGREE_FEET,
+                                  cache=None, batch_size=None, journal=None):
+    """
+    Geocode the addresses in the point store with the services one after another in cost order (cheapest first). An
+    address is only sent to the next service while it is unresolved: it is resolved once a service reports a match
+    confidence of at least min_confidence, or once two services' results agree within agree_feet (the more confident of
+    the two is chosen). Addresses no service resolves get their most confident result. The chosen results are stored as
+    the 'cascade' service; each service's results are stored for the addresses sent to it, the other rows stay pending
+    for that service. Results a service already has in the store (restored from a journal or a previous run) are reused
+    without a request. Rows that share an address key are geocoded once.
+    :param store: PointStore with ids, names and addresses
+    :param gc_services: list of geocoding services in the order they are queried
+    :param min_confidence: match confidence between 0 and 1 at which a result is accepted
+    :param agree_feet: distance in feet within which two services' results agree
+    :param cache: optional GeocodeCache shared by all services
+    :param batch_size: if set, services with a batch endpoint submit chunks of batch_size addresses
+    :param journal: optional GeocodeJournal, each outcome is recorded as soon as it arrives
+    :return: updated PointStore
+    """
+    # rows without a cascade result, one row per unique address
+    store.fill_duplicates(CASCADE_SERVICE)
+    rows = store.pending_rows(CASCADE_SERVICE)
+    unique, inverse = store.unique_rows(rows)
+    n = len(unique)
+
+    # chosen result of each address (rank orders results: confidence, 0 if not reported, -1 for no result)
+    latitude = np.full(n, np.nan)
+    longitude = np.full(n, np.nan)
+    confidence = np.full(n, np.nan)
+    rank = np.full(n, -1.0)
+    resolved = np.zeros(n, dtype=bool)
+
+    # results of the services queried so far and the number of addresses sent to each service
+    results = []
+    queried = {}
+
+    for service in gc_services:
+        todo = np.flatnonzero(~resolved)
+        queried[service] = 0
+        if len(todo) == 0:
+            continue
+
+        # reuse results the service already has for these addresses
+        store.add_service(service)
+        store.fill_duplicates(service)
+        service_lat = store.latitude[service][unique]
+        service_lon = store.longitude[service][unique]
+        service_conf = store.confidence[service][unique]
+
+        # geocode the rest with the service and fan its results out to every pending row with the address
+        ask = todo[store.status[service][unique[todo]] == STATUS_PENDING]
+        queried[service] = len(ask)
+        metrics.inc('cascade_addresses_total', len(ask), service=service)
+        if len(ask):
+            pending = store.subset(unique[ask])
+            if batch_size is not None and service in BATCH_SERVICES:
+                lat, lon, conf = geocode_points_batch(pending, service, batch_size, cache, journal=journal)
+            else:
+                lat, lon, conf = geocode_points(pending, service, cache, journal=journal)
+            service_lat[ask], service_lon[ask], service_conf[ask] = lat, lon, conf
+
+            sent = np.zeros(n, dtype=bool)
+            sent[ask] = True
+            sent = sent[inverse]
+            store.set_coordinates(service, service_lat[inverse][sent], service_lon[inverse][sent], rows=rows[sent],
+                                  confidence=service_conf[inverse][sent])
+
+        # results of resolved addresses are not compared
+        service_lat[resolved] = np.nan
+        service_lon[resolved] = np.nan
+        found = ~np.isnan(service_lat) & ~np.isnan(service_lon)
+        service_rank = np.where(found, np.nan_to_num(service_conf, nan=0.0), -1.0)
+
+        # confident results
+        confident = found & (service_rank >= min_confidence)
+
+        # results agreeing with an earlier service's result (the more confident result of the pair is chosen)
+        agree = np.zeros(n, dtype=bool)
+        pair_lat, pair_lon, pair_conf, pair_rank = service_lat.copy(), service_lon.copy(), service_conf.copy(), service_rank.copy()
+        for earlier_lat, earlier_lon, earlier_conf, earlier_rank in results:
+            with np.errstate(invalid='ignore'):
+                close = found & ~confident & ~agree & \
+                        (geodesic_distance_feet(earlier_lat, earlier_lon, service_lat, service_lon) <= agree_feet)
+            better = close & (earlier_rank > service_rank)
+            pair_lat[better], pair_lon[better] = earlier_lat[better], earlier_lon[better]
+            pair_conf[better], pair_rank[better] = earlier_conf[better], earlier_rank[better]
+            agree |= close
+
+        # chosen result: the confident result, the agreeing pair's result or the service's result if it is the most
+        # confident result of the address so far
+        choose = confident | agree | (service_rank > rank)
+        latitude[choose] = pair_lat[choose]
+        longitude[choose] = pair_lon[choose]
+        confidence[choose] = pair_conf[choose]
+        rank[choose] = pair_rank[choose]
+        resolved |= confident | agree
+
+        metrics.inc('cascade_resolved_total', int(confident.sum()), service=service, reason='confident')
+        metrics.inc('cascade_resolved_total', int(agree.sum()), service=service, reason='agreement')
+        results.append((service_lat, service_lon, service_conf, service_rank))
+
+    # store chosen results, fanned out to every row with the address
+    store.set_coordinates(CASCADE_SERVICE, latitude[inverse], longitude[inverse], rows=rows, confidence=confidence[inverse])
+
+    # addresses sent to each service compared with sending every address to every service
+    full = n * len(gc_services)
+    sent = sum(queried.values())
+    print('Cascade geocoding: {} addresses, {} resolved; addresses sent: {}; {} of {} lookups saved ({:.0%})'.format(
+        n, int(resolved.sum()), ', '.join('{} {}'.format(service, count) for service, count in queried.items()),
+        full - sent, full, (full - sent) / full if full else 0.0))
+
+    return store
+
+
+# geocode the point store with every service using the selected geocoding mode
+def geocode_services(store, gc_services, geocode_mode='threads', cache=None, batch_size=None, journal=None,
+                     min_confidence=CASCADE_MIN_CONFIDENCE, agree_feet=CASCADE_AGREE_FEET):
+    """
+    Geocode the addresses in the point store with each service.
+    :param store: PointStore with ids, names and addresses
+    :param gc_services: list of registered geocoding services (see providers.available_providers), in cost order for
+    the cascade mode
+    :param geocode_mode: 'sequential' (one service after another), 'threads' (all services at the same time, each with
+    its own rate limit), 'async' (asyncio engine, many requests in flight per service over pooled connections) or
+    'cascade' (services in cost order, each address only until a result is confident, see
+    geocode_address_table_cascade)
+    :param cache: optional GeocodeCache shared by all services
+    :param batch_size: if set, services with a batch endpoint submit chunks of batch_size addresses
+    :param journal: optional GeocodeJournal; journaled outcomes are restored first and only pending rows are geocoded
+    :param min_confidence: cascade mode: match confidence at which a result is accepted
+    :param agree_feet: cascade mode: distance in feet within which two services' results agree
+    :return: updated PointStore
+    """
+    # create each service's provider first, so unknown services and missing reference files fail before geocoding
+    for service in gc_services:
+        get_provider(service)
+
+    # restore outcomes from an interrupted run
+    if journal is not None:
+        journal.restore(store, gc_services)
+
+    if geocode_mode == 'threads':
+        store = geocode_address_table_concurrent(store, gc_services, cache=cache, batch_size=batch_size, journal=journal)
+    elif geocode_mode == 'async':
+        from async_geocoder import geocode_address_table_async
+        store = geocode_address_table_async(store, gc_services, cache=cache, journal=journal)
+    elif geocode_mode == 'cascade':
+        store = geocode_address_table_cascade(store, gc_services, min_confidence, agree_feet, cache=cache,
+                                              batch_size=batch_size, journal=journal)
+    else:
+        for service in gc_services:
+            store = geocode_address_table(store, service, cache=cache, batch_size=batch_size, journal=journal)
+
+    return store
+
+
+# services with results in the store after geocoding
+def result_services(gc_services, geocode_mode='threads'):
+    """
+    Return the services whose results are output: the geocoding services and, in cascade mode, the chosen results.
+    :param gc_services: list of geocoding services
+    :param geocode_mode: geocoding mode (see geocode_services)
+    :return: list of service names
+    """
+    if geocode_mode == 'cascade':
+        return list(gc_services) + [CASCADE_SERVICE]
 
-    return address_table, point_list, fail_list
+    return list(gc_services)
 
 
-def output_geocode_results_csv(point_list, csv_path):
+def output_geocode_results_csv(store, service, csv_path, status=STATUS_OK, append=False):
     """
-    Output geocode results from the Point object list as a CSV.
-    :param point_list: list of Point objects
+    Output geocode results for a service from the point store as a CSV.
+    :param store: PointStore
+    :param service: geocoding service name (or 'known')
     :param csv_path: path to save csv file
+    :param status: which points to write (STATUS_OK for results, STATUS_FAILED for fails)
+    :param append: append rows to an existing csv file instead of overwriting it
     :return: None
     """
-    # with the file open
-    with open(csv_path, 'w') as f:
+    gc_service = None if service == 'known' else service
+    append = append and os.path.exists(csv_path)
+
+    # coordinates of the rows to write ('None' for failed geocodes)
+    rows = store.rows(service, status)
+    latitude = [None if np.isnan(value) else value for value in store.latitude[service][rows]]
+    longitude = [None if np.isnan(value) else value for value in store.longitude[service][rows]]
+
+    # with the file open (fields containing commas, quotes or line breaks are quoted)
+    with open(csv_path, 'a' if append else 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
         # write point info to file
-        f.write('id_num,name,address,gc_service,latitude,longitude\n')
-        for point in point_list:
-            f.write('{},{},{},{},{},{}\n'.format(point.id_num, point.name, point.address, point.gc_service, point.latitude, point.longitude))
+        if not append:
+            writer.writerow(['id_num', 'name', 'address', 'gc_service', 'latitude', 'longitude'])
+        writer.writerows(['{}'.format(value) for value in row]
+                         for row in zip(store.id_num[rows], store.name[rows], store.address[rows], repeat(gc_service), latitude, longitude))
 
 
-def output_geocode_results_shp(point_list, shp_path):
+def output_geocode_results_shp(store, service, shp_path, append=False):
     """
-    Output geocode results from the Point object list as a shapefile.
-    :param point_list: list of Point objects
+    Output successful geocode results for a service from the point store as a shapefile.
+    :param store: PointStore
+    :param service: geocoding service name (or 'known')
     :param shp_path: path to save shapefile
+    :param append: append features to an existing shapefile instead of overwriting it
+    :return: None
+    """
+    output_geocode_results_vector(store, service, shp_path, append)
+
+
+def output_geocode_results_vector(store, service, vector_path, append=False, transaction_size=100000):
+    """
+    Output successful geocode results for a service from the point store as a vector file. The format is chosen by file
+    extension: .shp (ESRI Shapefile), .gpkg (GeoPackage) or .fgb (FlatGeobuf); GeoPackage and FlatGeobuf files are
+    written with a spatial index.
+    :param store: PointStore
+    :param service: geocoding service name (or 'known')
+    :param vector_path: path to save vector file
+    :param append: append features to an existing file instead of overwriting it (not supported for FlatGeobuf)
+    :param transaction_size: number of features written per transaction (formats with transaction support)
     :return: None
     """
-    # create shapefile using given lat/lon coordinates
+    from osgeo import ogr
+    from osgeo import osr
+
     # driver
-    driver = ogr.GetDriverByName('ESRI Shapefile')
+    extension = os.path.splitext(vector_path)[1].lower()
+    if extension not in VECTOR_DRIVERS:
+        raise ValueError('Unsupported vector format: {}'.format(extension))
+    driver = ogr.GetDriverByName(VECTOR_DRIVERS[extension])
+
+    # append to existing file
+    if append and os.path.exists(vector_path):
+        if extension == '.fgb':
+            raise ValueError('FlatGeobuf files cannot be appended to: {}'.format(vector_path))
+        ds = driver.Open(vector_path, 1)
+        layer = ds.GetLayer(0)
+        write_point_features(ds, layer, store, service, transaction_size)
+        ds.SyncToDisk()
+        ds.Destroy()
+        return None
 
     # check if path exists and delete
-    if os.path.exists(shp_path):
-        driver.DeleteDataSource(shp_path)
+    if os.path.exists(vector_path):
+        driver.DeleteDataSource(vector_path)
 
     # create new data source
-    ds = driver.CreateDataSource(shp_path)
+    ds = driver.CreateDataSource(vector_path)
 
     # create spatial reference object, WGS84 EPSG=4326
     srs = osr.SpatialReference()
     srs.ImportFromEPSG(4326)
 
-    # get layer name from shp_path
-    name = shp_path.split('/')[-1:][0].replace('.shp', '')
+    # get layer name from vector_path
+    name = os.path.splitext(os.path.basename(vector_path))[0]
 
-    # create layer
-    layer = ds.CreateLayer(name, srs=srs, geom_type=ogr.wkbPoint)
+    # create layer (GeoPackage and FlatGeobuf layers get a spatial index)
+    options = [] if extension == '.shp' else ['SPATIAL_INDEX=YES']
+    layer = ds.CreateLayer(name, srs=srs, geom_type=ogr.wkbPoint, options=options)
 
     # field definition objects
-    fd1 = ogr.FieldDefn('id_num', ogr.OFTInteger)
+    fd1 = ogr.FieldDefn('id_num', ogr.OFTInteger64)
     fd2 = ogr.FieldDefn('name', ogr.OFTString)
     fd3 = ogr.FieldDefn('address', ogr.OFTString)
     fd4 = ogr.FieldDefn('latitude', ogr.OFTReal)
@@ -191,124 +564,203 @@ def output_geocode_results_shp(point_list, shp_path):
     layer.CreateField(fd4)
     layer.CreateField(fd5)
 
-    # create feature definition object
+    # add features
+    write_point_features(ds, layer, store, service, transaction_size)
+
+    # sync changes to disk
+    ds.SyncToDisk()
+
+    # destroy objects when done
+    ds.Destroy()
+
+
+# write point features to an OGR layer
+def write_point_features(ds, layer, store, service, transaction_size=100000):
+    """
+    Add a point feature to the layer for each successful row of the service, committing every transaction_size features.
+    :param ds: OGR data source containing the layer
+    :param layer: OGR layer with id_num, name, address, latitude and longitude fields
+    :param store: PointStore
+    :param service: geocoding service name (or 'known')
+    :param transaction_size: number of features written per transaction
+    :return: None
+    """
+    from osgeo import ogr
+
+    # field indexes (setting fields by index avoids a name lookup per feature)
     feature_defn = layer.GetLayerDefn()
+    id_field = feature_defn.GetFieldIndex('id_num')
+    name_field = feature_defn.GetFieldIndex('name')
+    address_field = feature_defn.GetFieldIndex('address')
+    lat_field = feature_defn.GetFieldIndex('latitude')
+    lon_field = feature_defn.GetFieldIndex('longitude')
 
-    # populate features
-    # iterate through points in list
-    for p in point_list:
-        # create new feature object
-        feature = ogr.Feature(feature_defn)
+    # coordinate arrays
+    latitude = store.latitude[service]
+    longitude = store.longitude[service]
 
-        # geometry
-        point = ogr.Geometry(ogr.wkbPoint)
-        point.AddPoint(p.longitude, p.latitude)
-        feature.SetGeometry(point)
+    # reuse one feature and geometry object for every row
+    feature = ogr.Feature(feature_defn)
+    point = ogr.Geometry(ogr.wkbPoint)
 
-        # fields
-        feature.SetField('id_num', p.id_num)
-        feature.SetField('name', p.name)
-        feature.SetField('address', p.address)
-        feature.SetField('latitude', p.latitude)
-        feature.SetField('longitude', p.longitude)
+    # wrap inserts in transactions if the format supports them
+    transactions = ds.TestCapability(ogr.ODsCTransactions)
 
-        # add feature to layer
-        layer.CreateFeature(feature)
+    # populate features
+    # iterate through successful rows
+    rows = store.rows(service)
+    for start in range(0, len(rows), transaction_size):
+        if transactions:
+            ds.StartTransaction()
 
-        # destroy feature
-        feature.Destroy()
+        for i in rows[start:start + transaction_size]:
+            # geometry
+            point.SetPoint_2D(0, float(longitude[i]), float(latitude[i]))
+            feature.SetGeometry(point)
 
-    # sync changes to disk
-    ds.SyncToDisk()
+            # fields
+            feature.SetField(id_field, int(store.id_num[i]))
+            feature.SetField(name_field, str(store.name[i]))
+            feature.SetField(address_field, str(store.address[i]))
+            feature.SetField(lat_field, float(latitude[i]))
+            feature.SetField(lon_field, float(longitude[i]))
 
-    # destroy objects when done
-    ds.Destroy()
+            # add feature to layer as a new feature
+            feature.SetFID(-1)
+            layer.CreateFeature(feature)
+
+        if transactions:
+            ds.CommitTransaction()
+
+    # destroy feature
+    feature.Destroy()
 
 
 # create distance comparison tables
-def create_distance_table(address_table, csv_out):
+def create_distance_table(address_table, store, csv_out, append=False, site_index=None, k=1, radius_feet=None):
     """
     Calculate distance between geocoded points and known coords, then save as CSV.
-    :param address_table: address table containing geocoded and known Point objects
+    :param address_table: pandas df with addresses and identifiers
+    :param store: PointStore with known and geocoded coordinates
     :param csv_out: path to save distance table as CSV
+    :param append: append rows to an existing csv file instead of overwriting it
+    :param site_index: optional KnownSiteIndex over known sites; adds the nearest known sites of each geocoded point
+    (see add_nearest_site_columns)
+    :param k: number of nearest known sites added for each service
+    :param radius_feet: if set, also add the number of known sites within radius_feet of each geocoded point
     :return: distance table
     """
-    # list of geocoding services used
-    services = []
+    # copy of the address table with a distance column for each service
+    distance_table = address_table.copy()
 
-    # add services to list if present in address table
-    if 'nominatim' in address_table.columns:
-        services.append('Nominatim')
-    if 'google' in address_table.columns:
-        services.append('Google')
-    if 'arcgis' in address_table.columns:
-        services.append('ArcGIS')
-    if 'bing' in address_table.columns:
-        services.append('Bing')
+    # known coordinates
+    known_lat = store.latitude['known']
+    known_lon = store.longitude['known']
 
-    # for each service
-    for service in services:
-
-        # add column to table
-        col_name = service
-        address_table[col_name] = None
+    # for each service in the store, calculate all distances at once (NaN for failed geocodes and rows the service was
+    # not asked to geocode, which are flagged in the queried column)
+    for service in store.services():
+        if service != 'known':
+            col_name = distance_column(service)
+            distance_table[col_name] = geodesic_distance_feet(known_lat, known_lon, store.latitude[service], store.longitude[service])
+            distance_table[queried_column(col_name)] = store.status[service] != STATUS_PENDING
 
-        # calculate distances
-        for i, row in address_table.iterrows():
-            try:
-                address_table[col_name][i] = address_table['known'][i].calc_distance_feet(address_table[service.lower()][i])
-            except Exception as e:
-                print('Exception: {}'.format(e))
-
-    # delete Point object columns
-    for service in services:
-        del address_table[service.lower()]
-    del address_table['known']
+    # nearest known sites
+    if site_index is not None:
+        add_nearest_site_columns(distance_table, store, site_index, k, radius_feet)
 
     # output distance table as csv
-    address_table.to_csv(csv_out, index=False)
+    append = append and os.path.exists(csv_out)
+    distance_table.to_csv(csv_out, index=False, mode='a' if append else 'w', header=not append)
 
     # return distance table
-    return address_table
+    return distance_table
 
 
-# calculate statistics for distance tables
-def calc_distance_statistics(distance_table, csv_out):
+# add nearest known site columns to a distance table
+def add_nearest_site_columns(distance_table, store, site_index, k=1, radius_feet=None):
+    """
+    Add, for each service, the id numbers and distances of the k known sites nearest to each geocoded point, a flag for
+    points that are closer to another known site than to their own, and optionally the number of known sites within
+    radius_feet. Columns are named '<service> Nearest Site', '<service> Nearest Site Distance' (numbered 1..k when k > 1),
+    '<service> Other Site' and '<service> Sites Within <radius> ft'.
+    :param distance_table: distance table with a distance column for each service (modified in place)
+    :param store: PointStore with known and geocoded coordinates, in the same row order as the distance table
+    :param site_index: KnownSiteIndex over known sites
+    :param k: number of nearest known sites
+    :param radius_feet: optional search radius in feet
+    :return: distance table
+    """
+    for service in store.services():
+        if service == 'known':
+            continue
+        col_name = distance_column(service)
+        latitude = store.latitude[service]
+        longitude = store.longitude[service]
+
+        # k nearest known sites of every geocoded point
+        distance, id_num = site_index.nearest(latitude, longitude, k)
+        for j in range(k):
+            suffix = ' {}'.format(j + 1) if k > 1 else ''
+            distance_table['{} Nearest Site{}'.format(col_name, suffix)] = pd.arrays.IntegerArray(id_num[:, j], id_num[:, j] < 0)
+            distance_table['{} Nearest Site Distance{}'.format(col_name, suffix)] = distance[:, j]
+
+        # geocoded point is at least a foot closer to another known site than to its own
+        distance_table['{} Other Site'.format(col_name)] = distance[:, 0] + 1 < distance_table[col_name].to_numpy()
+
+        # number of known sites within the radius
+        if radius_feet is not None:
+            rows, _, _ = site_index.within(latitude, longitude, radius_feet)
+            distance_table['{} Sites Within {} ft'.format(col_name, radius_feet)] = np.bincount(rows, minlength=len(store))
+
+    return distance_table
+
+
+# plot colors of distance columns
+def plot_palette(columns):
+    """
+    Get the plot color of each distance column: PLOT_COLORS for built in columns, EXTRA_PLOT_COLORS in turn for the
+    others, so a column keeps its color whichever columns are plotted with it.
+    :param columns: distance columns
+    :return: dictionary of column: color
     """
-    Calculate distance statistics (mean, max, std dev, percent matched) and output table as CSV.
+    extra = cycle(EXTRA_PLOT_COLORS)
+    return {col: PLOT_COLORS[col] if col in PLOT_COLORS else next(extra) for col in columns}
+
+
+# distance columns present in a distance table
+def distance_columns(distance_table):
+    """
+    Get the distance columns of a distance table (see stored_distance_columns).
     :param distance_table: pandas df with distances between geocode results and known coords
+    :return: list of column names
+    """
+    return stored_distance_columns(list(distance_table.columns))
+
+
+# calculate statistics for distance tables
+def calc_distance_statistics(distance_table, csv_out, columns=None):
+    """
+    Calculate distance statistics (rows queried, count, percent of queried rows matched, mean, std dev, max,
+    p50/p90/p95/p99) in one streaming pass and output table as CSV.
+    :param distance_table: pandas df with distances between geocode results and known coords, or an iterable of df
+    chunks (e.g. pd.read_csv(path, chunksize=100000)) for tables that do not fit in memory
     :param csv_out: path to save statistics table as CSV.
+    :param columns: distance columns to summarize (default: the table's distance columns, see distance_columns)
     :return: statistics tables
     """
-    # get column names containing distances
-    cols = list(distance_table.columns)
-    cols.remove('Name ')
-    cols.remove('Address')
-    cols.remove('id_num')
-    cols.remove('Latitude')
-    cols.remove('Longitude')
-    cols.remove('Source ')
-    cols.remove('RP Name ')
-    cols.remove('RP Type ')
-    cols.remove('Record Date ')
-    cols.remove('Flag Active ')
-    cols.remove('Flag Owner ')
-    cols.remove('rv_method ')
-    cols.remove('Notes ')
-    cols.remove('Extra_Lat')
-    cols.remove('Extra_Long ')
-    cols.remove('Extra RP data Name  ')
-    cols.remove('Extra RP data Type ')
-
-    # create empty statistics dataframe
-    table = pd.DataFrame(columns={'comparison', 'percent_match', 'mean_distance', 'std_dev', 'max_distance'})
-
-    # add a row to the statistics table for each geocoding service
-    for col in cols:
-        success = distance_table[col].count()/distance_table['id_num'].count()*100
-        new_row = {'comparison': col, 'percent_match': success, 'mean_distance': distance_table[col].mean(), 'max_distance': distance_table[col].max(), 'std_dev': distance_table[col].std()} #, 'max_dist_id': max_id}
-
-        table = table.append(new_row, ignore_index=True)
+    # single table or chunks
+    chunks = [distance_table] if isinstance(distance_table, pd.DataFrame) else distance_table
+
+    # update running statistics with each chunk
+    stats = None
+    for chunk in chunks:
+        if stats is None:
+            stats = DistanceStatistics(columns if columns is not None else distance_columns(chunk))
+        stats.update(chunk)
+
+    # create statistics table
+    table = stats.table()
 
     # save statistics table
     table.to_csv(csv_out, index=False)
@@ -317,49 +769,40 @@ def calc_distance_statistics(distance_table, csv_out):
 
 
 # plot distances between results by different services
-def plot_result_distances(distance_table, plot_out=None):
+def plot_result_distances(distance_table, plot_out=None, mode='box'):
     """
     Visualize geocoding results as a box plot
-    :param distance_table: pandas df containing all distance calculations
+    :param distance_table: pandas df containing all distance calculations ('summary' mode also accepts an iterable of
+    df chunks, e.g. pd.read_csv(path, chunksize=100000))
     :param plot_out: path to save box plot
+    :param mode: 'box' (seaborn box plot of every distance) or 'summary' (box plot, log-scale ECDF and histogram drawn
+    from quantile sketches, render time does not depend on the number of distances)
     :return: None
     """
+    if mode == 'summary':
+        return plot_distance_summary(distance_table, plot_out)
+
+    if mode != 'box':
+        raise ValueError('Unknown plot mode: {}'.format(mode))
+
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     # Draw Box Plot
     # https://www.machinelearningplus.com/plots/top-50-matplotlib-visualizations-the-master-plots-python/
     # get column names containing distances
-    cols = list(distance_table.columns)
-    cols.remove('Name ')
-    cols.remove('Address')
-    cols.remove('id_num')
-    cols.remove('Latitude')
-    cols.remove('Longitude')
-    cols.remove('Source ')
-    cols.remove('RP Name ')
-    cols.remove('RP Type ')
-    cols.remove('Record Date ')
-    cols.remove('Flag Active ')
-    cols.remove('Flag Owner ')
-    cols.remove('rv_method ')
-    cols.remove('Notes ')
-    cols.remove('Extra_Lat')
-    cols.remove('Extra_Long ')
-    cols.remove('Extra RP data Name  ')
-    cols.remove('Extra RP data Type ')
+    cols = distance_columns(distance_table)
 
     # create new table with all distances in one column rather than a column for each service
-    table = pd.DataFrame(columns={'id_num', 'Geocoding Service', 'Distance (Feet)'})
-
-    # add a new row containing each distance and its associated service
-    for col in cols:
-        for i, row in distance_table.iterrows():
-            if pd.isna(distance_table[col][i]) is False:
-                new_row = {'id_num': distance_table['id_num'][i], 'Geocoding Service': col, 'Distance (Feet)': distance_table[col][i]}
-                table = table.append(new_row, ignore_index=True)
+    table = distance_table.melt(id_vars='id_num', value_vars=cols, var_name='Geocoding Service', value_name='Distance (Feet)')
+    table = table.dropna(subset=['Distance (Feet)'])
 
     # set up box plot
     plt.figure(figsize=(13, 10), dpi=80)
 
-    sns.boxplot(x='Geocoding Service', y='Distance (Feet)', data=table, palette=['darkorange', 'lawngreen', 'red', 'deepskyblue'], notch=False)
+    palette = plot_palette(cols)
+    sns.boxplot(x='Geocoding Service', y='Distance (Feet)', data=table, order=cols, palette=[palette[col] for col in cols],
+                notch=False)
 
     # Decoration
     plt.title('Distance Between Geocoded Results and Known Locations (Feet)', fontsize=14)
@@ -373,33 +816,133 @@ def plot_result_distances(distance_table, plot_out=None):
     return None
 
 
+# plot pre-aggregated distance summaries
+def plot_distance_summary(distance_table, plot_out=None, columns=None):
+    """
+    Visualize geocoding results from per-service quantile sketches: box plot (whiskers at p5/p95), ECDF and histogram,
+    both on a log distance axis. Distances are aggregated in one streaming pass, so millions of rows plot in the same
+    time as a few thousand.
+    :param distance_table: pandas df containing all distance calculations, or an iterable of df chunks
+    :param plot_out: path to save plot
+    :param columns: distance columns to plot (default: the table's distance columns, see distance_columns)
+    :return: None
+    """
+    import matplotlib.pyplot as plt
+
+    # single table or chunks
+    chunks = [distance_table] if isinstance(distance_table, pd.DataFrame) else distance_table
+
+    # aggregate distances
+    stats = None
+    for chunk in chunks:
+        if stats is None:
+            stats = DistanceStatistics(columns if columns is not None else distance_columns(chunk))
+        stats.update(chunk)
+
+    # set up figure: box plot, ECDF, histogram
+    fig, (ax_box, ax_ecdf, ax_hist) = plt.subplots(1, 3, figsize=(20, 8), dpi=80)
+    bins = np.logspace(0, 6, 61)
+
+    box_stats = []
+    box_colors = []
+    palette = plot_palette(stats.columns)
+    for col in stats.columns:
+        color = palette[col]
+        sketch = stats.sketch[col]
+        if stats.count[col] == 0:
+            continue
+
+        # box from quantiles
+        box_stats.append({'label': col, 'whislo': sketch.quantile(0.05), 'q1': sketch.quantile(0.25),
+                          'med': sketch.quantile(0.5), 'q3': sketch.quantile(0.75), 'whishi': sketch.quantile(0.95),
+                          'fliers': []})
+        box_colors.append(color)
+
+        # ECDF and histogram from sketch buckets (zero distances are drawn at 1 foot on the log axis)
+        values, counts = sketch.buckets()
+        values = np.maximum(values, 1)
+        ax_ecdf.step(values, np.cumsum(counts) / counts.sum(), where='post', color=color, label=col)
+        ax_hist.hist(values, bins=bins, weights=counts, histtype='step', color=color, label=col)
+
+    # draw boxes
+    boxes = ax_box.bxp(box_stats, showfliers=False, patch_artist=True, medianprops={'color': 'black'})
+    for patch, color in zip(boxes['boxes'], box_colors):
+        patch.set_facecolor(color)
+
+    # Decoration
+    ax_box.set_xlabel('Geocoding Service')
+    ax_box.set_ylabel('Distance (Feet)')
+    ax_box.set_ylim(0, 7000)
+    ax_box.set_title('p5, p25, p50, p75, p95')
+    ax_ecdf.set_xscale('log')
+    ax_ecdf.set_xlabel('Distance (Feet)')
+    ax_ecdf.set_ylabel('Fraction of Geocoded Points')
+    ax_ecdf.set_title('ECDF')
+    ax_ecdf.legend()
+    ax_hist.set_xscale('log')
+    ax_hist.set_xlabel('Distance (Feet)')
+    ax_hist.set_ylabel('Number of Geocoded Points')
+    ax_hist.set_title('Histogram')
+    ax_hist.legend()
+    fig.suptitle('Distance Between Geocoded Results and Known Locations (Feet)', fontsize=14)
+
+    # save plot
+    if plot_out is not None:
+        fig.savefig(plot_out)
+
+    return None
+
+
 # map geocoded results
-def map_geocoding_results(map_out, color, icon, *args):
+def map_geocoding_results(map_out, color, icon, store, *services, mode='cluster'):
     """
     Save a html map of points
     :param map_out: path to save map html file
-    :param color: list containing colors for each point layer in *args
-    :param icon: list containing icon symbols for each point layer in *args
-    :param args: each arg is a shapefile to be added as a point layer to be added to the map
+    :param color: list containing colors for each point layer in *services
+    :param icon: list containing icon symbols for each point layer in *services
+    :param store: PointStore with coordinates for each service
+    :param services: each service (or 'known') is added as a point layer to the map
+    :param mode: 'cluster' (client-side marker clustering), 'geojson' (one GeoJSON circle layer per service) or
+    'markers' (one folium Marker per point, slow for large layers)
     :return: None
     """
+    import folium
+    from folium.plugins import FastMarkerCluster
+
     # counter for color and icon symbology lists
     num = 0
 
     # create map object
     mapobj = folium.Map(location=(32.81, -117.05), zoom_start=13)
 
-    # for each shapefile
-    for arg in args:
-        # create geodataframe
-        gdf = gpd.read_file(arg)
-
-        # add each row of geodatframe to map
-        for i, row in gdf.iterrows():
-            # popup
-            label = gdf.name[i]
-            # add point to map
-            mapobj.add_child(folium.Marker(location=(gdf.latitude[i], gdf.longitude[i]), popup=label, icon=folium.Icon(color=color[num], icon=icon[num])))
+    # for each service
+    for service in services:
+        rows = store.rows(service)
+        latitude = store.latitude[service][rows]
+        longitude = store.longitude[service][rows]
+        names = [str(name) for name in store.name[rows]]
+
+        # clustered markers: the points are written once as a data array and the markers are created in the browser
+        if mode == 'cluster':
+            callback = ('function (row) {{'
+                        'var icon = L.AwesomeMarkers.icon({{icon: "{}", markerColor: "{}", prefix: "glyphicon"}});'
+                        'var marker = L.marker(new L.LatLng(row[0], row[1]), {{icon: icon}});'
+                        'marker.bindPopup(row[2]);'
+                        'return marker;}}').format(icon[num], color[num])
+            data = [[float(lat), float(lon), name] for lat, lon, name in zip(latitude, longitude, names)]
+            FastMarkerCluster(data, callback=callback, name=service).add_to(mapobj)
+
+        # one GeoJSON layer of circle markers
+        elif mode == 'geojson':
+            folium.GeoJson(points_geojson(latitude, longitude, names), name=service,
+                           marker=folium.CircleMarker(radius=5, color=MARKER_CSS_COLORS.get(color[num], color[num]), fill=True),
+                           popup=folium.GeoJsonPopup(fields=['name'], labels=False)).add_to(mapobj)
+
+        # add each successful point to map
+        else:
+            for lat, lon, label in zip(latitude, longitude, names):
+                # add point to map
+                mapobj.add_child(folium.Marker(location=(lat, lon), popup=label, icon=folium.Icon(color=color[num], icon=icon[num])))
 
         # increment num for color and icon symbology lists
         num += 1
@@ -408,49 +951,78 @@ def map_geocoding_results(map_out, color, icon, *args):
     mapobj.save(map_out)
 
 
+# GeoJSON feature collection of points
+def points_geojson(latitude, longitude, names, properties=None):
+    """
+    Build a GeoJSON feature collection of points.
+    :param latitude: array of latitudes
+    :param longitude: array of longitudes
+    :param names: list of point names
+    :param properties: optional dictionary of property name: list of values (one per point)
+    :return: GeoJSON dictionary
+    """
+    features = []
+    for k, (lat, lon, name) in enumerate(zip(latitude, longitude, names)):
+        feature_properties = {'name': name}
+        if properties is not None:
+            for key, values in properties.items():
+                feature_properties[key] = values[k]
+        features.append({'type': 'Feature',
+                         'id': k,
+                         'geometry': {'type': 'Point', 'coordinates': [float(lon), float(lat)]},
+                         'properties': feature_properties})
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+
 # bubble map
-def create_bubble_map(shp_in, distance_table, bubble_size_parameter, color, map_out):
+def create_bubble_map(store, distance_table, bubble_size_parameter, color, map_out):
     """
     Save a map showing geocoded locations at the known coordinates, with point size determined by distance to geocoded result.
-    :param shp_in: shapefile with given coordinates
-    :param distance_table: distance table with distances from geocoded result to given coordinates
-    :param bubble_size_parameter: name of geocoder to use as size parameter (gdf column name)
-    :param color: point color
+    Each geocoder is one GeoJSON layer and the map file is written once.
+    :param store: PointStore with known coordinates
+    :param distance_table: distance table with distances from geocoded result to given coordinates (same rows as store)
+    :param bubble_size_parameter: name of geocoder to use as size parameter (distance table column name), or a list of
+    names to add a layer for each geocoder to the same map
+    :param color: point color, or a list with one color per geocoder
     :param map_out: path for saving map as a .html file
     :return: None
     """
-    # read shapefile
-    gdf = gpd.read_file(shp_in)
-    # merge distance table to shapefile
-    gdf = gdf.merge(distance_table, on='id_num')
-    # create column that flags null distances (geocode fails)
-    gdf['null_flag'] = gdf[bubble_size_parameter].isnull()
+    import folium
+
+    # one layer per geocoder
+    if isinstance(bubble_size_parameter, str):
+        bubble_size_parameter = [bubble_size_parameter]
+    if isinstance(color, str):
+        color = [color]
+
+    # known coordinates
+    rows = store.rows('known')
+    latitude = store.latitude['known'][rows]
+    longitude = store.longitude['known'][rows]
+    names = [str(name) for name in store.name[rows]]
 
     # create map object
     mapobj = folium.Map(location=(32.81, -117.05), zoom_start=13)
 
-    # add markers to the map
-    for i, row in gdf.iterrows():
-        # black marker for null distance (geocode failed)
-        if gdf['null_flag'][i]:
-            folium.Circle(
-                location=[gdf.latitude[i], gdf.longitude[i]],
-                popup=gdf.name[i],
-                radius=200,
-                color='black',
-                fill=True,
-                fill_color='black'
-            ).add_to(mapobj)
-        # if geocode successful, graduated point with distance to known location determining radius
-        else:
-            folium.Circle(
-                location=[gdf.latitude[i], gdf.longitude[i]],
-                popup=gdf.name[i],
-                radius=gdf[bubble_size_parameter][i]*0.2,
-                color=color,
-                fill=True,
-                fill_color=color
-            ).add_to(mapobj)
-
-        # save map
-        mapobj.save(map_out)
+    # add a layer for each geocoder
+    for parameter, layer_color in zip(bubble_size_parameter, color):
+        distances = distance_table[parameter].to_numpy(dtype='float64')[rows]
+
+        # black marker for null distance (geocode failed), otherwise distance to known location determines radius
+        # (folium styles each feature from its 'style' property)
+        failed = np.isnan(distances)
+        radius = np.where(failed, 200, distances*0.2)
+        styles = [{'radius': float(r), 'color': 'black' if f else layer_color, 'fillColor': 'black' if f else layer_color, 'fill': True}
+                  for f, r in zip(failed, radius)]
+        properties = {'distance': [None if f else float(d) for f, d in zip(failed, distances)], 'style': styles}
+
+        folium.GeoJson(points_geojson(latitude, longitude, names, properties), name=parameter, marker=folium.Circle(),
+                       popup=folium.GeoJsonPopup(fields=['name'], labels=False)).add_to(mapobj)
+
+    # layer switcher for maps with several geocoders
+    if len(bubble_size_parameter) > 1:
+        folium.LayerControl().add_to(mapobj)
+
+    # save map
+    mapobj.save(map_out)
@@ -0,0 +1,9 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+import os
+import sys
+
+# the pipeline modules import each other by module name, so tests import them from the package directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sage_geocoding'))
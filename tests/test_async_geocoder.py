@@ -0,0 +1,95 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from async_geocoder import geocode_address_table_async
+from point_store import PointStore, STATUS_OK
+import retry
+from retry import RetryPolicy
+from stub_geocoder import StubGeocoderServer, stub_result
+
+import numpy as np
+import pytest
+
+# services answered by the stub server
+SERVICES = ['nominatim', 'google', 'arcgis', 'bing']
+
+
+# point store with numbered addresses
+def address_store(rows, unique=None):
+    """
+    Create a point store of addresses; with unique set, addresses repeat every unique rows.
+    :param rows: number of rows
+    :param unique: number of distinct addresses (default: rows)
+    :return: PointStore
+    """
+    unique = rows if unique is None else unique
+    address = ['{} Main Street San Diego CA'.format(100 + i % unique) for i in range(rows)]
+
+    return PointStore(np.arange(rows), ['Cleaners {}'.format(i) for i in range(rows)], address)
+
+
+# circuit breakers start closed in every test
+@pytest.fixture(autouse=True)
+def reset_breakers():
+    retry.breakers.clear()
+    yield
+    retry.breakers.clear()
+
+
+def test_coordinates_match_stub_results():
+    store = address_store(30, unique=20)
+    with StubGeocoderServer() as server:
+        geocode_address_table_async(store, SERVICES, base_url=server.base_url, token='stub', min_interval=0)
+
+    # each unique address is sent once per service
+    assert server.requests == 20 * len(SERVICES)
+
+    for service in SERVICES:
+        expected = np.array([stub_result(service, address)[:2] for address in store.address])
+        assert (store.status[service] == STATUS_OK).all()
+        np.testing.assert_allclose(store.latitude[service], expected[:, 0])
+        np.testing.assert_allclose(store.longitude[service], expected[:, 1])
+        assert not np.isnan(store.confidence[service]).any()
+
+
+def test_concurrency_cap():
+    store = address_store(40)
+    with StubGeocoderServer(latency=0.05) as server:
+        geocode_address_table_async(store, ['google'], concurrency=4, base_url=server.base_url, token='stub', min_interval=0)
+
+    assert server.requests == 40
+    assert server.max_in_flight == 4
+
+
+def test_session_reuse():
+    store = address_store(40)
+    with StubGeocoderServer(latency=0.01) as server:
+        geocode_address_table_async(store, ['arcgis'], concurrency=4, base_url=server.base_url, token='stub', min_interval=0)
+
+    # keep-alive connections are reused, at most one per request in flight
+    assert server.requests == 40
+    assert 1 <= len(server.connections) <= 4
+
+
+def test_retry_after_server_error():
+    store = address_store(5)
+    policy = RetryPolicy(max_retries=3, base_delay=0.01)
+    with StubGeocoderServer(fail_first=2) as server:
+        geocode_address_table_async(store, ['bing'], concurrency=1, base_url=server.base_url, token='stub', min_interval=0,
+                                    retry_policy=policy)
+
+    # the two failed requests are sent again and every address gets a result
+    assert server.requests == 7
+    assert (store.status['bing'] == STATUS_OK).all()
+
+
+def test_server_error_without_retries():
+    store = address_store(5)
+    policy = RetryPolicy(max_retries=0)
+    with StubGeocoderServer(fail_first=2) as server:
+        geocode_address_table_async(store, ['bing'], concurrency=1, base_url=server.base_url, token='stub', min_interval=0,
+                                    retry_policy=policy)
+
+    assert server.requests == 5
+    assert (store.status['bing'] == STATUS_OK).sum() == 3
@@ -0,0 +1,101 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from batch_geocoder import BatchJobUnfinished, bing_batch_geocode, geocode_points_batch
+from point_store import PointStore
+from providers import get_provider
+import retry
+
+import numpy as np
+import pytest
+
+# succeeded results with the full output schema: the fields are not in the input order and failed records have no
+# coordinates
+BING_SUCCEEDED = '\n'.join([
+    'Bing Spatial Data Services, 2.0',
+    'Id|GeocodeRequest/Culture|GeocodeRequest/Query|GeocodeResponse/Address/AddressLine|GeocodeResponse/Confidence|'
+    'GeocodeResponse/EntityType|GeocodeResponse/Point/Latitude|GeocodeResponse/Point/Longitude|StatusCode|FaultReason',
+    '0|en-US|100 Main Street San Diego CA|100 Main St|High|Address|32.71|-117.16|Success|',
+    '1|en-US|101 Main Street San Diego CA||Low|PopulatedPlace|32.72|-117.15|Success|',
+    '2|en-US|nowhere|||||||Success|'])
+
+
+# response of the stubbed session
+class StubResponse:
+
+    def __init__(self, body):
+        self.body = body
+
+    def raise_for_status(self):
+        return None
+
+    def json(self):
+        return self.body
+
+    @property
+    def content(self):
+        return self.body.encode('utf-8')
+
+
+# session answering a Bing geocode job: created, still running for a number of polls, then completed
+class StubBingSession:
+
+    def __init__(self, polls=1):
+        self.polls = polls
+        self.posts = 0
+        self.gets = 0
+
+    def job(self, status):
+        links = [{'role': 'output', 'name': 'succeeded', 'url': 'https://stub/job1/output/succeeded'}]
+        return {'resourceSets': [{'resources': [{'id': 'job1', 'status': status, 'links': links}]}]}
+
+    def post(self, url, **kwargs):
+        self.posts += 1
+        return StubResponse(self.job('Pending'))
+
+    def get(self, url, **kwargs):
+        self.gets += 1
+        if url.endswith('/succeeded'):
+            return StubResponse(BING_SUCCEEDED)
+        self.polls -= 1
+        return StubResponse(self.job('Completed' if self.polls <= 0 else 'Pending'))
+
+
+# the bing provider uses a stubbed session in every test
+@pytest.fixture
+def session():
+    provider = get_provider('bing')
+    original = provider.session
+    provider.session = StubBingSession()
+    retry.breakers.clear()
+    yield provider.session
+    provider.session = original
+    retry.breakers.clear()
+
+
+def test_bing_results_found_by_header(session):
+    coords = bing_batch_geocode([(0, 'a'), (1, 'b'), (2, 'c')], token='stub', poll_interval=0)
+
+    assert coords == {0: (32.71, -117.16, 1.0), 1: (32.72, -117.15, 0.3)}
+
+
+def test_bing_job_results_map_to_rows(session):
+    store = PointStore(np.arange(3), ['a', 'b', 'c'], ['100 Main Street', '101 Main Street', 'nowhere'])
+    latitude, longitude, confidence = geocode_points_batch(store, 'bing', token='stub', poll_interval=0)
+
+    np.testing.assert_allclose(latitude, [32.71, 32.72, np.nan])
+    np.testing.assert_allclose(longitude, [-117.16, -117.15, np.nan])
+    np.testing.assert_allclose(confidence, [1.0, 0.3, np.nan])
+
+
+def test_unfinished_bing_job_is_not_resubmitted(session):
+    session.polls = 1000000
+    store = PointStore(np.arange(2), ['a', 'b'], ['100 Main Street', '101 Main Street'])
+    latitude, _, _ = geocode_points_batch(store, 'bing', token='stub', poll_interval=0, max_wait=0.05)
+
+    # one job is submitted and the addresses stay without results
+    assert session.posts == 1
+    assert np.isnan(latitude).all()
+    with pytest.raises(BatchJobUnfinished):
+        bing_batch_geocode([(0, 'a')], token='stub', poll_interval=0, max_wait=0)
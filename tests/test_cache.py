@@ -0,0 +1,99 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+import cache
+from cache import CACHE_VERSION, GeocodeCache
+
+import sqlite3
+import pytest
+
+
+# wall clock set by the test
+class FakeTime:
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(cache, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def geocode_cache(tmp_path, clock):
+    geocode_cache = GeocodeCache(str(tmp_path / 'cache.db'), ttl=100, negative_ttl=10)
+    yield geocode_cache
+    geocode_cache.close()
+
+
+def test_result_expires_after_ttl(geocode_cache, clock):
+    geocode_cache.put('google', '100 Main Street', 32.7, -117.1, 1.0)
+
+    clock.now += 99
+    assert geocode_cache.get('google', '100 Main Street') == (32.7, -117.1, 1.0)
+    clock.now += 2
+    assert geocode_cache.get('google', '100 Main Street') is None
+    assert geocode_cache.stats() == {'hits': 1, 'negative_hits': 0, 'misses': 1}
+
+
+def test_failure_expires_after_negative_ttl(geocode_cache, clock):
+    geocode_cache.put('google', '100 Main Street', None, None)
+    geocode_cache.put('google', '200 Park Avenue', 32.7, -117.1)
+
+    clock.now += 9
+    assert geocode_cache.get('google', '100 Main Street') == (None, None, None)
+    clock.now += 2
+    assert geocode_cache.get('google', '100 Main Street') is None
+
+    # only the expired failure is purged
+    assert geocode_cache.purge_expired() == 1
+    assert geocode_cache.get('google', '200 Park Avenue') == (32.7, -117.1, None)
+
+
+def test_max_entries_evicts_oldest(tmp_path, clock):
+    geocode_cache = GeocodeCache(str(tmp_path / 'cache.db'), max_entries=2)
+    for k, address in enumerate(['100 Main Street', '200 Park Avenue', '300 Bay Road']):
+        clock.now += 1
+        geocode_cache.put('google', address, 32.7 + k, -117.1)
+
+    assert geocode_cache.get('google', '100 Main Street') is None
+    assert geocode_cache.get('google', '200 Park Avenue') is not None
+    assert geocode_cache.get('google', '300 Bay Road') is not None
+    geocode_cache.close()
+
+
+def test_key_is_canonical_address_per_service(geocode_cache):
+    geocode_cache.put('google', '123 North Main Street', 32.7, -117.1)
+
+    assert geocode_cache.get('google', '123 n. main st.') == (32.7, -117.1, None)
+    assert geocode_cache.get('bing', '123 North Main Street') is None
+
+
+def test_old_keys_are_migrated(tmp_path, clock):
+    # cache written before confidences were stored and addresses were canonicalized
+    path = str(tmp_path / 'cache.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE geocode_cache (service TEXT NOT NULL, address TEXT NOT NULL, latitude REAL, '
+                 'longitude REAL, created REAL NOT NULL, PRIMARY KEY (service, address))')
+    conn.executemany('INSERT INTO geocode_cache VALUES (?, ?, ?, ?, ?)',
+                     [('google', '123 NORTH MAIN STREET', 32.7, -117.1, clock.now - 2),
+                      ('google', '123 N MAIN STREET', 32.8, -117.2, clock.now - 1),
+                      ('google', '200 PARK AVE', 32.9, -117.3, clock.now)])
+    conn.commit()
+    conn.close()
+
+    geocode_cache = GeocodeCache(path)
+
+    # variants of an old key share the canonical key, the newest result is kept
+    assert geocode_cache.get('google', '123 North Main Street') == (32.8, -117.2, None)
+    assert geocode_cache.get('google', '200 Park Avenue') == (32.9, -117.3, None)
+    assert geocode_cache.conn.execute('SELECT COUNT(*) FROM geocode_cache').fetchone()[0] == 2
+    assert geocode_cache.conn.execute('PRAGMA user_version').fetchone()[0] == CACHE_VERSION
+    geocode_cache.close()
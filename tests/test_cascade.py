@@ -0,0 +1,105 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from point_store import PointStore, STATUS_OK, STATUS_PENDING
+import providers
+from providers import GeocoderProvider, register_provider
+import retry
+from utility import calc_distance_statistics, create_distance_table, geocode_address_table_cascade
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# known location of each address; 0.000274 degrees of latitude is about 100 feet, 0.0145 about a mile
+KNOWN = {'A': (32.70, -117.10), 'B': (32.71, -117.10), 'C': (32.72, -117.10), 'D': (32.73, -117.10)}
+
+# result (latitude, longitude, confidence) of each service in cost order; missing addresses have no result
+RESULTS = {'cheap': {'A': (32.70, -117.10, 0.95), 'B': (32.71, -117.10, 0.5), 'C': (32.72, -117.10, 0.5)},
+           'mid': {'B': (32.710274, -117.10, 0.6), 'C': (32.7345, -117.10, 0.4), 'D': (32.73, -117.10, 0.95)},
+           'pricey': {'C': (32.6855, -117.10, 0.3)}}
+
+
+# provider answering from RESULTS and counting its requests
+class ScriptedProvider(GeocoderProvider):
+
+    min_interval = 0
+    http = False
+
+    def __init__(self):
+        self.requests = []
+
+    def geocode(self, address):
+        self.requests.append(address)
+        if address not in RESULTS[self.name]:
+            raise LookupError('No result for {}'.format(address))
+        return RESULTS[self.name][address]
+
+
+# the scripted services are registered for one test
+@pytest.fixture(autouse=True)
+def scripted_providers():
+    for name in RESULTS:
+        register_provider(name)(type('{}Provider'.format(name.title()), (ScriptedProvider,), {}))
+    retry.breakers.clear()
+    yield
+    for name in RESULTS:
+        providers.PROVIDERS.pop(name, None)
+        providers.providers.pop(name, None)
+    retry.breakers.clear()
+
+
+# point store of the addresses (A twice) with known coordinates
+def cascade_store():
+    address = ['A', 'B', 'C', 'D', 'A']
+    store = PointStore(np.arange(len(address)), ['Cleaners {}'.format(a) for a in address], address)
+    store.set_coordinates('known', [KNOWN[a][0] for a in address], [KNOWN[a][1] for a in address])
+    return store
+
+
+def test_cascade_sends_addresses_until_resolved():
+    store = geocode_address_table_cascade(cascade_store(), list(RESULTS), min_confidence=0.9, agree_feet=250)
+
+    # A is confident at the first service, B resolved by agreement, D confident at the second service; only C reaches
+    # the last service
+    assert providers.get_provider('cheap').requests == ['A', 'B', 'C', 'D']
+    assert providers.get_provider('mid').requests == ['B', 'C', 'D']
+    assert providers.get_provider('pricey').requests == ['C']
+
+    # chosen results: A from cheap, the more confident of B's agreeing pair, C's most confident result, D from mid
+    np.testing.assert_allclose(store.latitude['cascade'], [32.70, 32.710274, 32.72, 32.73, 32.70])
+    np.testing.assert_allclose(store.confidence['cascade'], [0.95, 0.6, 0.5, 0.95, 0.95])
+    assert (store.status['cascade'] == STATUS_OK).all()
+
+    # rows not sent to a service stay pending for it
+    assert list(store.status['mid'] == STATUS_PENDING) == [True, False, False, False, True]
+    assert list(store.status['pricey'] == STATUS_PENDING) == [True, True, False, True, True]
+
+
+def test_agree_feet_controls_agreement():
+    geocode_address_table_cascade(cascade_store(), list(RESULTS), min_confidence=0.9, agree_feet=50)
+
+    # B's results are about 100 feet apart, so without agreement B is also sent to the last service
+    assert providers.get_provider('pricey').requests == ['B', 'C']
+
+
+def test_low_confidence_falls_through():
+    geocode_address_table_cascade(cascade_store(), list(RESULTS), min_confidence=1.0, agree_feet=250)
+
+    # no result is confident enough: A and D go on to the next service, B still stops on agreement
+    assert providers.get_provider('mid').requests == ['A', 'B', 'C', 'D']
+    assert providers.get_provider('pricey').requests == ['A', 'C', 'D']
+
+
+def test_match_rate_counts_only_queried_rows(tmp_path):
+    store = geocode_address_table_cascade(cascade_store(), list(RESULTS), min_confidence=0.9, agree_feet=250)
+    address_table = pd.DataFrame({'id_num': store.id_num, 'Name': store.name, 'Address': store.address})
+    distance_table = create_distance_table(address_table, store, str(tmp_path / 'distances.csv'))
+    stats = calc_distance_statistics(distance_table, str(tmp_path / 'stats.csv')).set_index('comparison')
+
+    # cheap answered 4 of its 5 rows (D has no result); later services are rated on the rows sent to them only
+    assert stats.loc['Cheap', 'queried'] == 5 and stats.loc['Cheap', 'count'] == 4
+    assert stats.loc['Mid', 'queried'] == 3 and stats.loc['Mid', 'percent_match'] == 100
+    assert stats.loc['Pricey', 'queried'] == 1 and stats.loc['Pricey', 'percent_match'] == 100
+    assert stats.loc['Cascade', 'queried'] == 5 and stats.loc['Cascade', 'percent_match'] == 100
@@ -0,0 +1,78 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from distance_stats import PERCENTILES, DistanceStatistics, QuantileSketch, queried_column
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+# distances spread over several orders of magnitude, with exact zeros
+def random_distances(rng, n):
+    values = rng.lognormal(mean=6.0, sigma=2.0, size=n)
+    values[rng.random(n) < 0.02] = 0.0
+    return values
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_sketch_quantiles_within_relative_accuracy(seed):
+    rng = np.random.default_rng(seed)
+    values = random_distances(rng, 20000)
+    sketch = QuantileSketch(relative_accuracy=0.005)
+    sketch.update(values)
+
+    # the sketch returns a value of the bucket holding the rank's element (numpy's 'lower' method)
+    for q in [0.01, 0.05, 0.25, 0.5, 0.75] + [p / 100 for p in PERCENTILES]:
+        exact = np.percentile(values, q * 100, method='lower')
+        assert sketch.quantile(q) == pytest.approx(exact, rel=0.005 + 1e-9, abs=1e-12)
+
+
+def test_sketch_updates_in_chunks_match_one_update():
+    rng = np.random.default_rng(3)
+    values = random_distances(rng, 10000)
+    whole = QuantileSketch()
+    whole.update(values)
+    chunked = QuantileSketch()
+    for chunk in np.array_split(values, 7):
+        chunked.update(chunk)
+
+    assert chunked.zero_count == whole.zero_count
+    np.testing.assert_array_equal(chunked.counts, whole.counts)
+
+
+def test_empty_sketch():
+    assert np.isnan(QuantileSketch().quantile(0.5))
+
+
+@pytest.mark.parametrize('chunks', [1, 2, 9, 100])
+def test_running_mean_and_variance_match_numpy(chunks):
+    rng = np.random.default_rng(chunks)
+    values = random_distances(rng, 5000)
+    values[rng.random(len(values)) < 0.1] = np.nan
+    table = pd.DataFrame({'Google': values})
+
+    # uneven chunk sizes
+    edges = np.sort(rng.choice(np.arange(1, len(table)), chunks - 1, replace=False))
+    stats = DistanceStatistics(['Google'])
+    for chunk in np.split(np.arange(len(table)), edges):
+        stats.update(table.iloc[chunk])
+
+    found = values[~np.isnan(values)]
+    row = stats.table().iloc[0]
+    assert row['count'] == len(found) and row['queried'] == len(values)
+    assert row['mean_distance'] == pytest.approx(found.mean(), rel=1e-9)
+    assert row['std_dev'] == pytest.approx(np.std(found, ddof=1), rel=1e-9)
+    assert stats.m2['Google'] / (len(found) - 1) == pytest.approx(np.var(found, ddof=1), rel=1e-9)
+    assert row['max_distance'] == found.max()
+
+
+def test_match_rate_uses_queried_rows():
+    table = pd.DataFrame({'Bing': [10.0, np.nan, 30.0, np.nan], queried_column('Bing'): [True, True, True, False]})
+    stats = DistanceStatistics(['Bing'])
+    stats.update(table)
+    row = stats.table().iloc[0]
+
+    assert row['queried'] == 3 and row['count'] == 2
+    assert row['percent_match'] == pytest.approx(200 / 3)
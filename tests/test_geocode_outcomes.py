@@ -0,0 +1,91 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from cache import GeocodeCache
+from journal import GeocodeJournal
+from point_store import PointStore, STATUS_OK
+import providers
+from providers import GeocoderProvider, register_provider
+import retry
+from utility import geocode_address_table
+
+import numpy as np
+import pytest
+
+
+# exception named like geopy's rejected api key error
+class GeocoderAuthenticationFailure(Exception):
+    pass
+
+
+# provider rejecting every request
+class RejectedKeyProvider(GeocoderProvider):
+
+    # offline, so the test sends no requests
+    min_interval = 0
+    http = False
+    requests = 0
+
+    def geocode(self, address):
+        RejectedKeyProvider.requests += 1
+        raise GeocoderAuthenticationFailure('The api key is invalid')
+
+
+# provider answering every request
+class AnsweringProvider(GeocoderProvider):
+
+    min_interval = 0
+    http = False
+
+    def geocode(self, address):
+        return 32.7, -117.1, 1.0
+
+
+# test providers are registered for one test, circuit breakers start closed
+@pytest.fixture(autouse=True)
+def test_providers():
+    register_provider('rejected')(RejectedKeyProvider)
+    register_provider('answering')(AnsweringProvider)
+    RejectedKeyProvider.requests = 0
+    retry.breakers.clear()
+    yield
+    for name in ('rejected', 'answering'):
+        providers.PROVIDERS.pop(name, None)
+        providers.providers.pop(name, None)
+    retry.breakers.clear()
+
+
+# point store with numbered addresses
+def address_store(rows):
+    return PointStore(np.arange(rows), ['Cleaners {}'.format(i) for i in range(rows)],
+                      ['{} Main Street San Diego CA'.format(100 + i) for i in range(rows)])
+
+
+def test_auth_error_is_not_cached_or_journaled(tmp_path):
+    store = address_store(5)
+    cache = GeocodeCache(str(tmp_path / 'cache.db'))
+    journal = GeocodeJournal(str(tmp_path / 'journal.csv'))
+    geocode_address_table(store, 'rejected', cache, journal=journal)
+    journal.close()
+
+    # the first rejected request stops the service, nothing is kept, so every row is geocoded again by the next run
+    assert RejectedKeyProvider.requests == 1
+    assert retry.get_breaker('rejected').is_stopped()
+    assert not (store.status['rejected'] == STATUS_OK).any()
+    assert all(cache.get('rejected', address) is None for address in store.address)
+    assert GeocodeJournal(str(tmp_path / 'journal.csv'), resume=True).load() == {}
+    cache.close()
+
+
+def test_answers_are_cached_and_journaled(tmp_path):
+    store = address_store(3)
+    cache = GeocodeCache(str(tmp_path / 'cache.db'))
+    journal = GeocodeJournal(str(tmp_path / 'journal.csv'))
+    geocode_address_table(store, 'answering', cache, journal=journal)
+    journal.close()
+
+    assert (store.status['answering'] == STATUS_OK).all()
+    assert all(cache.get('answering', address) == (32.7, -117.1, 1.0) for address in store.address)
+    assert len(GeocodeJournal(str(tmp_path / 'journal.csv'), resume=True).load()['answering']) == 3
+    cache.close()
@@ -0,0 +1,84 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from incremental import compare_rows, match_changed_rows, match_keys, restore_previous_results
+from point_store import PointStore, STATUS_FAILED, STATUS_OK, STATUS_PENDING
+from utility import generate_id_nums
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# previous input: (name, address)
+PREVIOUS = [('Main Cleaners', '100 Main Street'), ('Park Cleaners', '200 Park Avenue'), ('Bay Cleaners', '300 Bay Road')]
+
+
+# point store with stable ids
+def input_store(rows):
+    table = pd.DataFrame(rows, columns=['Name', 'Address'])
+    return PointStore(generate_id_nums(table, 'Name', 'Address'), table['Name'], table['Address'])
+
+
+# previous results of one service, with a failed geocode for the last row
+def previous_results():
+    store = input_store(PREVIOUS)
+    return {'google': pd.DataFrame({'id_num': store.id_num, 'name': store.name, 'address': store.address,
+                                    'latitude': [32.70, 32.71, np.nan], 'longitude': [-117.10, -117.11, np.nan],
+                                    'confidence': [1.0, 0.8, np.nan]})}
+
+
+@pytest.mark.parametrize('rows, expected', [
+    # same input
+    (PREVIOUS, {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 3}),
+    # a new row
+    (PREVIOUS + [('Lake Cleaners', '400 Lake Drive')], {'added': 1, 'changed': 0, 'removed': 0, 'unchanged': 3}),
+    # a removed row
+    (PREVIOUS[:2], {'added': 0, 'changed': 0, 'removed': 1, 'unchanged': 2}),
+    # name kept, address changed
+    ([PREVIOUS[0], PREVIOUS[1], ('Bay Cleaners', '310 Bay Road')], {'added': 0, 'changed': 1, 'removed': 0, 'unchanged': 2}),
+    # address kept, name changed (normalized the way ids are, so case and punctuation do not matter)
+    ([PREVIOUS[0], ('Parkside Cleaners', '200 PARK AVENUE.'), PREVIOUS[2]],
+     {'added': 0, 'changed': 1, 'removed': 0, 'unchanged': 2}),
+    # a changed row, a removed row and a new row
+    ([('Main Cleaners', '110 Main Street'), PREVIOUS[1], ('Lake Cleaners', '400 Lake Drive')],
+     {'added': 1, 'changed': 1, 'removed': 1, 'unchanged': 1}),
+])
+def test_compare_rows(rows, expected):
+    assert compare_rows(input_store(rows), previous_results()) == expected
+
+
+@pytest.mark.parametrize('new, old, expected', [
+    # name matches, address matches, no match
+    ([('a', 'x')], [('a', 'y')], 1),
+    ([('b', 'x')], [('a', 'x')], 1),
+    ([('b', 'x')], [('a', 'y')], 0),
+    # each removed row is paired once
+    ([('a', 'x'), ('a', 'y')], [('a', 'z')], 1),
+    # unknown names and addresses of rows from old csv files never match
+    ([('a', 'x')], [(None, None)], 0),
+])
+def test_match_changed_rows(new, old, expected):
+    new_name, new_address = zip(*new)
+    old_name, old_address = zip(*old)
+    assert match_changed_rows(match_keys(new_name), match_keys(new_address), match_keys(old_name), match_keys(old_address)) == expected
+
+
+def test_restore_previous_results():
+    rows = PREVIOUS + [('Lake Cleaners', '400 Lake Drive')]
+    rows[1] = ('Park Cleaners', '210 Park Avenue')
+    store = input_store(rows)
+    restored = restore_previous_results(store, previous_results())
+
+    # the unchanged row with a result is restored; the changed, new and failed rows stay pending
+    assert restored == 1
+    assert list(store.status['google']) == [STATUS_OK, STATUS_PENDING, STATUS_PENDING, STATUS_PENDING]
+    assert store.latitude['google'][0] == 32.70 and store.confidence['google'][0] == 1.0
+
+
+def test_restore_failed_results():
+    store = input_store(PREVIOUS)
+    restored = restore_previous_results(store, previous_results(), restore_failed=True)
+
+    assert restored == 3
+    assert list(store.status['google']) == [STATUS_OK, STATUS_OK, STATUS_FAILED]
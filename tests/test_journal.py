@@ -0,0 +1,78 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from journal import GeocodeJournal
+from point_store import PointStore, STATUS_FAILED, STATUS_OK, STATUS_PENDING
+
+import numpy as np
+
+
+# point store of numbered rows
+def journal_store(rows):
+    return PointStore(np.arange(rows), ['Cleaners {}'.format(i) for i in range(rows)],
+                      ['{} Main Street'.format(100 + i) for i in range(rows)])
+
+
+def test_resume_keeps_recorded_outcomes(tmp_path):
+    path = str(tmp_path / 'journal.csv')
+    journal = GeocodeJournal(path)
+    journal.record('google', 0, 32.7, -117.1, 1.0)
+    journal.record('google', 1, None, None)
+    journal.close()
+
+    # a resumed journal appends to the earlier outcomes
+    journal = GeocodeJournal(path, resume=True)
+    journal.record('bing', 2, 32.9, -117.3)
+    store = journal_store(3)
+    assert journal.restore(store, ['google', 'bing']) == 3
+    journal.close()
+
+    assert list(store.status['google']) == [STATUS_OK, STATUS_FAILED, STATUS_PENDING]
+    assert list(store.status['bing']) == [STATUS_PENDING, STATUS_PENDING, STATUS_OK]
+    assert store.confidence['google'][0] == 1.0 and np.isnan(store.confidence['bing'][2])
+
+
+def test_new_journal_truncates(tmp_path):
+    path = str(tmp_path / 'journal.csv')
+    journal = GeocodeJournal(path)
+    journal.record('google', 0, 32.7, -117.1)
+    journal.close()
+
+    journal = GeocodeJournal(path, resume=False)
+    store = journal_store(1)
+    assert journal.restore(store, ['google']) == 0
+    journal.close()
+    assert store.status['google'][0] == STATUS_PENDING
+
+
+def test_resume_skips_record_cut_off_mid_line(tmp_path):
+    path = str(tmp_path / 'journal.csv')
+    journal = GeocodeJournal(path)
+    journal.record('google', 0, 32.7, -117.1, 1.0)
+    journal.record('google', 1, 32.8, -117.2, 0.8)
+    journal.close()
+
+    # a crash while writing the second record leaves part of the line
+    with open(path) as f:
+        text = f.read()
+    with open(path, 'w') as f:
+        f.write(text[:-8])
+
+    # the partial record is dropped and new records start on their own line
+    journal = GeocodeJournal(path, resume=True)
+    journal.record('google', 2, 32.9, -117.3, 0.6)
+    store = journal_store(3)
+    assert journal.restore(store, ['google']) == 2
+    journal.close()
+    assert list(store.status['google']) == [STATUS_OK, STATUS_PENDING, STATUS_OK]
+    assert store.latitude['google'][2] == 32.9
+
+
+def test_old_records_without_confidence(tmp_path):
+    path = str(tmp_path / 'journal.csv')
+    with open(path, 'w') as f:
+        f.write('google,0,32.7,-117.1\n')
+
+    entries = GeocodeJournal(path, resume=True).load()
+    assert entries['google'][0][:2] == (32.7, -117.1) and np.isnan(entries['google'][0][2])
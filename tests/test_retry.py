@@ -0,0 +1,183 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+import retry
+from retry import CircuitBreaker, RetryPolicy, run_with_retries
+
+import random
+import pytest
+
+
+# clock advanced only by sleep calls
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+# retry policy with given backoffs, in the order they are asked for
+class FixedDelayPolicy(RetryPolicy):
+
+    def __init__(self, delays, **kwargs):
+        super().__init__(**kwargs)
+        self.delays = list(delays)
+
+    def delay(self, attempt):
+        return self.delays.pop(0)
+
+
+# requests answered from a script of outcomes per item, with the clock time of each request
+class ScriptedAttempt:
+
+    def __init__(self, clock, outcomes):
+        self.clock = clock
+        self.outcomes = {item: list(script) for item, script in outcomes.items()}
+        self.requests = []
+
+    def __call__(self, item):
+        self.requests.append((self.clock.now, item))
+        return self.outcomes[item].pop(0)
+
+
+# retry module runs on the fake clock with a seeded random generator
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(retry, 'time', clock)
+    monkeypatch.setattr(retry, 'random', random.Random(582))
+    retry.breakers.clear()
+    yield clock
+    retry.breakers.clear()
+
+
+def test_transient_error_is_retried_then_succeeds(clock):
+    attempt = ScriptedAttempt(clock, {0: ['timeout', 'quota', 'success']})
+    policy = RetryPolicy(max_retries=4, base_delay=1.0, max_delay=60.0)
+    outcomes = run_with_retries([0], attempt, 'svc', policy, sleep=clock.sleep)
+
+    assert outcomes == {0: 'success'}
+    assert len(attempt.requests) == 3
+
+    # each retry waits for its jittered backoff, at most base_delay * 2 ** attempt
+    times = [time for time, _ in attempt.requests]
+    assert 0 <= times[1] - times[0] <= 1.0
+    assert 0 <= times[2] - times[1] <= 2.0
+
+
+def test_permanent_outcomes_are_not_retried(clock):
+    attempt = ScriptedAttempt(clock, {0: ['failure'], 1: ['error'], 2: ['success']})
+    outcomes = run_with_retries([0, 1, 2], attempt, 'svc', RetryPolicy(), sleep=clock.sleep)
+
+    assert outcomes == {0: 'failure', 1: 'error', 2: 'success'}
+    assert [item for _, item in attempt.requests] == [0, 1, 2]
+    assert clock.sleeps == []
+
+
+def test_retries_give_up_after_max_retries(clock):
+    attempt = ScriptedAttempt(clock, {0: ['unavailable'] * 3})
+    outcomes = run_with_retries([0], attempt, 'svc', RetryPolicy(max_retries=2), CircuitBreaker('svc', failure_threshold=10),
+                                sleep=clock.sleep)
+
+    assert outcomes == {0: 'unavailable'}
+    assert len(attempt.requests) == 3
+
+
+def test_open_circuit_sends_no_requests(clock):
+    breaker = CircuitBreaker('svc', failure_threshold=2, reset_timeout=30.0)
+    breaker.record_failure()
+    breaker.record_failure()
+    attempt = ScriptedAttempt(clock, {item: ['success'] for item in range(3)})
+    outcomes = run_with_retries(range(3), attempt, 'svc', RetryPolicy(max_outage=10.0), breaker, sleep=clock.sleep)
+
+    # the outage would outlast max_outage, so the items are given up without a request
+    assert outcomes == {0: 'unavailable', 1: 'unavailable', 2: 'unavailable'}
+    assert attempt.requests == []
+
+
+def test_probe_after_reset_timeout_closes_circuit(clock):
+    breaker = CircuitBreaker('svc', failure_threshold=2, reset_timeout=30.0)
+    attempt = ScriptedAttempt(clock, {0: ['unavailable', 'success'], 1: ['unavailable', 'success'], 2: ['success']})
+    outcomes = run_with_retries(range(3), attempt, 'svc', FixedDelayPolicy([0.5, 0.5]), breaker, sleep=clock.sleep)
+
+    assert outcomes == {0: 'success', 1: 'success', 2: 'success'}
+    assert breaker.state == 'closed'
+
+    # the second error opens the circuit at time 0: nothing is sent until the reset timeout is over
+    assert [time for time, _ in attempt.requests[2:]] == [30.0, 30.0, 30.0]
+
+
+def test_delayed_retries_are_sent_in_ready_time_order(clock):
+    attempt = ScriptedAttempt(clock, {item: ['timeout', 'success'] for item in range(4)})
+    policy = FixedDelayPolicy([3.0, 1.0, 2.0, 1.0])
+    run_with_retries(range(4), attempt, 'svc', policy, CircuitBreaker('svc', failure_threshold=10), sleep=clock.sleep)
+
+    # first attempts in order, retries by ready time (ties in the order they failed)
+    assert [item for _, item in attempt.requests] == [0, 1, 2, 3, 1, 3, 2, 0]
+    assert [time for time, _ in attempt.requests[4:]] == [1.0, 1.0, 2.0, 3.0]
+
+
+def test_auth_error_stops_the_service(clock):
+    breaker = CircuitBreaker('svc')
+    attempt = ScriptedAttempt(clock, {item: ['auth'] for item in range(3)})
+    outcomes = run_with_retries(range(3), attempt, 'svc', RetryPolicy(), breaker, sleep=clock.sleep)
+
+    assert outcomes == {0: 'auth', 1: 'auth', 2: 'auth'}
+    assert len(attempt.requests) == 1
+    assert breaker.is_stopped()
+
+    # a stopped service stays stopped
+    breaker.record_success()
+    assert breaker.is_stopped()
+
+
+def test_backoff_jitter_bounds(clock):
+    policy = RetryPolicy(base_delay=0.5, max_delay=8.0)
+    for attempt in range(8):
+        delays = [policy.delay(attempt) for _ in range(200)]
+        cap = min(8.0, 0.5 * 2 ** attempt)
+        assert all(0 <= delay <= cap for delay in delays)
+
+        # full jitter spreads the retries over the whole range
+        assert max(delays) > 0.9 * cap and min(delays) < 0.1 * cap
+
+
+def test_breaker_transitions(clock):
+    breaker = CircuitBreaker('svc', failure_threshold=3, reset_timeout=10.0)
+
+    # closed until the threshold of consecutive errors, a response resets the count
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == 'closed' and breaker.wait_time() == 0
+
+    # open: callers wait for the rest of the reset timeout
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    clock.now = 4.0
+    assert breaker.wait_time() == pytest.approx(6.0)
+    assert breaker.outage_seconds() == pytest.approx(4.0)
+
+    # half open: one probe at a time
+    clock.now = 10.0
+    assert breaker.wait_time() == 0
+    assert breaker.state == 'half_open'
+    assert breaker.wait_time() > 0
+
+    # a failed probe opens the circuit again, a successful one closes it
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    clock.now = 20.0
+    assert breaker.wait_time() == 0
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.outage_seconds() == 0
@@ -0,0 +1,62 @@
+# The Sage Project
+# Jessica Embury
+
+# import statements
+from main import map_stages
+from point_store import PointStore
+import providers
+from providers import GeocoderProvider, register_provider
+from utility import DEFAULT_MAP_COLOR, DEFAULT_MAP_ICON, EXTRA_PLOT_COLORS, create_distance_table, distance_column, \
+    distance_columns, plot_palette, service_style
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+# provider without a label or map style
+class CountyProvider(GeocoderProvider):
+
+    http = False
+
+    def geocode(self, address):
+        return 32.7, -117.1, 1.0
+
+
+# the test provider is registered for one test
+@pytest.fixture(autouse=True)
+def county_provider():
+    register_provider('county')(CountyProvider)
+    yield
+    providers.PROVIDERS.pop('county', None)
+    providers.providers.pop('county', None)
+
+
+def test_provider_styles():
+    assert service_style('arcgis') == ('ArcGIS', 'red', 'globe')
+    assert service_style('cascade') == ('Cascade', 'cadetblue', 'ok')
+    assert service_style('county') == ('County', DEFAULT_MAP_COLOR, DEFAULT_MAP_ICON)
+
+
+def test_registered_provider_gets_distance_and_map_columns(tmp_path):
+    store = PointStore(np.arange(2), ['a', 'b'], ['100 Main Street', '101 Main Street'])
+    store.set_coordinates('known', [32.7, 32.8], [-117.1, -117.2])
+    store.set_coordinates('google', [32.7, 32.8], [-117.1, -117.2])
+    store.set_coordinates('county', [32.7, np.nan], [-117.1, np.nan])
+    address_table = pd.DataFrame({'id_num': store.id_num, 'Name': store.name, 'Address': store.address})
+
+    distance_table = create_distance_table(address_table, store, str(tmp_path / 'distances.csv'))
+    assert distance_columns(distance_table) == ['Google', distance_column('county')]
+    assert distance_table['County'].iloc[0] == pytest.approx(0)
+
+    # one map and one bubble map per service, and the combined bubble map
+    stages = map_stages(str(tmp_path), ['google', 'county'], str(tmp_path / '{}.html'))
+    assert [stage.name for stage in stages] == ['map_google', 'map_county', 'google_bubble', 'county_bubble', 'all_bubble']
+
+
+def test_plot_palette_is_keyed_by_column():
+    # built in columns keep their color whichever columns are plotted with them
+    assert plot_palette(['Bing', 'Google']) == {'Bing': 'deepskyblue', 'Google': 'lawngreen'}
+    palette = plot_palette(['County', 'Google', 'City'])
+    assert palette['Google'] == 'lawngreen'
+    assert palette['County'] == EXTRA_PLOT_COLORS[0] and palette['City'] == EXTRA_PLOT_COLORS[1]